@@ -0,0 +1,5 @@
+import os
+
+# keep tests away from the example albums and out of worker processes
+os.environ.setdefault('ZT_SIG_STORE', '')
+os.environ.setdefault('ZT_HASH_WORKER_MODE', 'thread')
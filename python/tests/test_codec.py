@@ -0,0 +1,39 @@
+from zita.serve.codec import PredictionCodec
+
+
+class FakeRedis(object):
+
+    def __init__(self):
+        self.hashes = {}
+
+    def hsetnx(self, key, field, value):
+        self.hashes.setdefault(key, {}).setdefault(field, value)
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(field)
+
+
+PRED = {'id': 'a.jpg', 'model': 'm', 'classes': ['cat', 'dog'],
+        'tags': ['dog'], 'preds': [0, 1], 'probs': [0.25, 0.75]}
+
+
+def test_schemas_are_saved_again_after_a_flush():
+    client = FakeRedis()
+    writer = PredictionCodec(client, 'schemas')
+    reader = PredictionCodec(client, 'schemas')
+    value = writer.encode(PRED)
+    assert reader.decode(value) == PRED
+
+    client.hashes.clear()
+    assert PredictionCodec(client, 'schemas').decode(value) is None
+    # a failed lookup in the writer process saves its schema again
+    writer.schemas.clear()
+    assert writer.decode(value) is None
+    value = writer.encode(PRED)
+    assert PredictionCodec(client, 'schemas').decode(value) == PRED
+
+    # or it is saved again after `resave_sec`
+    client.hashes.clear()
+    writer.resave_sec = 0
+    value = writer.encode(PRED)
+    assert PredictionCodec(client, 'schemas').decode(value) == PRED
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from PIL import Image
+
+from zita.data import get_labels
+from zita.data.dedup import (dedup_df, IncrementalDedup, compare_hash,
+                             hash_files)
+
+
+@pytest.fixture
+def albums(tmp_path):
+    """Ten random images, 'alb/{i}.png', where i and i + 5 are near
+    duplicates"""
+    rng = np.random.RandomState(0)
+    (tmp_path / 'alb').mkdir()
+    for i in range(5):
+        pixels = (rng.rand(64, 64) * 255).astype('uint8')
+        Image.fromarray(pixels).save(tmp_path / 'alb' / f'{i}.png')
+        pixels[0, 0] = 255 - pixels[0, 0]
+        Image.fromarray(pixels).save(tmp_path / 'alb' / f'{i + 5}.png')
+    return tmp_path
+
+
+def labels(names):
+    return pd.DataFrame({'name': names, 'label': 'a,b'})
+
+
+def test_incremental_matches_full_dedup(albums):
+    names = ['alb/0.png', 'alb/1.png', 'alb/2.png', 'alb/5.png',
+             'alb/1.png', 'alb/3.png', 'alb/6.png', 'alb/4.png',
+             'alb/9.png', 'alb/3.png']
+    df = labels(names)
+    full = dedup_df(df, albums)
+
+    dedup = IncrementalDedup(albums)
+    for end in [3, 5, 8, len(names)]:
+        inc = dedup.update(df.iloc[:end])
+    assert list(inc.index) == list(full.index)
+    assert list(full['name']) == ['alb/0.png', 'alb/1.png', 'alb/2.png',
+                                  'alb/3.png', 'alb/4.png']
+
+
+def brute_dedup(df, path, dup_range):
+    """Positions of the rows kept when each row is compared with every
+    row before it"""
+    min_thresh, max_thresh = dup_range
+    sigs = [sig for _, sig in hash_files([path / x for x in df['name']])]
+    return [j for j in range(len(sigs))
+            if not any(min_thresh <= compare_hash(sigs[i], sigs[j])
+                       <= max_thresh for i in range(j))]
+
+
+@pytest.mark.parametrize('dup_range', [(0, 0), (0, 4), (1, 4), (0, 8),
+                                       (5, 8)])
+def test_incremental_matches_brute_force(albums, dup_range):
+    # 'alb/{i + 10}.png' are 4 to 7 bits away from 'alb/{i}.png'
+    for i in range(5):
+        pixels = np.array(Image.open(albums / 'alb' / f'{i}.png'))
+        pixels[:, :7] = 255 - pixels[:, :7]
+        Image.fromarray(pixels).save(albums / 'alb' / f'{i + 10}.png')
+
+    rng = np.random.RandomState(1)
+    for _ in range(5):
+        names = [f'alb/{i}.png' for i in rng.randint(15, size=20)]
+        df = labels(names)
+        expected = brute_dedup(df, albums, dup_range)
+        assert list(dedup_df(df, albums, dup_range).index) == expected
+
+        dedup = IncrementalDedup(albums, dup_range)
+        ends = sorted(rng.choice(np.arange(1, len(names)), 3, replace=False))
+        for end in ends + [len(names)]:
+            inc = dedup.update(df.iloc[:end])
+            assert list(inc.index) == brute_dedup(df.iloc[:end], albums,
+                                                  dup_range)
+        assert list(inc.index) == expected
+
+
+def test_incremental_rebuilds_when_rows_are_removed(albums):
+    df = labels(['alb/0.png', 'alb/5.png', 'alb/1.png'])
+    dedup = IncrementalDedup(albums)
+    dedup.update(df)
+    inc = dedup.update(df.iloc[1:])
+    assert list(inc.index) == list(dedup_df(df.iloc[1:], albums).index)
+
+
+def test_get_labels_reloads_changed_csv(albums):
+    csv = albums / 'tags.csv'
+    csv.write_text('alb/0.png,a\nalb/1.png,b||a\n')
+    first = get_labels(str(csv), dup_range=None)
+    assert get_labels(str(csv), dup_range=None) is first
+
+    with csv.open('a') as f:
+        f.write('alb/2.png,c\nalb/1.png,b||d\n')
+    second = get_labels(str(csv), dup_range=None)
+    assert list(second['label']) == ['a', 'a,b', 'c', 'b,d']
+    deduped = get_labels(str(csv), path=albums)
+    assert list(deduped['name']) == ['alb/0.png', 'alb/1.png', 'alb/2.png']
@@ -0,0 +1,36 @@
+import importlib
+import types
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('tqdm')
+# the default models of `predict_all_models` are listed on import
+predict = importlib.import_module('zita.serve.predict')
+list_learners, predict.list_learners = predict.list_learners, lambda: []
+try:
+    evaluate = importlib.import_module('zita.serve.evaluate')
+finally:
+    predict.list_learners = list_learners
+
+
+def test_pred_matrix_of_saved_strings():
+    preds = pd.Series(['0 1 1', '[1, 0, 0]'])
+    assert evaluate.pred_matrix(preds).tolist() == [[0, 1, 1], [1, 0, 0]]
+    assert evaluate.pred_matrix(pd.Series([[0, 1]])).tolist() == [[0, 1]]
+
+
+def test_find_best_model_uses_the_label_matrix(tmp_path):
+    labels_csv = tmp_path / 'tags.csv'
+    labels_csv.write_text('a.jpg,cat||dog\nb.jpg,dog\nc.jpg,bird\n')
+    ds = types.SimpleNamespace(
+        photo_ids=[f'{evaluate.ALBUMS_ROOT}/a.jpg',
+                   f'{evaluate.ALBUMS_ROOT}/b.jpg'],
+        y=types.SimpleNamespace(classes=['dog', 'cat']))
+    results = {
+        'good': pd.DataFrame({'id': ['a.jpg', 'b.jpg', 'c.jpg'],
+                              'preds': ['1 1', '1 0', '0 0']}),
+        'bad': pd.DataFrame({'id': ['a.jpg', 'b.jpg'],
+                             'preds': [[1, 0], [0, 1]]}),
+    }
+    assert evaluate.find_best_model(results, ds, labels_csv) == 'good'
@@ -0,0 +1,93 @@
+from itertools import combinations
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from zita.data.hash_index import HashIndex, pack_sigs, popcount
+
+
+def make_sigs(n, nbits, seed=0):
+    """Random hashes, with near duplicates of earlier hashes planted
+    at 0 to 6 flipped bits"""
+    rng = np.random.RandomState(seed)
+    bits = [rng.rand(nbits) < 0.5 for _ in range(n // 2)]
+    while len(bits) < n:
+        flipped = bits[rng.randint(len(bits))].copy()
+        at = rng.choice(nbits, rng.randint(7), replace=False)
+        flipped[at] = ~flipped[at]
+        bits.append(flipped)
+    return [SimpleNamespace(hash=b) for b in bits]
+
+
+def brute_dist(a, b):
+    return int(np.count_nonzero(a.hash != b.hash))
+
+
+def brute_pairs(sigs, min_dist, max_dist):
+    return sorted(
+        (a, b, d) for a, b in combinations(range(len(sigs)), 2)
+        for d in [brute_dist(sigs[a], sigs[b])] if min_dist <= d <= max_dist)
+
+
+@pytest.mark.parametrize('nbits', [64, 100, 256])
+def test_popcount_matches_bit_count(nbits):
+    sigs = make_sigs(20, nbits)
+    codes = pack_sigs(sigs)
+    for a, b in combinations(range(len(sigs)), 2):
+        assert popcount(codes[a] ^ codes[b]) == brute_dist(sigs[a], sigs[b])
+
+
+@pytest.mark.parametrize('nbits,max_dist', [(64, 4), (100, 6), (256, 10)])
+def test_query_matches_brute_force(nbits, max_dist):
+    sigs = make_sigs(200, nbits)
+    index = HashIndex(max_dist=max_dist)
+    index.add(pack_sigs(sigs), keys=[f'k{i}' for i in range(len(sigs))])
+
+    for dist in [0, max_dist // 2, max_dist]:
+        for i in range(0, len(sigs), 7):
+            found = index.query(pack_sigs([sigs[i]])[0], max_dist=dist)
+            expected = sorted(
+                (brute_dist(sigs[i], x), f'k{j}')
+                for j, x in enumerate(sigs) if brute_dist(sigs[i], x) <= dist)
+            assert sorted((d, k) for k, d in found) == expected
+            # closest first
+            assert [d for _, d in found] == sorted(d for _, d in found)
+
+
+@pytest.mark.parametrize('nbits,max_dist', [(64, 4), (100, 6), (256, 10)])
+def test_pairs_match_brute_force(nbits, max_dist):
+    sigs = make_sigs(200, nbits, seed=1)
+    index = HashIndex(max_dist=max_dist)
+    index.add(pack_sigs(sigs))
+
+    for min_dist, dist in [(0, max_dist), (1, max_dist), (0, 0), (2, 3)]:
+        found = index.pairs(min_dist, dist)
+        assert sorted(map(tuple, found.tolist())) == \
+            brute_pairs(sigs, min_dist, dist)
+
+
+def test_adding_in_chunks_matches_one_add():
+    sigs = make_sigs(150, 64, seed=2)
+    codes = pack_sigs(sigs)
+    index = HashIndex(max_dist=4)
+    for start in range(0, len(codes), 40):
+        index.add(codes[start:start + 40])
+
+    assert len(index) == len(sigs)
+    assert sorted(map(tuple, index.pairs(0, 4).tolist())) == \
+        brute_pairs(sigs, 0, 4)
+    for i in [0, 60, 149]:
+        assert sorted(index.query(codes[i])) == sorted(
+            (j, brute_dist(sigs[i], x)) for j, x in enumerate(sigs)
+            if brute_dist(sigs[i], x) <= 4)
+
+
+def test_distances_beyond_the_index_are_rejected():
+    index = HashIndex(max_dist=2)
+    assert index.query(np.zeros(1, dtype=np.uint64)) == []
+    index.add(pack_sigs(make_sigs(4, 64)))
+    with pytest.raises(ValueError):
+        index.query(index.codes[0], max_dist=3)
+    with pytest.raises(ValueError):
+        index.pairs(0, 3)
@@ -0,0 +1,26 @@
+import os
+
+from zita.data.label_index import LabelIndex
+
+
+def write(path, text, mtime_ns):
+    path.write_text(text)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_rewrites_swap_in_complete_files(tmp_path):
+    path = tmp_path / 'tags.csv'
+    write(path, 'a.jpg,cat\nb.jpg,dog||cat\n', 10 ** 18)
+    index = LabelIndex(path, check_interval=0)
+    assert index.get('b.jpg') == ('cat', 'dog')
+
+    # truncated by a rewrite that is still in progress
+    write(path, 'a.jpg,cat\n', 10 ** 18 + 1)
+    assert index.get('b.jpg') == ('cat', 'dog')
+    # still the same on the next check, so it is complete
+    assert index.get('b.jpg') is None
+    assert index.get('a.jpg') == ('cat',)
+
+    write(path, 'a.jpg,bird\nb.jpg,dog\nc.jpg,cat\n', 10 ** 18 + 2)
+    assert len(index) == 3
+    assert index.get('a.jpg') == ('bird',)
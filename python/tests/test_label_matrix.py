@@ -0,0 +1,6 @@
+from zita.data.label_matrix import multi_hot
+
+
+def test_multi_hot_of_lists_and_single_indices():
+    assert multi_hot([[0, 2], 1, []], 3).tolist() == [
+        [1, 0, 1], [0, 1, 0], [0, 0, 0]]
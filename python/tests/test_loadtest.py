@@ -0,0 +1,19 @@
+import pytest
+
+import zita.utils.loadtest as loadtest
+
+
+def test_unique_never_repeats_photos(monkeypatch):
+    asked = []
+    monkeypatch.setattr(loadtest, 'post_query', lambda url, query, variables:
+                        asked.extend(variables['photoIds']))
+    photo_ids = [f'album ~ {i}.jpg' for i in range(12)]
+
+    stats = loadtest.run_load_test('http://zita', photo_ids, concurrency=4,
+                                   requests=6, batch_size=2, unique=True)
+    assert stats['errors'] == 0
+    assert sorted(asked) == sorted(photo_ids)
+
+    with pytest.raises(ValueError):
+        loadtest.run_load_test('http://zita', photo_ids, requests=7,
+                               batch_size=2, unique=True)
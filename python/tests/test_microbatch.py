@@ -0,0 +1,42 @@
+import pytest
+
+from zita.serve.microbatch import MicroBatcher
+
+
+def test_concurrent_items_run_as_one_batch():
+    batches = []
+
+    def run_batch(key, items):
+        batches.append((key, list(items)))
+        return [x * 2 for x in items]
+
+    batcher = MicroBatcher(run_batch, max_wait_ms=50, max_batch_size=3)
+    futures = [batcher.submit('m', x) for x in range(4)]
+    assert [f.result(5) for f in futures] == [0, 2, 4, 6]
+    # full batches run right away, the rest after max_wait
+    assert batches == [('m', [0, 1, 2]), ('m', [3])]
+
+
+def test_failed_batch_is_retried_one_by_one():
+    batches = []
+
+    def run_batch(key, items):
+        batches.append(list(items))
+        if 'missing.jpg' in items:
+            raise ValueError('No such photo')
+        return [x.upper() for x in items]
+
+    batcher = MicroBatcher(run_batch, max_wait_ms=50, max_batch_size=3)
+    futures = [batcher.submit('m', x)
+               for x in ('a.jpg', 'missing.jpg', 'b.jpg')]
+    assert futures[0].result(5) == 'A.JPG'
+    assert futures[2].result(5) == 'B.JPG'
+    with pytest.raises(ValueError):
+        futures[1].result(5)
+    assert batches == [['a.jpg', 'missing.jpg', 'b.jpg'], ['a.jpg'],
+                       ['missing.jpg'], ['b.jpg']]
+
+
+def test_no_wait_runs_in_the_caller():
+    batcher = MicroBatcher(lambda key, items: [len(items)], max_wait_ms=0)
+    assert batcher('m', 'a.jpg') == 1
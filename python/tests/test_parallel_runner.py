@@ -0,0 +1,11 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from zita.utils.parallel_runner import ParallelRunner
+
+
+def test_queue_depth_of_process_runners():
+    with ParallelRunner(pool=ProcessPoolExecutor(max_workers=1)) as runner:
+        assert runner.queue_depth() == 0
+    with ParallelRunner(max_workers=1) as runner:
+        assert runner.run(abs, [-1, 2]) == [1, 2]
+        assert runner.queue_depth() == 0
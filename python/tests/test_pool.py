@@ -0,0 +1,24 @@
+import types
+
+import torch
+
+from zita.serve.pool import learner_nbytes
+
+
+def test_learner_nbytes_counts_quantized_weights():
+    net = torch.nn.Sequential(torch.nn.Linear(256, 256))
+    qnet = torch.quantization.quantize_dynamic(net, {torch.nn.Linear},
+                                               dtype=torch.qint8)
+    size = learner_nbytes(types.SimpleNamespace(model=net))
+    qsize = learner_nbytes(types.SimpleNamespace(model=qnet))
+    assert size > 256 * 256 * 4
+    # int8 weights are a quarter of the float32 ones
+    assert 256 * 256 < qsize < size / 2
+    assert learner_nbytes(types.SimpleNamespace()) == 0
+
+
+def test_learner_nbytes_counts_tied_weights_once():
+    net = torch.nn.Sequential(torch.nn.Linear(8, 8, bias=False),
+                              torch.nn.Linear(8, 8, bias=False))
+    net[1].weight = net[0].weight
+    assert learner_nbytes(types.SimpleNamespace(model=net)) == 8 * 8 * 4
@@ -0,0 +1,31 @@
+import importlib
+
+from contextlib import contextmanager
+
+# `zita.serve.predict` is also the name of a function in zita.serve
+predict = importlib.import_module('zita.serve.predict')
+
+
+class FakeBackend(object):
+    batch_size = 7
+
+
+class FakePool(object):
+
+    @contextmanager
+    def checkout(self, model):
+        yield FakeBackend()
+
+
+def test_native_batch_predict_uses_backend_batch_size(monkeypatch):
+    calls = []
+
+    def predict_photos(learn, model, photo_ids, bs=None, runner=None):
+        calls.append(bs)
+        return [{'id': x} for x in photo_ids]
+
+    monkeypatch.setattr(predict, 'learner_pool', FakePool())
+    monkeypatch.setattr(predict, 'predict_photos', predict_photos)
+    results = predict.native_batch_predict.nocache('m', ['a.jpg', 'b.jpg'])
+    assert results == [{'id': 'a.jpg'}, {'id': 'b.jpg'}]
+    assert calls == [7]
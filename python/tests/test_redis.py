@@ -0,0 +1,105 @@
+import threading
+import orjson
+
+from zita.serve.redis import RedisStore
+
+
+class FakePubSub(object):
+
+    def subscribe(self, channel):
+        pass
+
+    def listen(self):
+        threading.Event().wait()
+        return iter(())
+
+
+class FakePipeline(object):
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __getattr__(self, name):
+        def command(*args):
+            self.commands.append((name, args))
+        return command
+
+    def execute(self):
+        return [getattr(self.client, name)(*args)
+                for name, args in self.commands]
+
+
+class FakeRedis(object):
+    """The few commands RedisStore needs, values are bytes like Redis
+    returns them"""
+
+    def __init__(self):
+        self.data = {}
+        self.published = []
+
+    def register_script(self, script):
+        return lambda keys=(), args=(): 0
+
+    def pubsub(self, **kwargs):
+        return FakePubSub()
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def mget(self, *keys):
+        return [self.data.get(k) for k in keys]
+
+    def mset(self, mapping):
+        self.data.update(mapping)
+
+    def expire(self, key, seconds):
+        pass
+
+    def hsetnx(self, key, field, value):
+        self.data.setdefault(key, {}).setdefault(field, value)
+
+    def hmget(self, key, fields):
+        return [self.data.get(key, {}).get(x) for x in fields]
+
+    def delete(self, *keys):
+        return sum(self.data.pop(k, None) is not None for k in keys)
+
+    def publish(self, channel, message):
+        self.published.append((channel, message))
+
+    def sadd(self, key, *members):
+        self.data.setdefault(key, set()).update(
+            x.encode() if isinstance(x, str) else x for x in members)
+
+    def spop(self, key, count):
+        members = self.data.get(key, set())
+        return [members.pop() for _ in range(min(count, len(members)))]
+
+    def srem(self, key, *members):
+        self.sadd(key)
+        self.data[key].difference_update(x.encode() for x in members)
+
+
+def test_drop_namespace_with_local_cache():
+    client = FakeRedis()
+    store = RedisStore(client, allow_async=False, local_size=100)
+    keys = ['zita.pred:m@1["m","a.jpg"]', 'zita.pred:m@1["m","b.jpg"]']
+    for key in keys:
+        client.data[key] = b'value'
+    store.local.set_many([(key, b'value') for key in keys])
+    with client.pipeline() as pipe:
+        store.add_to_index(pipe, 'zita.pred', 'm@1', keys)
+        pipe.execute()
+
+    assert store.drop_namespace('zita.pred', 'm@1', batch_size=1) == 2
+    assert store.local.get_many(keys) == [None, None]
+    assert not any(key in client.data for key in keys)
+    published = [orjson.loads(x)['keys'] for _, x in client.published]
+    assert sorted(sum(published, [])) == sorted(keys)
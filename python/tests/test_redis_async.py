@@ -0,0 +1,71 @@
+import asyncio
+
+from test_redis import FakeRedis
+
+from zita.serve.codec import PredictionCodec
+from zita.serve.redis import RedisStore
+from zita.serve.redis_async import AsyncRedisStore, ThreadedClient
+
+
+class NoIO(object):
+    """A client that must not be used"""
+
+    def __getattr__(self, name):
+        raise AssertionError(f'blocking Redis call: {name}')
+
+
+class CountingClient(ThreadedClient):
+
+    def __init__(self, client):
+        super().__init__(client, 2)
+        self.mgets = []
+
+    async def mget(self, *keys):
+        self.mgets.append(keys)
+        return await super().mget(*keys)
+
+
+def make_store(client):
+    astore = AsyncRedisStore(RedisStore(client, allow_async=False,
+                                        local_size=0))
+    astore.client = CountingClient(client)
+    return astore
+
+
+def test_concurrent_reads_share_one_mget():
+    client = FakeRedis()
+    client.data.update({'a': b'1', 'b': b'2'})
+    astore = make_store(client)
+
+    async def main():
+        return await asyncio.gather(
+            astore.mget(['a', 'b']), astore.mget(['b', 'c']),
+            astore.get('a'))
+
+    assert asyncio.run(main()) == [[b'1', b'2'], [b'2', None], 1]
+    assert [sorted(x) for x in astore.client.mgets] == [['a', 'b', 'c']]
+
+
+def test_codec_schemas_do_not_block_the_loop():
+    client = FakeRedis()
+    astore = make_store(client)
+    # the synchronous client of the codec must never be used
+    codec = PredictionCodec(NoIO(), 'schemas')
+    calls = []
+
+    @astore.cache(key='pred', codec=codec)
+    async def predict(photo_id):
+        calls.append(photo_id)
+        return {'id': photo_id, 'model': 'm', 'classes': ['cat', 'dog'],
+                'tags': ['dog'], 'preds': [0, 1], 'probs': [0.25, 0.75]}
+
+    async def main():
+        first = await predict('a.jpg')
+        # a restarted process does not know the schema yet
+        codec.schemas.clear()
+        return first, await predict('a.jpg')
+
+    first, second = asyncio.run(main())
+    assert first == second
+    assert calls == ['a.jpg']
+    assert len(client.data['schemas']) == 1
@@ -0,0 +1,78 @@
+import threading
+
+from zita.serve.refill import RefillQueue
+
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.data = {}
+
+    def mget(self, *keys):
+        return [self.data.get(k) for k in keys]
+
+
+class FakeStore(object):
+    """Leases held by other processes are in `leases`"""
+
+    def __init__(self):
+        self.client = FakeClient()
+        self.leases = {}
+
+    def acquire_leases(self, keys, ttl_ms):
+        acquired = [k for k in keys if k not in self.leases]
+        self.leases.update((k, 'us') for k in acquired)
+        return acquired
+
+    def release_leases(self, keys):
+        for key in keys:
+            if self.leases.get(key) == 'us':
+                del self.leases[key]
+
+
+def test_failed_batch_does_not_stop_the_refill():
+    queue = RefillQueue(FakeStore())
+    keys = ['a', 'b', 'c', 'd']
+    fetched = []
+
+    def fetch(idxs):
+        if 0 in idxs:
+            raise ValueError('No such photo')
+        fetched.extend(idxs)
+
+    handle = queue.submit(keys, [0, 1, 2, 3], fetch, mini_batch_size=2)
+    assert handle.wait(5)
+    assert fetched == [2, 3]
+    assert queue.pending() == 0
+    assert queue.store.leases == {}
+
+
+def test_refill_skips_cached_and_leased_keys():
+    store = FakeStore()
+    store.client.data['a'] = b'cached'
+    store.leases['b'] = 'other process'
+    queue = RefillQueue(store)
+    fetched = []
+
+    handle = queue.submit(['a', 'b', 'c'], [0, 1, 2], fetched.extend)
+    assert handle.wait(5)
+    assert fetched == [2]
+    # our lease is released, the other process's is kept
+    assert store.leases == {'b': 'other process'}
+
+
+def test_keys_in_flight_are_not_queued_again():
+    queue = RefillQueue(FakeStore())
+    started, release = threading.Event(), threading.Event()
+
+    def fetch(idxs):
+        started.set()
+        release.wait(5)
+
+    first = queue.submit(['a', 'b'], [0, 1], fetch)
+    assert started.wait(5)
+    second = queue.submit(['b', 'c'], [0, 1], lambda idxs: None)
+    assert first.keys == ['a', 'b'] and second.keys == ['c']
+    release.set()
+    assert first.wait(5) and second.wait(5)
+    assert queue.pending() == 0
@@ -0,0 +1,32 @@
+import os
+
+import zita.serve.registry as registry_module
+
+from zita.serve.pool import LearnerPool
+from zita.serve.registry import ModelRegistry
+
+
+def test_lazily_loaded_model_keeps_its_version(tmp_path, monkeypatch):
+    monkeypatch.setattr(registry_module, 'model_path',
+                        lambda model, root: root / f'{model}.pkl')
+    monkeypatch.setattr(registry_module, 'warmup', lambda learn: None)
+    path = tmp_path / 'm.pkl'
+    path.write_bytes(b'v1')
+
+    pool = LearnerPool(lambda model: path.read_bytes())
+    registry = ModelRegistry(pool, lambda model: path.read_bytes(),
+                             root=tmp_path, poll_sec=0)
+    # loaded on demand by the pool, not by the registry
+    assert pool.get('m') == b'v1'
+    loaded = registry.version('m')
+
+    path.write_bytes(b'v2')
+    os.utime(path, ns=(1, 1))
+    # the old copy still serves, so its predictions keep its version
+    assert registry.version('m') == loaded
+    assert registry.changed_models() == []
+    assert registry.changed_models() == ['m']
+
+    registry.load_model('m')
+    assert pool.get('m') == b'v2'
+    assert registry.version('m') not in (None, loaded)
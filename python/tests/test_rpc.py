@@ -0,0 +1,97 @@
+import time
+
+from zita import rpc
+
+
+class FakeSocket(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def send_multipart(self, frames):
+        self.sent.append(list(frames))
+
+
+def make_broker(timeout=60):
+    broker = rpc.Broker('inproc://test.clients', 'inproc://test.workers',
+                        timeout=timeout)
+    broker.frontend.close()
+    broker.backend.close()
+    broker.frontend, broker.backend = FakeSocket(), FakeSocket()
+    return broker
+
+
+def test_broker_routes_replies_to_the_waiting_client():
+    broker = make_broker()
+    broker.on_worker_message([b'w1', rpc.READY])
+    broker.on_client_message([b'c1', b'', b'{"photoId": "a.jpg"}'])
+    assert broker.backend.sent == [
+        [b'w1', rpc.REQUEST, b'c1', b'', b'{"photoId": "a.jpg"}']]
+    assert not broker.idle
+
+    broker.on_worker_message([b'w1', rpc.REPLY, b'c1', b'', b'{}'])
+    broker.on_worker_message([b'w1', rpc.READY])
+    assert broker.frontend.sent == [[b'c1', b'', b'{}']]
+    assert list(broker.idle) == [b'w1']
+    assert broker.workers[b'w1'].served == 1
+
+
+def test_broker_drops_replies_after_a_timeout():
+    broker = make_broker(timeout=0)
+    broker.on_worker_message([b'w1', rpc.READY])
+    broker.on_client_message([b'c1', b'', b'{"photoId": "a.jpg"}'])
+    broker.check_workers()
+    assert broker.frontend.sent == [
+        [b'c1', b'', rpc.error_reply('Prediction timed out.')]]
+    assert not broker.workers
+
+    # the stuck worker finishes after all
+    broker.on_worker_message([b'w1', rpc.REPLY, b'c1', b'', b'{}'])
+    assert len(broker.frontend.sent) == 1
+    assert not broker.idle
+    broker.on_worker_message([b'w1', rpc.READY])
+    assert list(broker.idle) == [b'w1']
+
+
+def test_broker_drops_replies_to_another_client():
+    broker = make_broker()
+    broker.on_worker_message([b'w1', rpc.READY])
+    broker.on_client_message([b'c2', b'', b'{"photoId": "a.jpg"}'])
+    broker.on_worker_message([b'w1', rpc.REPLY, b'c1', b'', b'{}'])
+    assert broker.frontend.sent == []
+
+
+def test_idle_worker_rejoins_after_missed_heartbeats():
+    broker = make_broker()
+    broker.on_worker_message([b'w1', rpc.READY])
+    broker.workers[b'w1'].last_seen = time.time() - 60
+    broker.check_workers()
+    assert not broker.workers and not broker.idle
+
+    broker.on_worker_message([b'w1', rpc.HEARTBEAT])
+    assert list(broker.idle) == [b'w1']
+
+
+def test_broker_merges_metrics_of_all_workers():
+    broker = make_broker()
+    broker.on_worker_message([b'w1', rpc.READY])
+    broker.on_worker_message([b'w2', rpc.READY])
+    broker.check_workers()
+    assert [x[1] for x in broker.backend.sent] == [rpc.METRICS, rpc.METRICS]
+    for identity, count in [(b'w1', 3), (b'w2', 5)]:
+        families = [('zita_predicted_images', 'Images', 'counter',
+                     [('_total', {'model': 'm'}, count)])]
+        broker.on_worker_message([identity, rpc.METRICS,
+                                  rpc.orjson.dumps(families)])
+
+    broker.on_client_message([b'c1', b'', b'{"metrics": true}'])
+    (client, _, text), = broker.frontend.sent
+    assert client == b'c1'
+    assert text.decode().splitlines() == [
+        '# HELP zita_predicted_images Images',
+        '# TYPE zita_predicted_images counter',
+        'zita_predicted_images_total{worker="w1",model="m"} 3',
+        'zita_predicted_images_total{worker="w2",model="m"} 5',
+    ]
+    # metrics queries are not sent to workers
+    assert list(broker.idle) == [b'w1', b'w2']
@@ -0,0 +1,25 @@
+import asyncio
+
+import pytest
+
+ariadne = pytest.importorskip('ariadne')
+
+from zita.serve import resolver  # noqa: E402
+from zita.serve.schema import schema, Context  # noqa: E402
+
+
+def test_truth_is_resolved_through_the_schema(monkeypatch):
+
+    async def apredict(model, photo_id):
+        return {'id': photo_id, 'model': model, 'tags': ['dog']}
+
+    monkeypatch.setattr(resolver, 'apredict', apredict)
+    monkeypatch.setattr(resolver, 'get_true_labels',
+                        lambda photo_id: ['cat', 'dog'])
+    query = '{ prediction(photoId: "a.jpg") { id tags truth } }'
+
+    ok, result = asyncio.run(ariadne.graphql(
+        schema, {'query': query}, context_value=Context(model='m')))
+    assert ok, result
+    assert result['data']['prediction'] == {
+        'id': 'a.jpg', 'tags': ['dog'], 'truth': ['cat', 'dog']}
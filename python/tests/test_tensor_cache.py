@@ -0,0 +1,29 @@
+import torch
+
+from zita.data.tensor_cache import TensorCache
+
+
+def test_get_many_copies_out_of_evicted_slots(tmp_path, monkeypatch):
+    a, b = tmp_path / 'a.jpg', tmp_path / 'b.jpg'
+    a.write_bytes(b'a')
+    b.write_bytes(b'b')
+    # room for a single tensor
+    cache = TensorCache(tmp_path / 'cache', 2, max_bytes=3 * 2 * 2 * 4)
+    cache.put(a, torch.zeros(3, 2, 2))
+
+    x, = cache.get_many([a])
+    cache.put(b, torch.ones(3, 2, 2))
+    assert x.sum() == 0
+    assert cache.get(a) is None
+
+    # slot reused while it is copied
+    cache.put(a, torch.zeros(3, 2, 2))
+    slot = cache._slot
+
+    def evict(i):
+        monkeypatch.setattr(cache, '_slot', slot)
+        cache.put(b, torch.ones(3, 2, 2))
+        return slot(i)
+
+    monkeypatch.setattr(cache, '_slot', evict)
+    assert cache.get_many([a]) == [None]
@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+import zita.serve.warm as warm
+
+
+def fake_predict(cache, calls):
+
+    def native_batch_predict(model, photo_ids, cache_only=False,
+                             cache_first=True, **kwargs):
+        if cache_only:
+            return [cache.get(x) for x in photo_ids]
+        calls.append(len(photo_ids))
+        if 'bad.jpg' in photo_ids:
+            raise OSError('cannot identify image file')
+        cache.update((x, {'id': x}) for x in photo_ids)
+        return [cache[x] for x in photo_ids]
+
+    return native_batch_predict
+
+
+def test_warm_cache_skips_undecodable_photos(tmp_path, monkeypatch):
+    cache, calls = {}, []
+    monkeypatch.setattr(warm, 'native_batch_predict',
+                        fake_predict(cache, calls))
+    monkeypatch.setattr(warm, 'model_digest', lambda model: 'v1')
+    monkeypatch.setattr(warm, 'existing', lambda photo_ids: photo_ids)
+    good = [f'{i}.jpg' for i in range(7)]
+    photo_ids = good[:3] + ['bad.jpg'] + good[3:]
+    checkpoint = tmp_path / 'warm.json'
+
+    stats = warm.warm_cache('m', photo_ids, batch_size=8, workers=1,
+                            checkpoint=str(checkpoint))
+    assert (stats['predicted'], stats['failed']) == (7, 1)
+    assert sorted(cache) == sorted(good)
+    # the batch is split in halves, not predicted one photo at a time
+    assert calls == [8, 4, 2, 2, 1, 1, 4]
+    assert json.loads(checkpoint.read_text())['offset'] == 8
+
+
+def test_warm_cache_fails_on_unknown_model(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(warm, 'native_batch_predict',
+                        fake_predict({}, calls))
+    monkeypatch.setattr(warm, 'model_digest', lambda model: None)
+    checkpoint = tmp_path / 'warm.json'
+
+    with pytest.raises(ValueError):
+        warm.warm_cache('typo', ['a.jpg'], workers=1,
+                        checkpoint=str(checkpoint))
+    assert calls == []
+    assert not checkpoint.exists()
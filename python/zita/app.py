@@ -2,9 +2,19 @@ import uvicorn
 
 from starlette.applications import Starlette
 from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import PlainTextResponse
 
 from zita.serve.schema import asgi_app
+from zita.serve.predict import registry
+from zita.serve.redis_async import astore
 from zita.settings import CORS, HOST, PORT, DEBUG
+from zita.utils.metrics import REGISTRY
+
+
+async def metrics(request):
+    """Metrics of this process in Prometheus text format"""
+    return PlainTextResponse(REGISTRY.render(),
+                             media_type="text/plain; version=0.0.4")
 
 
 def create_app():
@@ -15,7 +25,12 @@ def create_app():
             allow_origins=[CORS],
             allow_headers=["X-Requested-With", "Content-Type"],
         )
-    # Expose only a GraphQL API
+    # Load and warm up models before taking requests
+    app.add_event_handler("startup", registry.start)
+    app.add_event_handler("startup", astore.connect)
+    app.add_event_handler("shutdown", astore.close)
+    app.add_route("/metrics", metrics)
+    # Everything else is the GraphQL API
     app.mount("/", asgi_app)
     return app
 
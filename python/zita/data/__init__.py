@@ -1,57 +1,70 @@
 """
 Utilities to load dataset
+
+fastai is only imported by the functions that need it, so serving
+with a non-fastai backend does not pay for importing it.
 """
 import logging
+import os
 import pandas as pd
 
 from functools import lru_cache
-from fastai.vision import ImageList, ImageDataBunch, get_transforms
-from fastai.vision.image import open_image
 
+from zita.data.decode import photo_path, load_tensor
 from zita.data.dedup import dedup_df, DEFAULT_DUP_RANGE
+from zita.data.label_index import LabelIndex
+from zita.data.label_matrix import get_label_matrix
 from zita.settings import ALBUMS_ROOT, LABELS_CSV, ALBUM_DELIM
 
 logger = logging.getLogger('zita.data')
+# truth labels for serving, loaded on first use without dedup
+label_index = LabelIndex(LABELS_CSV)
 
 
-@lru_cache(maxsize=3)
 def get_labels(pth=str(LABELS_CSV), asdict=False, replace_album_delim=True,
                dup_range=DEFAULT_DUP_RANGE, path=ALBUMS_ROOT):
     """Get truth labels for all photos
+
+    Cached until the CSV changes, the next call after that only
+    dedups the rows added to it.
     """
+    stat = os.stat(pth)
+    return _get_labels(str(pth), (stat.st_size, stat.st_mtime_ns), asdict,
+                       replace_album_delim, dup_range, path)
+
+
+@lru_cache(maxsize=3)
+def _get_labels(pth, version, asdict, replace_album_delim, dup_range, path):
     logger.info("Reading labels CSV from %s", pth)
-    df = pd.read_csv(pth, names=["name", "label"])
-    # Remove empty tags
-    df = df[~df["label"].isna() & ~(df["label"] == "")]
+    # photos without tags are not in the matrix, tags are sorted
+    matrix = get_label_matrix(pth)
+    df = pd.DataFrame({"name": matrix.photo_ids,
+                       "label": matrix.label_strings()})
     if replace_album_delim:
-        df["name"] = df["name"].str.replace(ALBUM_DELIM, "/")
-    # Order the tags alpahbetically
-    df["label"] = (
-        df["label"]
-        .str.replace(r"\|\|", ",")
-        .astype("str")
-        .apply(lambda x: ",".join(sorted(x.split(","))))
-    )
+        df["name"] = df["name"].str.replace(ALBUM_DELIM, "/", regex=False)
     if dup_range:
-        df = dedup_df(df, path, dup_range)
+        # only new rows are compared when the CSV grows
+        df = dedup_df(df, path, dup_range, incremental=True)
     if asdict:
         return dict(zip(df["name"], df["label"]))
     return df
 
 
 def get_true_labels(photo_id):
-    all_labels = get_labels(asdict=True, replace_album_delim=False)
-    return all_labels.get(photo_id)
-
-
-def get_image(photo_id):
-    if ALBUM_DELIM in photo_id:
-        [album, photo] = photo_id.split(ALBUM_DELIM)
-        filepath = ALBUMS_ROOT/album/photo
-    else:
-        filepath = ALBUMS_ROOT/photo_id
-    if not filepath.exists():
-        raise ValueError(f"No such file: {filepath}")
+    """Sorted tags of a photo in the labels CSV, None if unlabelled"""
+    tags = label_index.get(photo_id)
+    return list(tags) if tags is not None else None
+
+
+def get_image(photo_id, size=None):
+    """Open a photo as a fastai Image. If `size` is given, decode
+    it directly to (about) that size, which is much faster for
+    large JPEGs."""
+    from fastai.vision.image import open_image, Image
+
+    filepath = photo_path(photo_id)
+    if size is not None:
+        return Image(load_tensor(filepath, size))
     return open_image(filepath)
 
 
@@ -67,6 +80,8 @@ def src_from_df(df, path=ALBUMS_ROOT, seed=42, valid_pct=0.2,
         dedup_thresh : [int, int]
             the min/max thresholds used for detecting duplicate photos.
     """
+    from fastai.vision import ImageList
+
     logger.info('Creating ImageList of %d items' % df.shape[0])
     itemlist = ImageList.from_df(df, path)
     if valid_pct:
@@ -85,6 +100,8 @@ def src_from_csv(path=ALBUMS_ROOT, labels_csv=LABELS_CSV,
 
 
 def src_from_photo_ids(photo_ids, path=ALBUMS_ROOT):
+    from fastai.vision import ImageList
+
     df = pd.DataFrame({
         "name": [x.replace(ALBUM_DELIM, '/') for x in photo_ids],
     })
@@ -103,6 +120,8 @@ def load_dataset(path=ALBUMS_ROOT, labels_csv=LABELS_CSV, normalize=False,
         bs : int
             batch size for DataBunch, don't create a DataBunch if bs is None
     """
+    from fastai.vision import get_transforms
+
     src = src_from_csv(path, labels_csv, **kwargs)
     if tfms and isinstance(tfms, dict):
         tfms = get_transforms(tfms)
@@ -117,6 +136,8 @@ def load_dataset(path=ALBUMS_ROOT, labels_csv=LABELS_CSV, normalize=False,
 
 
 def image_bunch(df, path=ALBUMS_ROOT, **kwargs):
+    from fastai.vision import ImageDataBunch
+
     args = dict(
         seed=101,
         label_delim=',',
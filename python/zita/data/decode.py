@@ -0,0 +1,88 @@
+"""
+Fast image decoding
+
+Most album photos are multi-megapixel JPEGs, but models only look at a
+few hundred pixels. Use reduced-size JPEG decoding (DCT scaling) to get
+close to the target size, then resize the rest of the way.
+"""
+import numpy as np
+import torch
+
+from PIL import Image
+
+from zita.settings import ALBUMS_ROOT, ALBUM_DELIM
+
+# fast enough and good enough once the image is already close to
+# the target size
+DEFAULT_RESAMPLE = Image.BILINEAR
+IMAGE_EXTS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'}
+
+
+def photo_path(photo_id, root=ALBUMS_ROOT):
+    """Find the file of a photo ID ("album ~ photo.jpg" or album/photo.jpg)"""
+    if ALBUM_DELIM in photo_id:
+        [album, photo] = photo_id.split(ALBUM_DELIM)
+        filepath = root/album/photo
+    else:
+        filepath = root/photo_id
+    if not filepath.exists():
+        raise ValueError(f"No such file: {filepath}")
+    return filepath
+
+
+def list_photo_ids(albums=None, root=ALBUMS_ROOT):
+    """List photo IDs ("album ~ photo.jpg") of all images in some
+    or all albums"""
+    if not albums:
+        albums = sorted(x.name for x in root.iterdir() if x.is_dir())
+    photo_ids = []
+    for album in albums:
+        for p in sorted((root/album).iterdir()):
+            if p.suffix.lower() in IMAGE_EXTS:
+                photo_ids.append(f'{album}{ALBUM_DELIM}{p.name}')
+    return photo_ids
+
+
+def open_draft(path, size, mode='RGB'):
+    """Open an image, decoding JPEGs at the smallest scale (1/2, 1/4 or 1/8)
+    that is still at least `size` (width, height).
+    """
+    img = Image.open(path)
+    # no-op for formats other than JPEG
+    img.draft(mode, size)
+    if img.mode != mode:
+        img = img.convert(mode)
+    return img
+
+
+def resize_crop(img, size, resample=DEFAULT_RESAMPLE):
+    """Resize so the image covers `size` (height, width), then crop the
+    center. Same as fastai's default (crop) resize for validation sets.
+    """
+    h, w = size
+    scale = max(h / img.height, w / img.width)
+    new_w = max(w, round(img.width * scale))
+    new_h = max(h, round(img.height * scale))
+    if (new_w, new_h) != img.size:
+        img = img.resize((new_w, new_h), resample)
+    left, top = (new_w - w) // 2, (new_h - h) // 2
+    if (new_w, new_h) != (w, h):
+        img = img.crop((left, top, left + w, top + h))
+    return img
+
+
+def to_tensor(img):
+    """PIL image to a float [C, H, W] tensor with values in [0, 1]"""
+    x = torch.from_numpy(np.array(img, dtype=np.uint8))
+    if x.ndim == 2:
+        x = x.unsqueeze(-1)
+    return x.permute(2, 0, 1).float().div_(255)
+
+
+def load_tensor(path, size, resample=DEFAULT_RESAMPLE):
+    """Decode an image to a [3, H, W] tensor of `size` (height, width)"""
+    if isinstance(size, int):
+        size = (size, size)
+    h, w = size
+    img = open_draft(path, (w, h))
+    return to_tensor(resize_crop(img, size, resample=resample))
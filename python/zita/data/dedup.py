@@ -3,36 +3,120 @@ Remove duplicate images
 """
 import os
 import logging
+import threading
 import numpy as np
 import time
 
-from imagehash import dhash, Image
+from concurrent.futures import ProcessPoolExecutor
+from imagehash import dhash
 from itertools import combinations
 from collections import defaultdict
-from functools import reduce
-from matplotlib import pyplot as plt
+from functools import partial, reduce
 
+from zita.data.decode import open_draft
+from zita.data.hash_index import HashIndex, pack_sigs, popcount
+from zita.data.sig_store import get_sig_store, hash_kind
+from zita.data.tensor_cache import file_key
 from zita.utils.parallel_runner import ParallelRunner
-from zita.settings import ALBUMS_ROOT
+from zita.settings import ALBUMS_ROOT, HASH_WORKER_MODE
 
 logger = logging.getLogger('zita.data')
 
 DEFAULT_DUP_RANGE = (0, 4)
+# number of signatures compared with each other at once, a block of
+# distances takes block_size^2 * 2 bytes
+DIST_BLOCK_SIZE = 2048
+# Perceptual hashes only look at a handful of pixels, so decode JPEGs
+# at the smallest scale that is still at least this big
+HASH_DRAFT_SIZE = (64, 64)
+# number of images each worker hashes per task, so that worker
+# processes do not send results back one image at a time
+HASH_CHUNK_SIZE = 64
 
 
 def compare_hash(x, y):
     return np.count_nonzero(y.hash != x.hash)
 
 
-def sigs2dists(sigs, comp=compare_hash):
-    """Image signatures to distances. Run in parallel mode
-    when pool is not None. Normally you don't need this."""
-    dists = [(a, b, comp(sigs[a], sigs[b]))
-             for a, b in combinations(range(len(sigs)), 2)]
-    dists = np.array(dists)
+def hamming(a, b):
+    """Hamming distances between all rows of packed signatures `a`
+    and `b`, as an [len(a), len(b)] array"""
+    dists = np.zeros((len(a), len(b)), dtype=np.uint16)
+    # one word at a time, to keep the temporary arrays small
+    for i in range(a.shape[1]):
+        dists += popcount(a[:, None, i:i + 1] ^ b[None, :, i:i + 1])
     return dists
 
 
+def iter_close_pairs(packed, min_thresh=0, max_thresh=4,
+                     block_size=DIST_BLOCK_SIZE):
+    """Yield [k, 3] arrays of (a, b, distance) with a < b, for all pairs
+    of packed signatures within the thresholds, one block at a time"""
+    n = len(packed)
+    for start in range(0, n, block_size):
+        a = packed[start:start + block_size]
+        # only compare with this block and the blocks after it
+        for other in range(start, n, block_size):
+            d = hamming(a, packed[other:other + block_size])
+            mask = (d >= min_thresh) & (d <= max_thresh)
+            if other == start:
+                mask &= np.triu(np.ones_like(mask), k=1)
+            ii, jj = np.nonzero(mask)
+            if len(ii):
+                yield np.stack([ii + start, jj + other,
+                                d[ii, jj].astype(np.int64)], axis=1)
+
+
+def sigs2dists(sigs, comp=compare_hash, dup_range=DEFAULT_DUP_RANGE,
+               block_size=DIST_BLOCK_SIZE):
+    """Image signatures to (a, b, distance) rows for all pairs of
+    images within `dup_range` (None for all pairs).
+
+    Hamming distances of image hashes are computed on packed bits in
+    blocks, so memory stays proportional to the pairs returned. Any
+    other `comp` function is called for each pair.
+    """
+    min_thresh, max_thresh = dup_range or (0, np.inf)
+    if comp is not compare_hash:
+        dists = [(a, b, d) for a, b in combinations(range(len(sigs)), 2)
+                 for d in [comp(sigs[a], sigs[b])]
+                 if min_thresh <= d <= max_thresh]
+        return np.array(dists, dtype=np.int64).reshape(-1, 3)
+    blocks = list(iter_close_pairs(pack_sigs(sigs), min_thresh, max_thresh,
+                                   block_size=block_size))
+    if not blocks:
+        return np.zeros((0, 3), dtype=np.int64)
+    return np.concatenate(blocks)
+
+
+def close_pairs(sigs, dup_range=DEFAULT_DUP_RANGE):
+    """(a, b, distance) rows of all pairs of image hashes within
+    `dup_range`, found with a `HashIndex` instead of comparing all
+    pairs"""
+    min_thresh, max_thresh = dup_range
+    index = build_index(sigs, max_dist=max_thresh)
+    return index.pairs(min_thresh, max_thresh)
+
+
+def build_index(sigs, keys=None, max_dist=DEFAULT_DUP_RANGE[1]):
+    """HashIndex of image hashes, to look up near duplicates of new
+    images with `find_duplicates`"""
+    index = HashIndex(max_dist=max_dist)
+    if len(sigs):
+        index.add(pack_sigs(sigs), keys=keys)
+    return index
+
+
+def find_duplicates(index, img, hashfunc=dhash, max_dist=None):
+    """Near duplicates of an image (a path, PIL image or image hash)
+    in a HashIndex, as a list of (key, distance), closest first"""
+    if not hasattr(img, 'hash'):
+        if not hasattr(img, 'convert'):
+            img = open_draft(img, HASH_DRAFT_SIZE, mode='L')
+        img = hashfunc(img)
+    return index.query(pack_sigs([img])[0], max_dist=max_dist)
+
+
 def dists2dups(dists, min_thresh=0, max_thresh=4):
     """Distances to duplicate list"""
     d = dists[:, 2]
@@ -52,6 +136,8 @@ def dists2dups(dists, min_thresh=0, max_thresh=4):
 
 
 def plot_dups(data, dedup, limit=5):
+    from matplotlib import pyplot as plt
+
     for i, (k, vals) in enumerate(dedup.items()):
         if i >= limit:
             break
@@ -61,17 +147,64 @@ def plot_dups(data, dedup, limit=5):
             data.train_ds.x[p].show(ax=axes[j + 1])
 
 
-def get_image_sigs(imgs, path=ALBUMS_ROOT, hashfunc=dhash, max_workers=None):
-    """Get image signatures"""
+def hash_files(paths, hashfunc=dhash):
+    """(file key, signature) of image files. The file key is taken
+    first, so a file changed while hashing is hashed again next time"""
+    return [(file_key(p), hashfunc(open_draft(p, HASH_DRAFT_SIZE, mode='L')))
+            for p in paths]
+
+
+def get_image_sigs(imgs, path=ALBUMS_ROOT, hashfunc=dhash, max_workers=None,
+                   store=None, worker_mode=HASH_WORKER_MODE,
+                   chunk_size=HASH_CHUNK_SIZE):
+    """Get image signatures
+
+    Signatures are read from the signature store (`ZT_SIG_STORE`, or
+    a `SignatureStore` passed as `store`) when the files did not change
+    since they were hashed, only the other images are hashed. Pass
+    `store=False` to hash all images.
+
+    Decoding is CPU bound, so images are hashed in worker processes by
+    default (`worker_mode="process"`, `hashfunc` must be picklable),
+    `chunk_size` images at a time. Results are stored as each chunk
+    is done.
+    """
     t = time.time()
+    paths = [path/x for x in imgs]
+    if store is None:
+        store = get_sig_store()
+    elif store is False:
+        store = None
+    kind = hash_kind(hashfunc, HASH_DRAFT_SIZE)
+    if store is not None:
+        sigs = store.get_many(paths, kind)
+    else:
+        sigs = [None] * len(paths)
+    missing = [i for i, x in enumerate(sigs) if x is None]
+    if not missing:
+        return sigs
 
-    prunner = ParallelRunner(max_workers=max_workers or os.cpu_count())
-    logger.info('Computing image signatures in %d threads...',
-                prunner._executor._max_workers)
+    max_workers = max_workers or os.cpu_count()
+    if worker_mode == 'process':
+        max_workers = min(max_workers, -(-len(missing) // chunk_size))
+        prunner = ParallelRunner(ProcessPoolExecutor(max_workers=max_workers))
+    else:
+        prunner = ParallelRunner(max_workers=max_workers)
+    logger.info('Computing %d of %d image signatures in %d %ss...',
+                len(missing), len(paths), max_workers, worker_mode)
 
-    # image loading is an I/O bound task, so it helps (a lot) to
-    # run hashing in parallel
-    sigs = prunner.run(lambda x: hashfunc(Image.open(path/x)), imgs)
+    chunks = [missing[i:i + chunk_size]
+              for i in range(0, len(missing), chunk_size)]
+    with prunner:
+        # results come back in order, as soon as each chunk is done
+        results = prunner.map(partial(hash_files, hashfunc=hashfunc),
+                              [[paths[i] for i in chunk] for chunk in chunks])
+        for chunk, computed in zip(chunks, results):
+            for i, (_, sig) in zip(chunk, computed):
+                sigs[i] = sig
+            if store is not None:
+                store.put_many([(paths[i], key, sig) for i, (key, sig)
+                                in zip(chunk, computed)], kind)
 
     delta = time.time() - t
     logger.info('Computing image signatures done in %.3f secs', delta)
@@ -79,15 +212,126 @@ def get_image_sigs(imgs, path=ALBUMS_ROOT, hashfunc=dhash, max_workers=None):
     return sigs
 
 
-def dedup_df(df, path=ALBUMS_ROOT, dup_range=DEFAULT_DUP_RANGE, hashfunc=dhash):
-    """Remove duplicate image items in a DF"""
+class IncrementalDedup(object):
+    """Remove duplicate images from growing DataFrames of labels
+
+    Keeps the hashes and duplicate groups of the rows it has seen, so
+    rows appended to the labels only need to be hashed and looked up in
+    the index. Gives the same result as `dedup_df`: a row is dropped if
+    it is close to any row before it, so appended rows never cause
+    older ones to be dropped. If rows were removed or reordered, the
+    groups are rebuilt.
+
+    Parameters
+    ----------
+        path:       albums root
+        dup_range:  min and max Hamming distance of duplicates
+        hashfunc:   perceptual hash function
+    """
+
+    def __init__(self, path=ALBUMS_ROOT, dup_range=DEFAULT_DUP_RANGE,
+                 hashfunc=dhash):
+        self.path = path
+        self.dup_range = dup_range
+        self.hashfunc = hashfunc
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.index = HashIndex(max_dist=self.dup_range[1])
+        # names of the rows seen so far, in order
+        self.names = []
+        # kept row -> rows dropped as its duplicates
+        self.groups = defaultdict(set)
+        # positions of the dropped rows
+        self.dups = set()
+
+    def update(self, df):
+        """Drop duplicates from a DataFrame of labels, comparing only
+        rows added after the rows seen before"""
+        with self.lock:
+            names = list(df['name'])
+            start = len(self.names)
+            if names[:start] != self.names:
+                logger.info('Labels were removed or reordered, '
+                            'rebuilding duplicate groups')
+                self.reset()
+                start = 0
+            new = names[start:]
+            if not start:
+                self._build(new)
+            elif new:
+                self._add(new, start)
+            self.names = names
+            logger.info(f'Found {len(self.dups)} duplicate photos '
+                        f'({len(new)} new images)')
+            # same as `dedup_df`: rows are dropped by position, so a
+            # photo listed twice only keeps its first row
+            keep = np.ones(len(df), dtype=bool)
+            keep[list(self.dups)] = False
+            return df[keep]
+
+    def _build(self, names):
+        if not names:
+            return
+        min_thresh, max_thresh = self.dup_range
+        sigs = get_image_sigs(names, path=self.path, hashfunc=self.hashfunc)
+        self.index.add(pack_sigs(sigs))
+        dedup, dups = dists2dups(self.index.pairs(min_thresh, max_thresh),
+                                 min_thresh=min_thresh, max_thresh=max_thresh)
+        for a, bs in dedup.items():
+            self.groups[a].update(bs)
+        self.dups = set(dups)
+
+    def _add(self, new, start):
+        min_thresh, max_thresh = self.dup_range
+        sigs = get_image_sigs(new, path=self.path, hashfunc=self.hashfunc)
+        codes = pack_sigs(sigs)
+        rows = range(start, start + len(new))
+        self.index.add(codes, keys=rows)
+        for row, code in zip(rows, codes):
+            # like `dists2dups`, a row is dropped if it is close to any
+            # row before it
+            found = [key for key, dist in self.index.query(code, max_thresh)
+                     if dist >= min_thresh and key < row]
+            for key in found:
+                self.groups[key].add(row)
+            if found:
+                self.dups.add(row)
+
+
+_dedupers = {}
+_dedupers_lock = threading.Lock()
+
+
+def get_deduper(path=ALBUMS_ROOT, dup_range=DEFAULT_DUP_RANGE,
+                hashfunc=dhash):
+    """Shared IncrementalDedup for an albums root and dup range"""
+    key = (str(path), tuple(dup_range), hashfunc)
+    with _dedupers_lock:
+        if key not in _dedupers:
+            _dedupers[key] = IncrementalDedup(path, dup_range, hashfunc)
+        return _dedupers[key]
+
+
+def dedup_df(df, path=ALBUMS_ROOT, dup_range=DEFAULT_DUP_RANGE, hashfunc=dhash,
+             incremental=False):
+    """Remove duplicate image items in a DF
+
+    With `incremental`, duplicate groups are kept in memory (see
+    `IncrementalDedup`) and the next call only compares images that
+    were added to the DF since.
+    """
+    if incremental:
+        return get_deduper(path, dup_range, hashfunc).update(df)
+
     min_thresh, max_thresh = dup_range
 
     sigs = get_image_sigs(df['name'], path=path, hashfunc=hashfunc)
 
     logger.info('Calculate image distances...')
     t = time.time()
-    dists = sigs2dists(sigs)
+    dists = close_pairs(sigs, dup_range)
     delta = time.time() - t
     logger.info('Calculate image distances done in %.3f secs', delta)
 
@@ -97,4 +341,7 @@ def dedup_df(df, path=ALBUMS_ROOT, dup_range=DEFAULT_DUP_RANGE, hashfunc=dhash):
     logger.info(
         f'Found {len(dups)} duplicate photos with '
         f'{min_thresh} <= thresh <= {max_thresh}')
-    return df[~df.index.isin(dups)]
+    # dups are positions, the index may have gaps
+    keep = np.ones(len(df), dtype=bool)
+    keep[list(dups)] = False
+    return df[keep]
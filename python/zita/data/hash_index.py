@@ -0,0 +1,177 @@
+"""
+Near-duplicate search over perceptual image hashes
+
+`HashIndex` finds all hashes within a small Hamming distance of a query
+without comparing it to every hash (multi-index hashing): the bits are
+split into `max_dist + 1` disjoint bands, and two hashes that differ in
+at most `max_dist` bits must be equal on at least one band. Candidates
+are the hashes with an equal band, their full distances are checked
+with popcount.
+"""
+import numpy as np
+
+# number of set bits of each 16-bit value (64 KB), np.bitwise_count
+# needs numpy 2
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(1 << 16)],
+                          dtype=np.uint8)
+
+
+def pack_sigs(sigs):
+    """Pack image hashes into a [n, words] uint64 array, one bit per
+    hash bit (zero padded to a multiple of 64 bits)"""
+    if not len(sigs):
+        return np.zeros((0, 1), dtype=np.uint64)
+    bits = np.array([np.asarray(x.hash, dtype=bool).ravel() for x in sigs])
+    nbits = bits.shape[1]
+    padded = -(-nbits // 64) * 64
+    if padded != nbits:
+        bits = np.pad(bits, ((0, 0), (0, padded - nbits)))
+    return np.ascontiguousarray(np.packbits(bits, axis=1)).view(np.uint64)
+
+
+def popcount(x):
+    """Number of set bits of uint64 rows, summed over the last axis"""
+    lanes = np.ascontiguousarray(x).view(np.uint16)
+    counts = np.zeros(x.shape[:-1], dtype=np.uint16)
+    for i in range(lanes.shape[-1]):
+        counts += POPCOUNT_TABLE[lanes[..., i]]
+    return counts
+
+
+class HashIndex(object):
+    """Index of packed image hashes (see `pack_sigs`)
+
+    Parameters
+    ----------
+        max_dist:  largest Hamming distance that can be searched for
+        nbits:     number of bits of the hashes, defaults to all bits
+                   of the first codes added
+
+    Usage:
+
+        index = HashIndex(max_dist=4)
+        index.add(pack_sigs(sigs), keys=photo_ids)
+        index.query(pack_sigs([sig])[0])   # [(photo_id, dist), ...]
+        index.pairs(0, 4)                  # [[a, b, dist], ...]
+    """
+
+    def __init__(self, max_dist=4, nbits=None):
+        self.max_dist = max_dist
+        self.nbits = nbits
+        self.codes = None
+        self.keys = []
+        # per band: sorted band values and the rows they belong to
+        self.bands = []
+        self.band_values = []
+        self.band_rows = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _init_bands(self, codes):
+        nbits = self.nbits or codes.shape[1] * 64
+        nbands = self.max_dist + 1
+        if nbands > nbits or -(-nbits // nbands) > 64:
+            raise ValueError(
+                f'Cannot index {nbits}-bit hashes for distances up to '
+                f'{self.max_dist}')
+        self.nbits = nbits
+        bounds = np.linspace(0, nbits, nbands + 1).astype(int)
+        self.bands = list(zip(bounds[:-1], bounds[1:]))
+        self.codes = np.zeros((0, codes.shape[1]), dtype=np.uint64)
+        self.band_values = [np.zeros(0, dtype=np.uint64)] * nbands
+        self.band_rows = [np.zeros(0, dtype=np.int64)] * nbands
+
+    def _band_values(self, codes):
+        bits = np.unpackbits(np.ascontiguousarray(codes).view(np.uint8),
+                             axis=1)
+        for lo, hi in self.bands:
+            weights = np.uint64(1) << np.arange(hi - lo, dtype=np.uint64)
+            yield (bits[:, lo:hi].astype(np.uint64) * weights).sum(
+                axis=1, dtype=np.uint64)
+
+    def add(self, codes, keys=None):
+        """Add packed hashes, `keys` (defaults to their positions in
+        the index) are what `query` returns"""
+        codes = np.asarray(codes, dtype=np.uint64)
+        if codes.ndim == 1:
+            codes = codes[None, :]
+        if self.codes is None:
+            self._init_bands(codes)
+        if keys is None:
+            keys = range(len(self.keys), len(self.keys) + len(codes))
+        keys = list(keys)
+        if len(keys) != len(codes):
+            raise ValueError('Need one key for each hash')
+
+        rows = np.arange(len(self.codes), len(self.codes) + len(codes))
+        for b, values in enumerate(self._band_values(codes)):
+            order = np.argsort(values, kind='stable')
+            values, new_rows = values[order], rows[order]
+            # merge into the sorted arrays, O(n) instead of a new sort
+            pos = np.searchsorted(self.band_values[b], values, side='right')
+            self.band_values[b] = np.insert(self.band_values[b], pos, values)
+            self.band_rows[b] = np.insert(self.band_rows[b], pos, new_rows)
+        self.codes = np.concatenate([self.codes, codes])
+        self.keys.extend(keys)
+
+    def candidates(self, code):
+        """Rows equal to `code` on at least one band"""
+        found = []
+        for b, value in enumerate(self._band_values(code[None, :])):
+            values = self.band_values[b]
+            lo = np.searchsorted(values, value[0], side='left')
+            hi = np.searchsorted(values, value[0], side='right')
+            found.append(self.band_rows[b][lo:hi])
+        return np.unique(np.concatenate(found))
+
+    def query(self, code, max_dist=None):
+        """(key, distance) of all hashes within `max_dist` of a
+        packed hash, closest first"""
+        max_dist = self.max_dist if max_dist is None else max_dist
+        if max_dist > self.max_dist:
+            raise ValueError(f'Index only supports distances up to '
+                             f'{self.max_dist}')
+        if not len(self):
+            return []
+        code = np.asarray(code, dtype=np.uint64).ravel()
+        rows = self.candidates(code)
+        dists = popcount(self.codes[rows] ^ code)
+        close = np.nonzero(dists <= max_dist)[0]
+        close = close[np.argsort(dists[close], kind='stable')]
+        return [(self.keys[rows[i]], int(dists[i])) for i in close]
+
+    def pairs(self, min_dist=0, max_dist=None):
+        """All pairs of rows within the distances, as a [k, 3] array of
+        (a, b, distance) with a < b"""
+        max_dist = self.max_dist if max_dist is None else max_dist
+        if max_dist > self.max_dist:
+            raise ValueError(f'Index only supports distances up to '
+                             f'{self.max_dist}')
+        found = [np.zeros((0, 3), dtype=np.int64)]
+        for values, rows in zip(self.band_values, self.band_rows):
+            found.extend(self._band_pairs(values, rows, min_dist, max_dist))
+        found = np.concatenate(found)
+        # a pair is found once for each band it is equal on
+        return np.unique(found, axis=0)
+
+    def _band_pairs(self, values, rows, min_dist, max_dist):
+        """Verified pairs of rows with equal values in one band"""
+        if len(values) < 2:
+            return
+        # runs of equal values, and where the run of each position ends
+        starts = np.r_[0, np.nonzero(values[1:] != values[:-1])[0] + 1]
+        sizes = np.diff(np.r_[starts, len(values)])
+        run_end = np.repeat(starts + sizes, sizes)
+        pos = np.arange(len(values))
+        # compare each row to the ones `offset` places after it in its
+        # run, so memory stays within the size of the index
+        for offset in range(1, sizes.max()):
+            pos = pos[pos + offset < run_end[pos]]
+            a, b = rows[pos], rows[pos + offset]
+            dists = popcount(self.codes[a] ^ self.codes[b])
+            ok = (dists >= min_dist) & (dists <= max_dist)
+            if ok.any():
+                a, b = a[ok], b[ok]
+                yield np.stack([np.minimum(a, b), np.maximum(a, b),
+                                dists[ok].astype(np.int64)], axis=1)
@@ -0,0 +1,131 @@
+"""
+Truth labels for serving
+
+`get_labels` reads the whole labels CSV and removes duplicate images,
+which is right for training but much too slow to answer one lookup.
+`LabelIndex` keeps a dict of photo ID -> sorted tags, loaded without
+dedup, and only reads the lines appended to the CSV since the last
+check.
+
+The Node FileStore rewrites the whole CSV, truncating it first, so a
+rewritten file is parsed into a new dict that replaces the old one only
+once the file stopped changing: lookups never see a half loaded index.
+"""
+import csv
+import io
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('zita.data')
+
+# bytes before the read offset that must not change for the file to
+# be considered appended to, rather than rewritten
+TAIL_BYTES = 256
+
+
+def parse_tags(label):
+    """Sorted tags of a label ("a||b" or "a,b")"""
+    return tuple(sorted(x for x in label.replace('||', ',').split(',') if x))
+
+
+class LabelIndex(object):
+    """Photo ID -> sorted tags of a labels CSV (name, label)
+
+    Parameters
+    ----------
+        path:            labels CSV
+        check_interval:  min seconds between checks of the file
+    """
+
+    def __init__(self, path, check_interval=1.0):
+        self.path = str(path)
+        self.check_interval = check_interval
+        self.labels = {}
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.stat = None
+        self.offset = 0
+        self.tail = b''
+        # stat of a shrunken file seen in the last check
+        self._pending = None
+
+    def __len__(self):
+        self.refresh()
+        return len(self.labels)
+
+    def __contains__(self, photo_id):
+        return self.get(photo_id) is not None
+
+    def get(self, photo_id, default=None):
+        """Sorted tags of a photo, refreshing the index first if the
+        CSV changed"""
+        self.refresh()
+        return self.labels.get(photo_id, default)
+
+    def refresh(self, force=False):
+        """Read lines added to the CSV, or reload it if it was
+        rewritten. A file that shrunk may still be being written, it is
+        only reloaded once it stays the same between two checks.
+        Returns the number of lines read."""
+        if not force and time.monotonic() - self.checked < \
+                self.check_interval:
+            return 0
+        with self.lock:
+            self.checked = time.monotonic()
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                logger.warning('Labels CSV %s not found', self.path)
+                return 0
+            if self.stat is not None and \
+                    (stat.st_mtime_ns, stat.st_size) == \
+                    (self.stat.st_mtime_ns, self.stat.st_size):
+                return 0
+            key = (stat.st_mtime_ns, stat.st_size)
+            if self.stat is not None and stat.st_size < self.stat.st_size \
+                    and self._pending != key:
+                self._pending = key
+                return 0
+            self._pending = None
+            with open(self.path, 'rb') as f:
+                appended = self._appended(f, stat)
+                offset, tail = (self.offset, self.tail) if appended \
+                    else (0, b'')
+                f.seek(offset)
+                data = f.read(stat.st_size - offset)
+            # a line still being written is read next time
+            end = data.rfind(b'\n') + 1
+            if appended:
+                count = self._parse(data[:end], self.labels)
+            else:
+                labels = {}
+                count = self._parse(data[:end], labels)
+                after = os.stat(self.path)
+                if (after.st_mtime_ns, after.st_size) != key:
+                    # rewritten while we read it, try again next time
+                    return 0
+                self.labels = labels
+            self.offset = offset + end
+            self.tail = (tail + data[:end])[-TAIL_BYTES:]
+            self.stat = stat
+            logger.debug('Read %d labels from %s', count, self.path)
+            return count
+
+    def _appended(self, f, stat):
+        if not self.offset or stat.st_size < self.offset \
+                or stat.st_ino != self.stat.st_ino:
+            return False
+        f.seek(self.offset - len(self.tail))
+        return f.read(len(self.tail)) == self.tail
+
+    def _parse(self, data, labels):
+        count = 0
+        for row in csv.reader(io.StringIO(data.decode('utf-8'))):
+            if len(row) < 2 or not row[1]:
+                continue
+            # later lines win, like `dict(zip(names, labels))`
+            labels[row[0]] = parse_tags(row[1])
+            count += 1
+        return count
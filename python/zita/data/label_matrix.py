@@ -0,0 +1,178 @@
+"""
+Multi-hot labels
+
+Labels are stored in the CSV as strings of tags ("a||b" or "a,b").
+`LabelMatrix` parses them once, with vectorized pandas operations, into
+a sorted tag vocabulary and a bit-packed [photos, tags] multi-hot
+matrix, and saves it next to the CSV so later runs only load it.
+"""
+import logging
+import os
+import threading
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+
+logger = logging.getLogger('zita.data')
+
+
+def multi_hot(indices, n_classes):
+    """[len(indices), n_classes] 0/1 matrix of lists of class indices,
+    or of single class indices"""
+    indices = [np.atleast_1d(np.asarray(x, dtype=np.int64))
+               for x in indices]
+    lengths = np.array([len(x) for x in indices], dtype=np.int64)
+    rows = np.repeat(np.arange(len(indices)), lengths)
+    cols = np.concatenate(indices) if len(indices) \
+        else np.zeros(0, dtype=np.int64)
+    matrix = np.zeros((len(indices), n_classes), dtype=np.uint8)
+    matrix[rows, cols] = 1
+    return matrix
+
+
+class LabelMatrix(object):
+    """Tags of a list of photos
+
+    Parameters
+    ----------
+        photo_ids:  photo IDs, one per row
+        classes:    sorted tag vocabulary, one per column
+        bits:       np.packbits of the [photos, classes] multi-hot
+                    matrix along the columns
+    """
+
+    def __init__(self, photo_ids, classes, bits):
+        self.photo_ids = list(photo_ids)
+        self.classes = list(classes)
+        self.bits = bits
+        self._rows = None
+
+    def __len__(self):
+        return len(self.photo_ids)
+
+    @classmethod
+    def from_tags(cls, photo_ids, tags):
+        """Build from lists of tags, or Series of label strings"""
+        tags = pd.Series(list(tags), dtype=object)
+        if len(tags) and tags.map(lambda x: isinstance(x, str)).all():
+            tags = tags.str.replace('||', ',', regex=False).str.split(',')
+        exploded = tags.explode()
+        exploded = exploded[exploded.notna() & (exploded != '')]
+        classes = np.unique(exploded.values.astype(str))
+        dense = np.zeros((len(tags), len(classes)), dtype=bool)
+        dense[exploded.index.values,
+              np.searchsorted(classes, exploded.values.astype(str))] = True
+        return cls(photo_ids, classes, np.packbits(dense, axis=1))
+
+    @classmethod
+    def from_csv(cls, pth):
+        """Photos with at least one tag in a labels CSV (name, label)"""
+        df = pd.read_csv(pth, names=['name', 'label'], dtype=str)
+        df = df[df['label'].notna() & (df['label'] != '')]
+        matrix = cls.from_tags(df['name'], df['label'])
+        return matrix.subset(np.nonzero(matrix.bits.any(axis=1))[0])
+
+    def subset(self, rows):
+        return LabelMatrix([self.photo_ids[i] for i in rows], self.classes,
+                           self.bits[rows])
+
+    def row_of(self, photo_id):
+        if self._rows is None:
+            # later rows win, like `dict(zip(names, labels))`
+            self._rows = {x: i for i, x in enumerate(self.photo_ids)}
+        return self._rows.get(photo_id)
+
+    def dense(self, photo_ids=None, classes=None):
+        """Unpacked [photos, classes] uint8 matrix, for a list of photos
+        (all zeros for unknown ones) and in the order of a list of
+        classes (all zeros for tags not in the vocabulary)"""
+        matrix = np.unpackbits(self.bits, axis=1)[:, :len(self.classes)]
+        if photo_ids is not None:
+            rows = np.array([self.row_of(x) for x in photo_ids], dtype=float)
+            known = ~np.isnan(rows)
+            out = np.zeros((len(rows), matrix.shape[1]), dtype=np.uint8)
+            out[known] = matrix[rows[known].astype(np.int64)]
+            matrix = out
+        if classes is not None:
+            vocab = {x: i for i, x in enumerate(self.classes)}
+            cols = np.array([vocab.get(x, -1) for x in classes],
+                            dtype=np.int64)
+            out = np.zeros((len(matrix), len(cols)), dtype=np.uint8)
+            out[:, cols >= 0] = matrix[:, cols[cols >= 0]]
+            matrix = out
+        return matrix
+
+    def tags(self, i):
+        """Sorted tags of the i-th photo"""
+        row = np.unpackbits(self.bits[i])[:len(self.classes)]
+        return [self.classes[j] for j in np.nonzero(row)[0]]
+
+    def label_strings(self, delim=','):
+        """Sorted tags of each photo joined by `delim`, each distinct
+        set of tags is only joined once"""
+        if not len(self):
+            return []
+        combos, inverse = np.unique(self.bits, axis=0, return_inverse=True)
+        strings = np.array([
+            delim.join(self.classes[j] for j in np.nonzero(
+                np.unpackbits(x)[:len(self.classes)])[0])
+            for x in combos], dtype=object)
+        return list(strings[inverse.ravel()])
+
+    def save(self, path, source=None):
+        """Save to a .npz file, `source` is the (size, mtime) of the
+        CSV it was built from"""
+        tmp_path = f'{path}.tmp.npz'
+        np.savez_compressed(
+            tmp_path, photo_ids=np.array(self.photo_ids, dtype=str),
+            classes=np.array(self.classes, dtype=str), bits=self.bits,
+            source=np.array(source or (-1, -1), dtype=np.int64))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, source=None):
+        """Load a saved matrix, None if it was built from another
+        version of the CSV"""
+        with np.load(path, allow_pickle=False) as data:
+            if source is not None and \
+                    tuple(data['source'].tolist()) != tuple(source):
+                return None
+            return cls(data['photo_ids'].tolist(), data['classes'].tolist(),
+                       data['bits'])
+
+
+_matrices = {}
+_matrices_lock = threading.Lock()
+
+
+def matrix_path(pth):
+    return Path(pth).with_suffix('.labels.npz')
+
+
+def get_label_matrix(pth):
+    """LabelMatrix of a labels CSV, loaded from (or saved to) the
+    `.labels.npz` file next to it, and kept in memory until the CSV
+    changes"""
+    stat = os.stat(pth)
+    source = (stat.st_size, stat.st_mtime_ns)
+    with _matrices_lock:
+        cached = _matrices.get(str(pth))
+        if cached is not None and cached[0] == source:
+            return cached[1]
+        path = matrix_path(pth)
+        matrix = None
+        if path.exists():
+            try:
+                matrix = LabelMatrix.load(path, source)
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning('Cannot load labels from %s: %s', path, e)
+        if matrix is None:
+            logger.info('Building label matrix from %s', pth)
+            matrix = LabelMatrix.from_csv(pth)
+            try:
+                matrix.save(path, source)
+            except OSError as e:
+                logger.warning('Cannot save labels to %s: %s', path, e)
+        _matrices[str(pth)] = (source, matrix)
+        return matrix
@@ -0,0 +1,147 @@
+"""
+Persistent store of perceptual image hashes
+
+Hashing a library for dedup means decoding every image, so signatures
+are kept in a SQLite database keyed by (path, hash function), with the
+file size and mtime they were computed from. Only new or changed files
+are hashed again.
+"""
+import logging
+import sqlite3
+import threading
+import numpy as np
+
+from functools import partial
+from imagehash import ImageHash
+
+from zita.data.tensor_cache import file_key
+from zita.settings import SIG_STORE
+
+logger = logging.getLogger('zita.data')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS signatures (
+    path TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    shape TEXT NOT NULL,
+    sig BLOB NOT NULL,
+    PRIMARY KEY (path, kind)
+);
+"""
+
+
+def hash_kind(hashfunc, draft_size):
+    """Name of a hash function and its arguments, signatures of
+    different kinds are stored separately"""
+    kwargs = {}
+    if isinstance(hashfunc, partial):
+        kwargs = hashfunc.keywords
+        hashfunc = hashfunc.func
+    name = getattr(hashfunc, '__name__', type(hashfunc).__name__)
+    args = ''.join(f',{k}={v}' for k, v in sorted(kwargs.items()))
+    return '{}{}:{}x{}'.format(name, args, *draft_size)
+
+
+def encode_sig(sig):
+    bits = np.asarray(sig.hash, dtype=bool)
+    return 'x'.join(map(str, bits.shape)), np.packbits(bits).tobytes()
+
+
+def decode_sig(shape, blob):
+    shape = tuple(int(x) for x in shape.split('x'))
+    bits = np.unpackbits(np.frombuffer(blob, dtype=np.uint8))
+    return ImageHash(bits[:int(np.prod(shape))].reshape(shape).astype(bool))
+
+
+class SignatureStore(object):
+    """SQLite store of image hashes
+
+    Parameters
+    ----------
+        path:  database file, created if it does not exist
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._local = threading.local()
+        self.db.executescript(SCHEMA)
+
+    @property
+    def db(self):
+        """One SQLite connection per thread"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def get_many(self, paths, kind):
+        """Stored signatures of a list of files, None for files not
+        hashed yet or changed since they were hashed"""
+        paths = [str(x) for x in paths]
+        rows = {}
+        for start in range(0, len(paths), 500):
+            chunk = paths[start:start + 500]
+            sql = ('SELECT path, size, mtime, shape, sig FROM signatures '
+                   'WHERE kind = ? AND path IN ({})'.format(
+                       ','.join('?' * len(chunk))))
+            rows.update((x[0], x[1:]) for x in
+                        self.db.execute(sql, [kind, *chunk]))
+        results = []
+        for path in paths:
+            row = rows.get(path)
+            try:
+                if row is None or file_key(path) != row[:2]:
+                    results.append(None)
+                    continue
+            except FileNotFoundError:
+                results.append(None)
+                continue
+            results.append(decode_sig(*row[2:]))
+        return results
+
+    def put_many(self, items, kind):
+        """Store signatures, `items` are (path, (size, mtime), sig)
+        with the file key taken before the file was hashed"""
+        rows = [(str(path), kind, *key, *encode_sig(sig))
+                for path, key, sig in items]
+        db = self.db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.executemany(
+                'INSERT OR REPLACE INTO signatures '
+                '(path, kind, size, mtime, shape, sig) '
+                'VALUES (?, ?, ?, ?, ?, ?)', rows)
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+
+    def __len__(self):
+        count, = self.db.execute(
+            'SELECT COUNT(*) FROM signatures').fetchone()
+        return count
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_sig_store(path=SIG_STORE):
+    """Shared SignatureStore of a database file, None if the store is
+    disabled or cannot be opened"""
+    if not path:
+        return None
+    path = str(path)
+    with _stores_lock:
+        if path not in _stores:
+            try:
+                _stores[path] = SignatureStore(path)
+            except (sqlite3.Error, OSError) as e:
+                logger.warning('Cannot open signature store %s: %s', path, e)
+                _stores[path] = None
+        return _stores[path]
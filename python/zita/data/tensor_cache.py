@@ -0,0 +1,236 @@
+"""
+Persistent cache of preprocessed input tensors
+
+Decoded and resized images are stored in fixed-size, memory-mapped shards
+(one directory per input geometry), with a SQLite index keyed by
+(photo path, file size, mtime). Any model with the same input size can
+read them without decoding the photo again.
+
+Tensors are stored before normalization (values in [0, 1]), so models
+with different normalization stats can share them; normalization is
+applied to the stacked batch before the forward pass.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+import torch
+
+from pathlib import Path
+
+from zita.data.decode import load_tensor
+
+logger = logging.getLogger('zita.data')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    slot INTEGER NOT NULL UNIQUE,
+    ready INTEGER NOT NULL DEFAULT 0,
+    atime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime);
+"""
+
+
+def file_key(path):
+    """(size, mtime) of a file, so changed files are treated as new"""
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class TensorCache(object):
+    """On-disk cache of [3, H, W] float32 tensors of one input size
+
+    Parameters
+    ----------
+        root:       cache directory, tensors of each input size are kept
+                    in a `{H}x{W}` subdirectory.
+        size:       input size (height, width).
+        max_bytes:  evict least recently used tensors once the cache
+                    would grow bigger than this.
+        shard_size: number of tensors in each memory-mapped shard file.
+    """
+
+    def __init__(self, root, size, max_bytes=4 * 1024 ** 3,
+                 shard_size=1024):
+        if isinstance(size, int):
+            size = (size, size)
+        self.size = tuple(size)
+        self.shape = (3, *self.size)
+        self.root = Path(root) / '{}x{}'.format(*self.size)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.shard_size = shard_size
+        slot_bytes = int(np.prod(self.shape)) * 4
+        self.max_slots = max(1, max_bytes // slot_bytes)
+        self._local = threading.local()
+        self._shards = {}
+        self._shards_lock = threading.Lock()
+        self.db.executescript(SCHEMA)
+
+    @property
+    def db(self):
+        """One SQLite connection per thread"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.root / 'index.db'), timeout=30,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def shard(self, i):
+        """Memory map of the i-th shard, created on first use"""
+        shard = self._shards.get(i)
+        if shard is None:
+            with self._shards_lock:
+                shard = self._shards.get(i)
+                if shard is None:
+                    path = self.root / f'shard-{i:05d}.npy'
+                    mode = 'r+' if path.exists() else 'w+'
+                    shard = self._shards[i] = np.lib.format.open_memmap(
+                        str(path), mode=mode, dtype=np.float32,
+                        shape=(self.shard_size, *self.shape))
+        return shard
+
+    def _slot(self, slot):
+        return self.shard(slot // self.shard_size)[slot % self.shard_size]
+
+    def _ready_rows(self, paths):
+        """path -> (size, mtime, slot) of the cached files"""
+        rows = {}
+        for start in range(0, len(paths), 500):
+            chunk = paths[start:start + 500]
+            sql = ('SELECT path, size, mtime, slot FROM entries WHERE ready '
+                   'AND path IN ({})'.format(','.join('?' * len(chunk))))
+            rows.update((x[0], x[1:]) for x in self.db.execute(sql, chunk))
+        return rows
+
+    def get_many(self, paths):
+        """Cached tensors of a list of files, None for files not cached
+        or changed since they were cached.
+
+        Tensors are copied out of the memory-mapped shards: another
+        thread or process can evict a slot and overwrite it at any time,
+        so a copy only counts as a hit if its entry is still in the same
+        slot once it is made."""
+        paths = [str(x) for x in paths]
+        rows = self._ready_rows(paths)
+        results, hits = [], []
+        for path in paths:
+            row = rows.get(path)
+            if row is None:
+                results.append(None)
+                continue
+            size, mtime, slot = row
+            try:
+                if file_key(path) != (size, mtime):
+                    results.append(None)
+                    continue
+            except FileNotFoundError:
+                results.append(None)
+                continue
+            results.append(torch.from_numpy(np.array(self._slot(slot))))
+            hits.append(path)
+        if hits:
+            # drop copies of slots that were reused while we read them
+            current = self._ready_rows(hits)
+            for i, path in enumerate(paths):
+                if results[i] is not None and \
+                        current.get(path) != rows[path]:
+                    results[i] = None
+            hits = [x for x in hits if current.get(x) == rows[x]]
+        if hits:
+            self.db.executemany('UPDATE entries SET atime = ? WHERE path = ?',
+                                [(time.time(), x) for x in hits])
+        return results
+
+    def get(self, path):
+        return self.get_many([path])[0]
+
+    def _allocate(self, path, key):
+        """Reserve a slot for a file, evicting the least recently used
+        entry if the cache is full"""
+        db = self.db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute('SELECT slot FROM entries WHERE path = ?',
+                             (path,)).fetchone()
+            if row is not None:
+                slot = row[0]
+            else:
+                count, = db.execute('SELECT COUNT(*) FROM entries').fetchone()
+                if count < self.max_slots:
+                    slot = count
+                else:
+                    slot, = db.execute(
+                        'SELECT slot FROM entries ORDER BY atime LIMIT 1'
+                    ).fetchone()
+                    db.execute('DELETE FROM entries WHERE slot = ?', (slot,))
+            db.execute(
+                'INSERT OR REPLACE INTO entries '
+                '(path, size, mtime, slot, ready, atime) '
+                'VALUES (?, ?, ?, ?, 0, ?)',
+                (path, *key, slot, time.time()))
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        return slot
+
+    def put(self, path, tensor):
+        path = str(path)
+        key = file_key(path)
+        slot = self._allocate(path, key)
+        self._slot(slot)[:] = tensor.numpy()
+        self.db.execute('UPDATE entries SET ready = 1 WHERE path = ? '
+                        'AND slot = ?', (path, slot))
+
+    def load(self, path):
+        """Get a tensor from cache, or decode and cache it"""
+        tensor = self.get(path)
+        if tensor is None:
+            tensor = load_tensor(path, self.size)
+            self.put(path, tensor)
+        return tensor
+
+    def build(self, paths, runner=None):
+        """Decode and cache all files that are not cached yet,
+        returns the number of files added"""
+        paths = [str(x) for x in paths]
+        missing = [p for p, x in zip(paths, self.get_many(paths)) if x is None]
+        logger.info('Caching %d of %d tensors in %s...',
+                    len(missing), len(paths), self.root)
+
+        def add(path):
+            self.put(path, load_tensor(path, self.size))
+
+        if runner is None:
+            for path in missing:
+                add(path)
+        else:
+            runner.run(add, missing)
+        return len(missing)
+
+    def __len__(self):
+        count, = self.db.execute('SELECT COUNT(*) FROM entries').fetchone()
+        return count
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_tensor_cache(root, size, **kwargs):
+    """Shared TensorCache instance for a root and input size"""
+    if isinstance(size, int):
+        size = (size, size)
+    key = (str(root), tuple(size))
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = TensorCache(root, size, **kwargs)
+        return _caches[key]
@@ -1,96 +1,405 @@
 """
 RPC Server to serve predictions
+
+Runs either as a single server loop, or as a broker that load
+balances requests over a pool of worker processes (or threads):
+
+    clients (REQ) -> ROUTER [broker] ROUTER <- DEALER (workers)
+
+Workers tell the broker when they are ready for the next request, so
+requests always go to the least recently used idle worker, and a slow
+batch prediction only blocks the worker running it.
+
+DEALER clients may also ask for batch predictions to be streamed back
+in parts, see `handle_stream`.
+
+Send {"metrics": true} to get metrics in Prometheus text format. A
+broker answers it itself: in "process" mode with the metrics of all its
+workers, each with a `worker` label, as they were at most
+METRICS_INTERVAL seconds ago.
 """
+import multiprocessing
 import orjson
+import threading
+import time
 import zmq
 import logging
 
-from zita.serve.predict import predict, batch_predict
-from zita.settings import LOG_LEVEL, RPC_PORT, DEFAULT_MODEL
+from collections import OrderedDict
+
+from zita.serve.predict import predict, batch_predict, registry
+from zita.utils.metrics import REGISTRY, render, merge
+from zita.settings import LOG_LEVEL, RPC_PORT, DEFAULT_MODEL, \
+    RPC_WORKERS, RPC_WORKER_MODE, RPC_TIMEOUT_SEC
 
 DEFAULT_PORT = RPC_PORT
 logger = logging.getLogger('zita.rpc')
 logger.setLevel(LOG_LEVEL)
 
-# def start_device(port=DEFAULT_PORT):
-#     # try:
-#     context = zmq.Context(1)
+# worker -> broker
+READY = b'READY'
+HEARTBEAT = b'HEARTBEAT'
+REPLY = b'REPLY'
+# broker -> worker
+REQUEST = b'REQUEST'
+# both ways: ask for metrics, and the collected metrics
+METRICS = b'METRICS'
+
+HEARTBEAT_INTERVAL = 1.0  # seconds
+HEARTBEAT_LIVENESS = 5  # missed heartbeats before an idle worker is dead
+METRICS_INTERVAL = 5.0  # seconds between metrics updates from workers
+
+
+def error_reply(error):
+    return orjson.dumps({'error': error})
+
+
+def parse_query(message):
+    try:
+        return orjson.loads(message)
+    except Exception:
+        logger.error('Could not parse message: %s', message)
+        return None
+
+
+def is_metrics_query(message):
+    if b'metrics' not in message:
+        return False
+    query = parse_query(message)
+    return isinstance(query, dict) and bool(query.get('metrics'))
+
 
-#     # Socket facing clients
-#     frontend = context.socket(zmq.XREP)
-#     url = f"tcp://*:{port}"
-#     print("Binding frontend to %s" % url)
-#     frontend.bind(url)
+def handle(message):
+    """Handle one request message, returns the reply message"""
+    query = parse_query(message)
+    if not query:
+        return error_reply('Bad request')
 
-#     # Socket facing services
-#     backend = context.socket(zmq.XREQ)
-#     url = f"tcp://*:{port + 1}"
-#     print("Binding backend to %s" % url)
-#     backend.bind(url)
+    try:
+        tags_only = query.get('tagsOnly') or False
+        if 'photoId' in query:
+            reply = predict(query.get('model') or DEFAULT_MODEL,
+                            query['photoId'])
+            if tags_only:
+                reply = reply['tags'] if reply else reply
+        elif 'photoIds' in query:
+            reply = batch_predict(query.get('model') or DEFAULT_MODEL,
+                                  query['photoIds'])
+            if tags_only:
+                reply = [x['tags'] if x else x for x in reply]
+        elif query.get('metrics'):
+            # Prometheus text format of the process that got the request
+            return REGISTRY.render().encode('utf-8')
+        else:
+            return error_reply('Unknown operation')
+    except Exception as e:
+        logger.error(e, exc_info=True)
+        return error_reply(str(e))
 
-#     zmq.device(zmq.QUEUE, frontend, backend)
-#     # except Exception as e:
-#     #     print(e)
-#     #     print("bringing down zmq device...")
-#     # finally:
-#     #     frontend.close()
-#     #     backend.close()
-#     #     context.term()
+    return orjson.dumps(reply)
+
+
+def handle_stream(query):
+    """Stream batch predictions: cached results first, then one message
+    per mini batch as it finishes, then an end-of-stream message.
+
+    Each data message has two frames, a header with the indexes of the
+    results in `photoIds`, and the results:
+
+        [{"indexes": [0, 3, ...]}, [result_0, result_3, ...]]
+
+    The last message has one frame: {"end": true, "total": n}, or
+    {"end": true, "error": "..."} if prediction failed.
+    """
+    tags_only = query.get('tagsOnly') or False
+    photo_ids = query['photoIds']
+    iterator = batch_predict.iter_batches(
+        query.get('model') or DEFAULT_MODEL, photo_ids)
+    try:
+        for indexes, results in iterator:
+            if tags_only:
+                results = [x['tags'] if x else x for x in results]
+            yield [orjson.dumps({'indexes': indexes}),
+                   orjson.dumps(results)]
+    except Exception as e:
+        logger.error(e, exc_info=True)
+        yield [orjson.dumps({'end': True, 'error': str(e)})]
+        return
+    yield [orjson.dumps({'end': True, 'total': len(photo_ids)})]
+
+
+def iter_replies(message):
+    """Replies to a request, each reply is a list of frames.
+
+    Streaming requests ({"photoIds": [...], "stream": true}) get
+    multiple replies, so the client must be a DEALER socket. All other
+    requests get exactly one reply.
+    """
+    query = parse_query(message)
+    if query and query.get('stream') and 'photoIds' in query:
+        yield from handle_stream(query)
+    else:
+        yield [handle(message)]
 
 
 def start_server(port=DEFAULT_PORT):
+    """Serve requests one by one in a single loop.
+
+    Uses a ROUTER socket, which REQ clients talk to exactly like a REP
+    socket, but also allows streaming multiple replies.
+    """
     context = zmq.Context()
-    socket = context.socket(zmq.REP)
+    socket = context.socket(zmq.ROUTER)
     url = f"tcp://*:{port}"
     logger.debug("Binding server to %s" % url)
     socket.bind(url)
+    registry.start()
 
-    def end(error):
-        reply = {'error': error}
-        socket.send(orjson.dumps(reply))
+    while True:
+        frames = socket.recv_multipart()
+        envelope, message = frames[:-1], frames[-1]
+        #  Send replies back to client
+        for reply in iter_replies(message):
+            socket.send_multipart([*envelope, *reply])
+
+
+def start_worker(url, context=None, name=None):
+    """Connect to the broker backend and serve requests"""
+    context = context or zmq.Context()
+    socket = context.socket(zmq.DEALER)
+    if name:
+        socket.setsockopt(zmq.IDENTITY, name.encode('utf-8'))
+    socket.connect(url)
+    registry.start()
+    logger.debug("Worker %s connected to %s", name, url)
+    socket.send(READY)
 
     while True:
-        message = socket.recv()
-        query = None
-        try:
-            query = orjson.loads(message)
-        except Exception:
-            logger.error('Could not parse message: %s', message)
-            end('Bad request')
+        if not socket.poll(HEARTBEAT_INTERVAL * 1000):
+            socket.send(HEARTBEAT)
             continue
-
-        if not query:
-            end('Bad request')
+        frames = socket.recv_multipart()
+        if frames[0] == METRICS:
+            socket.send_multipart([METRICS, orjson.dumps(REGISTRY.collect())])
             continue
+        if frames[0] != REQUEST:
+            continue
+        envelope, message = frames[1:-1], frames[-1]
+        for reply in iter_replies(message):
+            socket.send_multipart([REPLY, *envelope, *reply])
+        socket.send(READY)
 
-        try:
-            tags_only = query.get('tagsOnly') or False
-            if 'photoId' in query:
-                reply = predict(query.get('model') or DEFAULT_MODEL,
-                                query['photoId'])
-                if tags_only:
-                    reply = reply['tags'] if reply else reply
-            elif 'photoIds' in query:
-                reply = batch_predict(query.get('model') or DEFAULT_MODEL,
-                                      query['photoIds'])
-                if tags_only:
-                    reply = [x['tags'] if x else x for x in reply]
-            else:
-                end('Unknown operation')
+
+class WorkerState(object):
+
+    def __init__(self, identity):
+        self.identity = identity
+        self.last_seen = time.time()
+        # (envelope, started_at) of the request the worker is running
+        self.busy = None
+        self.served = 0
+
+
+class Broker(object):
+    """Route client requests to idle workers, least recently used first
+
+    Parameters
+    ----------
+        frontend_url:  where clients connect to
+        backend_url:   where workers connect to
+        timeout:       seconds a worker may spend on one request before
+                       it is considered dead
+        local_metrics: answer metrics queries with the metrics of this
+                       process, for workers that are threads of it
+    """
+
+    def __init__(self, frontend_url, backend_url, context=None,
+                 timeout=RPC_TIMEOUT_SEC, local_metrics=False):
+        self.context = context or zmq.Context.instance()
+        self.frontend = self.context.socket(zmq.ROUTER)
+        self.frontend.bind(frontend_url)
+        self.backend = self.context.socket(zmq.ROUTER)
+        # let restarted workers take over their old identity
+        self.backend.setsockopt(zmq.ROUTER_HANDOVER, 1)
+        self.backend.bind(backend_url)
+        self.timeout = timeout
+        self.workers = {}
+        # idle workers, least recently used first
+        self.idle = OrderedDict()
+        self.local_metrics = local_metrics
+        # worker -> its last collected metrics
+        self.metrics = {}
+        self.metrics_at = 0
+
+    def on_worker_message(self, frames):
+        identity, command = frames[0], frames[1]
+        worker = self.workers.get(identity)
+        if worker is None:
+            logger.debug("Worker %s joined", identity)
+            worker = self.workers[identity] = WorkerState(identity)
+            if command == HEARTBEAT:
+                # dropped while idle, it only sends READY after serving
+                # a request
+                self.idle[identity] = worker
+        worker.last_seen = time.time()
+
+        if command == REPLY:
+            envelope = worker.busy[0] if worker.busy else None
+            if envelope is None or \
+                    frames[2:2 + len(envelope)] != list(envelope):
+                # the client already got a timeout error and may be
+                # waiting for the reply to its next request
+                logger.warning("Dropping late reply from worker %s",
+                               identity)
+                return
+            self.frontend.send_multipart(frames[2:])
+            # streaming workers are alive as long as they reply
+            worker.busy = (envelope, time.time())
+        elif command == METRICS:
+            self.metrics[identity] = orjson.loads(frames[2])
+        elif command == READY:
+            if worker.busy:
+                worker.served += 1
+            worker.busy = None
+            self.idle[identity] = worker
+            self.idle.move_to_end(identity)
+
+    def on_client_message(self, frames):
+        if is_metrics_query(frames[-1]):
+            self.frontend.send_multipart([*frames[:-1],
+                                          self.render_metrics()])
+            return
+        identity, worker = self.idle.popitem(last=False)
+        envelope = frames[:-1]
+        worker.busy = (envelope, time.time())
+        self.backend.send_multipart([identity, REQUEST, *frames])
+
+    def render_metrics(self):
+        if self.local_metrics:
+            return REGISTRY.render().encode('utf-8')
+        families = {identity.decode('utf-8', 'replace'): x
+                    for identity, x in self.metrics.items()}
+        return render(merge(families, 'worker')).encode('utf-8')
+
+    def update_metrics(self):
+        """Ask all workers for their metrics, busy workers answer when
+        they finish their request"""
+        for identity in self.workers:
+            self.backend.send_multipart([identity, METRICS])
+        self.metrics_at = time.time()
+
+    def check_workers(self):
+        """Drop workers that stopped sending heartbeats, or got stuck
+        on a request"""
+        now = time.time()
+        if not self.local_metrics and \
+                now - self.metrics_at >= METRICS_INTERVAL:
+            self.update_metrics()
+        for identity, worker in list(self.workers.items()):
+            if worker.busy:
+                envelope, started_at = worker.busy
+                if now - started_at < self.timeout:
+                    continue
+                logger.error("Worker %s timed out", identity)
+                self.frontend.send_multipart(
+                    [*envelope, error_reply('Prediction timed out.')])
+            elif now - worker.last_seen < \
+                    HEARTBEAT_INTERVAL * HEARTBEAT_LIVENESS:
                 continue
-        except Exception as e:
-            logger.error(e, exc_info=True)
-            end(str(e))
-            continue
+            else:
+                logger.error("Worker %s stopped responding", identity)
+            del self.workers[identity]
+            self.idle.pop(identity, None)
+            self.metrics.pop(identity, None)
+
+    def stats(self):
+        return {
+            identity.decode('utf-8', 'replace'): {
+                'busy': bool(worker.busy),
+                'served': worker.served,
+                'last_seen': worker.last_seen,
+            }
+            for identity, worker in self.workers.items()
+        }
+
+    def run(self):
+        poller_all = zmq.Poller()
+        poller_all.register(self.backend, zmq.POLLIN)
+        poller_all.register(self.frontend, zmq.POLLIN)
+        poller_workers = zmq.Poller()
+        poller_workers.register(self.backend, zmq.POLLIN)
+
+        while True:
+            # only take client requests when a worker is idle
+            poller = poller_all if self.idle else poller_workers
+            events = dict(poller.poll(HEARTBEAT_INTERVAL * 1000))
+            if self.backend in events:
+                self.on_worker_message(self.backend.recv_multipart())
+            if self.frontend in events and self.idle:
+                self.on_client_message(self.frontend.recv_multipart())
+            self.check_workers()
+
+
+def _run_worker_process(url, name):
+    start_worker(url, name=name)
+
+
+def start_broker(port=DEFAULT_PORT, num_workers=RPC_WORKERS,
+                 mode=RPC_WORKER_MODE):
+    """Start the broker and `num_workers` workers.
+
+    In "process" mode, workers are separate processes (each loads its
+    own models), and dead workers are restarted. In "thread" mode they
+    share the models of this process.
+    """
+    if mode == 'thread':
+        context = zmq.Context.instance()
+        backend_url = 'inproc://zita.rpc.workers'
+    else:
+        context = None
+        backend_url = f'tcp://127.0.0.1:{port + 1}'
+    broker = Broker(f'tcp://*:{port}', backend_url, context=context,
+                    local_metrics=mode == 'thread')
+    logger.debug("Broker listening on %s, %d %s workers on %s",
+                 port, num_workers, mode, backend_url)
+
+    workers = {}
+
+    def spawn(i):
+        name = f'worker-{i}'
+        if mode == 'thread':
+            worker = threading.Thread(
+                target=start_worker, args=(backend_url, context, name),
+                name=name, daemon=True)
+        else:
+            # spawn instead of fork, so workers get their own Redis
+            # client thread and ZMQ context
+            worker = multiprocessing.get_context('spawn').Process(
+                target=_run_worker_process, args=(backend_url, name),
+                name=name, daemon=True)
+        worker.start()
+        workers[i] = worker
+
+    def supervise():
+        while True:
+            for i, worker in list(workers.items()):
+                if not worker.is_alive():
+                    logger.error("%s exited, restarting...", worker.name)
+                    spawn(i)
+            time.sleep(HEARTBEAT_INTERVAL)
 
-        #  Send reply back to client
-        socket.send(orjson.dumps(reply))
+    for i in range(num_workers):
+        spawn(i)
+    threading.Thread(target=supervise, name="RPCSupervisor",
+                     daemon=True).start()
+    broker.run()
 
 
 if __name__ == '__main__':
     import sys
     argv = sys.argv
-    if len(argv) > 1:
-        start_server(int(argv[1]))
+    port = int(argv[1]) if len(argv) > 1 else DEFAULT_PORT
+    if RPC_WORKERS > 0:
+        start_broker(port)
     else:
-        start_server()
+        start_server(port)
@@ -0,0 +1,149 @@
+"""
+Inference backends
+
+A backend wraps a loaded model and exposes what the batched engine
+needs: the input size, a forward pass on a stacked batch of [0, 1]
+images, and decoding probabilities to tags.
+
+- fastai: the exported fastai `Learner` pickle (`{model}.pkl`)
+- torchscript: a TorchScript module (`{model}.pt`) plus a metadata file
+  (`{model}.json`) created by `zita export`. Does not import fastai.
+"""
+import json
+import torch
+
+from zita.settings import MODELS_ROOT, PRED_BACKEND
+
+DEFAULT_INPUT_SIZE = 224
+DEFAULT_THRESH = 0.5
+MODEL_SUFFIXES = {'fastai': '.pkl', 'torchscript': '.pt'}
+
+
+def model_path(model, root=MODELS_ROOT, backend=PRED_BACKEND):
+    """Main file of a model for a backend"""
+    return root / f'{model}{MODEL_SUFFIXES[backend]}'
+
+
+def decode_probs(probs, classes, multi_label=True, thresh=DEFAULT_THRESH):
+    """Predicted labels (one-hot for multi-label models, class index
+    otherwise) and tags from probabilities"""
+    if multi_label:
+        preds = (probs >= thresh).float()
+        tags = [classes[i] for i in preds.nonzero().view(-1).tolist()]
+    else:
+        preds = probs.argmax()
+        tags = classes[preds.item()]
+    return tags, preds
+
+
+class FastaiBackend(object):
+    """Run an exported fastai Learner"""
+    name = 'fastai'
+
+    def __init__(self, learn):
+        self.learn = learn
+        self.model = learn.model
+
+    @classmethod
+    def load(cls, model, root=MODELS_ROOT):
+        from fastai.basic_train import load_learner
+        learn = load_learner(root, f'{model}.pkl')
+        # if hasattr(learn.model, 'module'):
+        #     learn.model = learn.model.module
+        return cls(learn)
+
+    @property
+    def classes(self):
+        return self.learn.data.classes
+
+    @property
+    def input_size(self):
+        size = self.learn.data.single_ds.tfmargs.get('size') \
+            or DEFAULT_INPUT_SIZE
+        if isinstance(size, int):
+            return size, size
+        return tuple(size[-2:])
+
+    @property
+    def batch_size(self):
+        return self.learn.data.batch_size
+
+    @property
+    def stats(self):
+        """Normalization (mean, std), None if not normalized"""
+        norm = getattr(self.learn.data, 'norm', None)
+        if not norm:
+            return None
+        return norm.keywords['mean'], norm.keywords['std']
+
+    @property
+    def multi_label(self):
+        from fastai.data_block import MultiCategoryList
+        return isinstance(self.learn.data.single_ds.y, MultiCategoryList)
+
+    def forward(self, xb):
+        """Activated predictions of a stacked batch, on CPU"""
+        learn = self.learn
+        yb = torch.zeros(len(xb))
+        # apply dataloader transforms (e.g. normalization, moving to device)
+        batch = learn.data.single_dl.proc_batch((xb, yb))
+        return learn.pred_batch(batch=batch).cpu()
+
+    def decode(self, probs):
+        y = self.learn.data.single_ds.y
+        preds = y.analyze_pred(probs)
+        return y.reconstruct(preds).obj, preds
+
+
+class TorchScriptBackend(object):
+    """Run a TorchScript module exported by `zita export`"""
+    name = 'torchscript'
+
+    def __init__(self, module, meta):
+        self.model = module.eval()
+        self.meta = meta
+        self.classes = meta['classes']
+        self.input_size = tuple(meta['input_size'])
+        self.batch_size = meta.get('batch_size') or 64
+        self.multi_label = meta.get('multi_label', True)
+        self.thresh = meta.get('thresh', DEFAULT_THRESH)
+        if meta.get('mean') is not None:
+            self.stats = (torch.tensor(meta['mean']),
+                          torch.tensor(meta['std']))
+        else:
+            self.stats = None
+
+    @classmethod
+    def load(cls, model, root=MODELS_ROOT):
+        with (root / f'{model}.json').open() as f:
+            meta = json.load(f)
+        module = torch.jit.load(str(root / f'{model}.pt'),
+                                map_location='cpu')
+        return cls(module, meta)
+
+    def forward(self, xb):
+        if self.stats is not None:
+            mean, std = self.stats
+            xb = (xb - mean[:, None, None]) / std[:, None, None]
+        with torch.no_grad():
+            out = self.model(xb)
+        if self.multi_label:
+            return torch.sigmoid(out)
+        return torch.softmax(out, dim=-1)
+
+    def decode(self, probs):
+        return decode_probs(probs, self.classes, self.multi_label,
+                            self.thresh)
+
+
+BACKENDS = {
+    'fastai': FastaiBackend,
+    'torchscript': TorchScriptBackend,
+}
+
+
+def load_backend(model, root=MODELS_ROOT, backend=PRED_BACKEND):
+    """Load a model with the configured backend"""
+    if not model_path(model, root, backend).exists():
+        raise ValueError(f"No such learner: {model}")
+    return BACKENDS[backend].load(model, root)
@@ -0,0 +1,268 @@
+"""
+Compact cache encoding for predictions
+
+A prediction dict repeats the model's full `classes` list and stores
+`probs` and `preds` as JSON arrays. In the cache, we store instead:
+
+    header | model | photo id | probs as packed float16 (or float32)
+
+The classes, whether the model is multi-label, and its threshold are
+stored once per model in a Redis hash, and `preds` and `tags` are
+derived from the probabilities when reading.
+
+Predictions that would not decode back to the same `tags` and `preds`
+(e.g. a probability rounds across the threshold) are stored as JSON,
+which is also how older cache entries are read.
+
+Packed entries cannot be decoded without their schema, so the schema
+hash must never expire: do not set a TTL on it, and use a `volatile-*`
+maxmemory policy (prediction entries always have a TTL) so Redis never
+evicts it. If it is lost anyway, each process writes its schemas again
+within `resave_sec`, or right away once it failed to find one.
+
+`encode` and `decode` read and write schemas with the synchronous
+client. On an event loop, call `asave_schemas` or `aload_schemas` with
+an asyncio client first, then encode with `save=False` and decode with
+`load=False`, which never do I/O.
+"""
+import hashlib
+import logging
+import struct
+import time
+import numpy as np
+import orjson
+
+from zita.serve.backends import DEFAULT_THRESH
+
+logger = logging.getLogger('zita.serve')
+
+MAGIC = b'ZP'
+VERSION = 1
+# magic, version, dtype, schema id, length of model name, length of photo id
+HEADER = struct.Struct('<2sBc8sHH')
+DTYPES = {
+    'float16': b'e',
+    'float32': b'f',
+}
+
+
+def value_schema_id(value):
+    """Schema id of a packed prediction, None for JSON values"""
+    if not value.startswith(MAGIC) or len(value) < HEADER.size:
+        return None
+    return HEADER.unpack_from(value)[3]
+
+
+class PredictionCodec(object):
+    """Encode prediction dicts to compact bytes and back
+
+    Parameters
+    ----------
+        client:   Redis client to store the model schemas with
+        key:      name of the Redis hash of schemas
+        dtype:    "float16" or "float32", how to pack probabilities
+        thresh:   threshold of multi-label models
+        resave_sec:  seconds before a schema is written to Redis again
+                  when it is used, in case the hash was flushed
+    """
+
+    def __init__(self, client, key, dtype='float16', thresh=DEFAULT_THRESH,
+                 resave_sec=60):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unsupported dtype: {dtype}")
+        self.client = client
+        self.key = key
+        self.dtype = dtype
+        self.thresh = thresh
+        self.resave_sec = resave_sec
+        # schema id -> schema dict
+        self.schemas = {}
+        # schema id -> when we last wrote it to Redis
+        self.saved = {}
+
+    def schema_id(self, schema):
+        return hashlib.blake2b(orjson.dumps(schema), digest_size=8).digest()
+
+    def schema(self, pred):
+        return {
+            'classes': list(pred['classes']),
+            'multi_label': isinstance(pred['preds'], list),
+            'thresh': self.thresh,
+        }
+
+    def _due(self, schema_id):
+        """Whether a schema should be written to Redis (again)"""
+        return time.monotonic() - self.saved.get(
+            schema_id, -self.resave_sec) >= self.resave_sec
+
+    def _missing(self, schema_id):
+        logger.warning('Prediction schema %s not found in %s',
+                       schema_id.hex(), self.key)
+        # the hash was flushed, write our schemas again on their
+        # next use
+        self.saved.clear()
+
+    def save_schema(self, schema, save=True):
+        schema_id = self.schema_id(schema)
+        if save and self._due(schema_id):
+            self.client.hsetnx(self.key, schema_id, orjson.dumps(schema))
+            self.saved[schema_id] = time.monotonic()
+        self.schemas[schema_id] = schema
+        return schema_id
+
+    def load_schema(self, schema_id, load=True):
+        schema = self.schemas.get(schema_id)
+        if schema is None and load:
+            data = self.client.hget(self.key, schema_id)
+            if data is None:
+                self._missing(schema_id)
+                return None
+            schema = self.schemas[schema_id] = orjson.loads(data)
+        return schema
+
+    async def asave_schemas(self, client, preds):
+        """Write the schemas of predictions that are due with an asyncio
+        client, so encoding them with `save=False` loses nothing"""
+        due = {}
+        for pred in preds:
+            if pred is not None:
+                schema = self.schema(pred)
+                schema_id = self.schema_id(schema)
+                if schema_id not in due and self._due(schema_id):
+                    due[schema_id] = schema
+        if not due:
+            return
+        pipe = client.pipeline(transaction=False)
+        for schema_id, schema in due.items():
+            pipe.hsetnx(self.key, schema_id, orjson.dumps(schema))
+        await pipe.execute()
+        now = time.monotonic()
+        for schema_id, schema in due.items():
+            self.schemas[schema_id] = schema
+            self.saved[schema_id] = now
+
+    async def aload_schemas(self, client, values):
+        """Read the schemas of encoded values that are not known yet with
+        an asyncio client, so decoding them with `load=False` works"""
+        ids = {value_schema_id(x) for x in values if x}
+        ids = [x for x in ids if x is not None and x not in self.schemas]
+        if not ids:
+            return
+        for schema_id, data in zip(ids, await client.hmget(self.key, ids)):
+            if data is None:
+                self._missing(schema_id)
+            else:
+                self.schemas[schema_id] = orjson.loads(data)
+
+    def derive(self, schema, probs):
+        """Tags and preds of the probabilities, like the backends'
+        `decode`"""
+        classes = schema['classes']
+        if schema['multi_label']:
+            preds = (probs >= schema['thresh']).astype(int).tolist()
+            tags = [c for c, x in zip(classes, preds) if x]
+        else:
+            preds = int(probs.argmax())
+            tags = classes[preds]
+        return tags, preds
+
+    def pack(self, pred, schema, dtype, save=True):
+        probs = np.asarray(pred['probs'], dtype=dtype)
+        if self.derive(schema, probs) != (pred['tags'], pred['preds']):
+            return None
+        model = pred['model'].encode('utf-8')
+        photo_id = pred['id'].encode('utf-8')
+        header = HEADER.pack(MAGIC, VERSION, DTYPES[dtype],
+                             self.save_schema(schema, save),
+                             len(model), len(photo_id))
+        return b''.join([header, model, photo_id, probs.tobytes()])
+
+    def encode(self, pred, save=True):
+        """Packed prediction. With `save=False`, its schema is not
+        written to Redis, see `asave_schemas`."""
+        schema = self.schema(pred)
+        for dtype in (self.dtype, 'float32'):
+            value = self.pack(pred, schema, dtype, save)
+            if value is not None:
+                return value
+        logger.debug('Could not pack prediction of %s, storing as JSON',
+                     pred['id'])
+        return orjson.dumps(pred)
+
+    def decode(self, value, load=True):
+        """The prediction dict, None if the model schema is gone. With
+        `load=False`, only known schemas are used, see
+        `aload_schemas`."""
+        if not value.startswith(MAGIC):
+            return orjson.loads(value)
+        _, version, dtype, schema_id, model_len, id_len = \
+            HEADER.unpack_from(value)
+        if version != VERSION:
+            return None
+        schema = self.load_schema(schema_id, load)
+        if schema is None:
+            return None
+        start = HEADER.size
+        model = value[start:start + model_len].decode('utf-8')
+        start += model_len
+        photo_id = value[start:start + id_len].decode('utf-8')
+        start += id_len
+        probs = np.frombuffer(value, dtype=dtype.decode('ascii'),
+                              offset=start)
+        tags, preds = self.derive(schema, probs)
+        return {
+            "id": photo_id,
+            "model": model,
+            "classes": schema['classes'],
+            "tags": tags,
+            "preds": preds,
+            "probs": probs.astype(float).tolist(),
+        }
+
+
+def migrate(client, codec, match, batch_size=1000):
+    """Re-encode JSON cache entries matching `match` with `codec`,
+    keeping their expiration.
+
+    Returns:
+        A dict with the number of keys scanned and converted, and
+        their size in bytes before and after.
+    """
+    stats = {'scanned': 0, 'converted': 0, 'bytes_before': 0,
+             'bytes_after': 0}
+    batch = []
+
+    def convert(keys):
+        with client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.get(key)
+                pipe.pttl(key)
+            # non-string keys fail with WRONGTYPE, skip them
+            results = pipe.execute(raise_on_error=False)
+        with client.pipeline(transaction=False) as pipe:
+            for key, value, ttl in zip(keys, results[::2], results[1::2]):
+                # a pttl of -2 means the key is gone, -1 never expires
+                if not isinstance(value, bytes) or value.startswith(MAGIC) \
+                        or ttl == -2:
+                    continue
+                new_value = codec.encode(orjson.loads(value))
+                if not new_value.startswith(MAGIC):
+                    continue
+                pipe.set(key, new_value, px=ttl if ttl > 0 else None)
+                stats['converted'] += 1
+                stats['bytes_before'] += len(value)
+                stats['bytes_after'] += len(new_value)
+            pipe.execute()
+
+    schema_key = codec.key.encode('utf-8')
+    for key in client.scan_iter(match, count=batch_size):
+        if key == schema_key:
+            continue
+        stats['scanned'] += 1
+        batch.append(key)
+        if len(batch) >= batch_size:
+            convert(batch)
+            batch = []
+    if batch:
+        convert(batch)
+    return stats
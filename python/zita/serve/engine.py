@@ -0,0 +1,145 @@
+"""
+Batched inference engine
+
+Instead of running `learn.predict` for each photo (one forward pass with
+batch size 1), preprocess images in parallel and stack them into a few
+large forward passes, then split the outputs back into per-photo dicts.
+
+All functions take a model backend (see `zita.serve.backends`).
+"""
+import logging
+import time
+import torch
+
+from zita.data.decode import photo_path, load_tensor
+from zita.data.tensor_cache import get_tensor_cache
+from zita.settings import PRED_BATCH_SIZE, TENSOR_CACHE_ROOT, TENSOR_CACHE_MB
+from zita.utils.metrics import Counter, Histogram
+
+logger = logging.getLogger('zita.serve')
+
+LOAD_SECONDS = Histogram(
+    'zita_image_load_seconds',
+    'Time to decode and preprocess the images of one batch', ['model'])
+FORWARD_SECONDS = Histogram(
+    'zita_forward_seconds',
+    'Time of the forward passes of one batch', ['model'])
+PREDICTED_IMAGES = Counter(
+    'zita_predicted_images', 'Number of images predicted', ['model'])
+
+
+def preprocess(backend, photo_id):
+    """Decode a photo straight to the model's input size and return
+    a [C, H, W] tensor ready to be stacked.
+
+    This skips fastai's item transforms: for validation sets they only
+    resize and center crop, which `load_tensor` does after decoding
+    the JPEG at a reduced scale.
+    """
+    return load_inputs(backend, [photo_id])[0]
+
+
+def get_input_cache(size):
+    """The tensor cache for an input size, None if disabled"""
+    if not TENSOR_CACHE_ROOT:
+        return None
+    return get_tensor_cache(TENSOR_CACHE_ROOT, size,
+                            max_bytes=TENSOR_CACHE_MB * 1024 * 1024)
+
+
+def input_size(backend):
+    """The (height, width) of the model's inputs"""
+    return backend.input_size
+
+
+def load_inputs(backend, photo_ids, runner=None):
+    """Decode photos to input tensors, in parallel if a runner is given.
+    Tensors already in the tensor cache are not decoded again."""
+    size = input_size(backend)
+    paths = [photo_path(x) for x in photo_ids]
+    cache = get_input_cache(size)
+    if cache is None:
+        xs = [None] * len(paths)
+    else:
+        xs = cache.get_many(paths)
+    missing = [i for i, x in enumerate(xs) if x is None]
+
+    def load(path):
+        x = load_tensor(path, size)
+        if cache is not None:
+            cache.put(path, x)
+        return x
+
+    missing_paths = [paths[i] for i in missing]
+    if runner is None:
+        loaded = [load(x) for x in missing_paths]
+    else:
+        loaded = runner.run(load, missing_paths)
+    for i, x in zip(missing, loaded):
+        xs[i] = x
+    return xs
+
+
+def forward(backend, xb):
+    """Run one forward pass for a stacked batch of inputs,
+    returns activated predictions on CPU"""
+    return backend.forward(xb)
+
+
+def warmup(backend, bs=1):
+    """Run a forward pass on a dummy batch. The first forward pass
+    of a model is much slower than the following ones."""
+    h, w = input_size(backend)
+    forward(backend, torch.zeros(bs, 3, h, w))
+
+
+def predict_inputs(backend, xs, bs=PRED_BATCH_SIZE):
+    """Predict a list of preprocessed tensors in batches of `bs`"""
+    all_probs = []
+    for start in range(0, len(xs), bs):
+        xb = torch.stack(xs[start:start + bs])
+        all_probs.extend(forward(backend, xb))
+    return all_probs
+
+
+def format_pred(backend, model, photo_id, probs):
+    """Convert raw probabilities to a prediction dict"""
+    tags, preds = backend.decode(probs)
+    return {
+        "id": photo_id,
+        "model": model,
+        "classes": backend.classes,
+        "tags": tags,
+        "preds": preds.to(int).tolist(),
+        "probs": probs.tolist()
+    }
+
+
+def predict_photos(backend, model, photo_ids, bs=PRED_BATCH_SIZE,
+                   runner=None):
+    """Predict a list of photos with batched forward passes
+
+    Args:
+        backend : a loaded model backend
+        model : name of the model, will be saved in the results
+        photo_ids : Photo Ids (dir/name.jpg) we use to find photos
+                    in ALBUMS_ROOT.
+        bs : max number of images in one forward pass
+        runner : a ParallelRunner to load and preprocess images with
+
+    Returns:
+        Prediction results as a list of dictionaries, in the same
+        order as `photo_ids`.
+    """
+    t = time.time()
+    xs = load_inputs(backend, photo_ids, runner=runner)
+    tt = time.time()
+    all_probs = predict_inputs(backend, xs, bs=bs)
+    ttt = time.time()
+    logger.debug('Loaded %d images in %.3f secs, forward in %.3f secs',
+                 len(xs), tt - t, ttt - tt)
+    LOAD_SECONDS.labels(model).observe(tt - t)
+    FORWARD_SECONDS.labels(model).observe(ttt - tt)
+    PREDICTED_IMAGES.labels(model).inc(len(xs))
+    return [format_pred(backend, model, photo_id, probs)
+            for photo_id, probs in zip(photo_ids, all_probs)]
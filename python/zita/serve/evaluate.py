@@ -1,17 +1,23 @@
-import threading
 import itertools
 import os
 import logging
+import time
 import pandas as pd
 import numpy as np
+import torch
 
-from zita.data import get_labels
+from pathlib import Path
+
+from zita.data import get_labels, src_from_csv
+from zita.data.label_matrix import LabelMatrix, get_label_matrix
 from zita.utils.parallel_runner import ParallelRunner
-from zita.serve.predict import list_learners, get_learner
-from zita.serve.predict import predict, batch_predict
+from zita.serve.engine import load_inputs, predict_inputs
+from zita.serve.predict import list_learners, learner_pool
+from zita.serve.predict import predict
 from tqdm import tqdm_notebook
 
-from zita.settings import ALBUMS_ROOT, MODELS_ROOT
+from zita.settings import ALBUMS_ROOT, MODELS_ROOT, LABELS_CSV, \
+    PRED_BATCH_SIZE
 
 logger = logging.getLogger('zita.serve')
 
@@ -38,12 +44,13 @@ def predict_all_ds(model, ds):
     results = [None for _ in ds]
 
     def learn_predict(arg, name):
-        learn = get_learner(model, cache_id=threading.get_ident())
         if len(arg) > 1:
             image, y = arg
         else:
             image = arg[0]
-        y_pred, preds, probs = learn.predict(image)
+        # learn.predict is not thread-safe, check out a replica
+        with learner_pool.checkout(model) as backend:
+            y_pred, preds, probs = backend.learn.predict(image)
         return {
             "id": name,
             "model": model,
@@ -53,7 +60,8 @@ def predict_all_ds(model, ds):
             "probs": probs.tolist()
         }
 
-    with ParallelRunner(max_workers=os.cpu_count()) as runner:
+    # each prediction holds a replica, more threads would only wait
+    with ParallelRunner(max_workers=learner_pool.replicas) as runner:
         iterator = runner.map(learn_predict, ds, ds.photo_ids)
         for i, pred in enumerate(iterator):
             progress.update(1)
@@ -75,28 +83,37 @@ def predict_all_models(items, models=list_learners(), skip_stage1=True):
     return results
 
 
-def find_best_model(results, ds):
+def pred_matrix(preds):
+    """[photos, classes] matrix of a column of predicted labels: lists,
+    or strings of them as `save_preds` writes them ("0 1" or "[0, 1]"),
+    parsed all at once"""
+    values = preds.tolist()
+    if values and isinstance(values[0], str):
+        text = ' '.join(values)
+        for c in '[],':
+            text = text.replace(c, ' ')
+        values = text.split()
+    return np.array(values, dtype=np.int64).reshape(len(preds), -1)
+
+
+def find_best_model(results, ds, labels_csv=LABELS_CSV):
     highest_oacc = 0
     best_model = None
     folder = str(ALBUMS_ROOT)
+    photo_ids = {x.replace(folder + '/', '') for x in ds.photo_ids}
+    classes = list(ds.y.classes)
+    labels = get_label_matrix(labels_csv)
 
     for model, df in results.items():
-        df['truth'] = df['truth'].apply(lambda x: ' '.join(sorted(x.split(','))))
-        df = df.merge(pd.DataFrame({
-            'id': [x.replace(folder + '/', '') for x in ds.photo_ids],
-            'y': ds.y.photo_ids
-        }), on='id')
+        df = df[df['id'].isin(photo_ids)]
+        # true labels in the order of the predicted ones
+        truth = labels.dense(df['id'].tolist(), classes)
+        preds = pred_matrix(df['preds'])
 
         # accurately predict all tags for each photo
-        acc = (df['tags'] == df['truth']).mean()
+        acc = (truth == preds).all(axis=1).mean()
 
         # overall accuracy
-        preds = df['preds'].str.split(' ')
-        preds = np.array(preds.tolist()).astype(int)
-        truth = np.zeros_like(preds)
-
-        for i, x in enumerate(df['y']):
-            truth[i, x] = 1
         oacc = (truth == preds).mean()
 
         print(f'{model:s} - {acc:.4f} - {oacc:.4f}')
@@ -132,3 +149,57 @@ def load_preds(path=MODELS_ROOT, suffix="-preds", skip_stage1=True):
             logger.error(e, exc_info=True)
             pass
     return dat
+
+
+def validation_set(path=ALBUMS_ROOT, labels_csv=LABELS_CSV, **kwargs):
+    """The validation split used in training (see `load_dataset`)
+
+    Returns:
+        photo_ids : photo IDs relative to `path`
+        labels : list of tags for each photo
+    """
+    src = src_from_csv(path, labels_csv, **kwargs)
+    valid = src.valid
+    photo_ids = [str(Path(x).relative_to(path)) for x in valid.x.items]
+    classes = valid.y.classes
+    labels = [[classes[i] for i in y] for y in valid.y.items]
+    return photo_ids, labels
+
+
+def evaluate_backend(backend, photo_ids, labels, thresh=0.5, beta=2,
+                     bs=PRED_BATCH_SIZE):
+    """Score a model backend on labelled photos with the same batched
+    engine used for serving.
+
+    Args:
+        labels : list of tags of each photo, or a LabelMatrix with
+                 the photos
+
+    Returns:
+        A dict of accuracy (per label, like `accuracy_thresh`), F-beta
+        (averaged over photos, like fastai's `fbeta`) and inference
+        latency per image.
+    """
+    if not isinstance(labels, LabelMatrix):
+        labels = LabelMatrix.from_tags(photo_ids, labels)
+    y_true = torch.from_numpy(
+        labels.dense(photo_ids, backend.classes)).float()
+
+    with ParallelRunner(max_workers=os.cpu_count()) as runner:
+        xs = load_inputs(backend, photo_ids, runner=runner)
+    t = time.time()
+    probs = torch.stack(predict_inputs(backend, xs, bs=bs))
+    elapsed = time.time() - t
+
+    y_pred = (probs >= thresh).float()
+    tp = (y_pred * y_true).sum(dim=1)
+    precision = tp / (y_pred.sum(dim=1) + 1e-9)
+    recall = tp / (y_true.sum(dim=1) + 1e-9)
+    beta2 = beta ** 2
+    fbeta = (1 + beta2) * precision * recall / \
+        (beta2 * precision + recall + 1e-9)
+    return {
+        'accuracy': (y_pred == y_true).float().mean().item(),
+        'fbeta': fbeta.mean().item(),
+        'secs_per_image': elapsed / max(1, len(photo_ids)),
+    }
@@ -0,0 +1,146 @@
+"""
+Cross-request dynamic micro-batching
+
+Concurrent single-photo predictions for the same model are held for a
+few milliseconds (or until a max batch size is reached) and then run
+as one batch. Each caller still gets its own result.
+"""
+import logging
+import threading
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from zita.utils.metrics import Gauge, Histogram
+
+logger = logging.getLogger('zita.serve')
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+QUEUE_DEPTH = Gauge(
+    'zita_microbatch_queue_depth',
+    'Number of requests waiting to be batched', ['model'])
+BATCH_SIZE = Histogram(
+    'zita_microbatch_batch_size',
+    'Number of requests coalesced into one batch', ['model'],
+    buckets=BATCH_SIZE_BUCKETS)
+QUEUE_WAIT = Histogram(
+    'zita_microbatch_wait_seconds',
+    'Time requests spent waiting in the queue', ['model'])
+
+
+class MicroBatcher(object):
+    """Coalesce single-item calls into batch calls
+
+    Parameters
+    ----------
+        run_batch: the batch function, called as `run_batch(key, items)`,
+                   must return a list of results in the same order.
+        max_wait_ms: how long to hold the first request of a batch.
+        max_batch_size: run the batch right away once it has this
+                        many requests.
+        max_concurrency: how many batches may run at the same time.
+    """
+
+    def __init__(self, run_batch, max_wait_ms=5, max_batch_size=64,
+                 max_concurrency=2, name='MicroBatcher'):
+        self.run_batch = run_batch
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.name = name
+        self._queues = {}
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix=name)
+        self._dispatcher = None
+
+    def submit(self, key, item):
+        """Queue one item, returns a Future for its result"""
+        future = Future()
+        with self._cond:
+            queue = self._queues.setdefault(key, [])
+            queue.append((item, future, time.time()))
+            QUEUE_DEPTH.labels(key).set(len(queue))
+            self._ensure_dispatcher()
+            self._cond.notify()
+        return future
+
+    def __call__(self, key, item):
+        if self.max_wait <= 0:
+            return self.run_batch(key, [item])[0]
+        return self.submit(key, item).result()
+
+    def stats(self):
+        """Queue depth and batch size histogram for each key"""
+        with self._cond:
+            depths = {key: len(queue) for key, queue in self._queues.items()}
+        return {
+            key: {
+                'queue_depth': depth,
+                'batch_sizes': BATCH_SIZE.labels(key).snapshot(),
+            }
+            for key, depth in depths.items()
+        }
+
+    def _ensure_dispatcher(self):
+        if self._dispatcher is None:
+            self._dispatcher = threading.Thread(
+                target=self._dispatch, name=self.name, daemon=True)
+            self._dispatcher.start()
+
+    def _pop_ready(self):
+        """Pop all batches that are ready to run. Returns the list of
+        ready batches and seconds until the next batch is due."""
+        now = time.time()
+        ready, timeout = [], None
+        for key, queue in self._queues.items():
+            while queue:
+                due = queue[0][2] + self.max_wait - now
+                if len(queue) < self.max_batch_size and due > 0:
+                    timeout = due if timeout is None else min(timeout, due)
+                    break
+                batch = queue[:self.max_batch_size]
+                del queue[:self.max_batch_size]
+                ready.append((key, batch))
+            QUEUE_DEPTH.labels(key).set(len(queue))
+        return ready, timeout
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                ready, timeout = self._pop_ready()
+                if not ready:
+                    self._cond.wait(timeout)
+                    continue
+            for key, batch in ready:
+                self._executor.submit(self._run, key, batch)
+
+    def _run(self, key, batch):
+        now = time.time()
+        items = [item for item, _, _ in batch]
+        futures = [future for _, future, _ in batch]
+        BATCH_SIZE.labels(key).observe(len(batch))
+        for _, _, queued_at in batch:
+            QUEUE_WAIT.labels(key).observe(now - queued_at)
+        logger.debug('Coalesced %d requests for %s after %.1f ms',
+                     len(batch), key, (now - batch[0][2]) * 1000)
+        try:
+            results = self.run_batch(key, items)
+        except Exception as error:
+            if len(batch) == 1:
+                futures[0].set_exception(error)
+                return
+            # one bad item (e.g. a missing photo) should not fail
+            # the other callers, retry them one by one
+            logger.debug('Batch failed (%s), retrying one by one', error)
+            for item, future in zip(items, futures):
+                self._run_one(key, item, future)
+            return
+        for future, result in zip(futures, results):
+            future.set_result(result)
+
+    def _run_one(self, key, item, future):
+        try:
+            future.set_result(self.run_batch(key, [item])[0])
+        except Exception as error:
+            future.set_exception(error)
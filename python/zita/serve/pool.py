@@ -0,0 +1,213 @@
+"""
+Bounded, memory-aware pool of learners
+
+Keeps one shared, read-only copy of each model per process (or a
+fixed number of replicas), with checkout/return semantics. Models
+are evicted by the memory they use rather than by entry count.
+"""
+import logging
+import threading
+import time
+import torch
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from queue import Queue, Empty
+
+logger = logging.getLogger('zita.serve')
+
+
+def _tensors(value):
+    """Tensors in a `state_dict` value"""
+    if torch.is_tensor(value):
+        yield value
+    elif isinstance(value, (tuple, list)):
+        for x in value:
+            yield from _tensors(x)
+    elif hasattr(value, 'unpack'):
+        # packed weights of quantized layers, in older PyTorch versions
+        yield from _tensors(value.unpack())
+
+
+def learner_nbytes(learn):
+    """Memory used by a learner's model: the tensors of its
+    `state_dict`, which also has the packed weights of quantized
+    layers that are not parameters or buffers"""
+    model = getattr(learn, 'model', None)
+    if model is None:
+        return 0
+    tensors = {}
+    for value in model.state_dict(keep_vars=True).values():
+        # tied weights are counted once
+        tensors.update((id(x), x) for x in _tensors(value))
+    return sum(x.numel() * x.element_size() for x in tensors.values())
+
+
+class PoolEntry(object):
+    """All loaded replicas of one model"""
+
+    def __init__(self, model):
+        self.model = model
+        self.lock = threading.Lock()
+        self.replicas = []
+        self.idle = Queue()
+        self.in_use = 0
+        self.nbytes = 0
+        self.last_used = time.time()
+
+
+class LearnerPool(object):
+    """Pool of loaded learners
+
+    Parameters
+    ----------
+        load:       function to load a learner by model name.
+        replicas:   max number of copies of each model, each checkout
+                    gets exclusive use of one copy.
+        max_bytes:  evict least recently used models that are not
+                    checked out once loaded models use more memory
+                    than this.
+        sizeof:     function to measure memory used by a learner.
+    """
+
+    def __init__(self, load, replicas=1, max_bytes=None,
+                 sizeof=learner_nbytes):
+        self.load = load
+        self.replicas = max(1, replicas)
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        return sum(x.nbytes for x in list(self._entries.values()))
+
+    def models(self):
+        return list(self._entries.keys())
+
+    def _entry(self, model):
+        with self._lock:
+            entry = self._entries.get(model)
+            if entry is None:
+                entry = self._entries[model] = PoolEntry(model)
+            self._entries.move_to_end(model)
+            entry.last_used = time.time()
+            return entry
+
+    def _add_replica(self, entry):
+        """Load a new replica, must hold `entry.lock`"""
+        t = time.time()
+        learn = self.load(entry.model)
+        nbytes = self.sizeof(learn)
+        entry.replicas.append(learn)
+        entry.nbytes += nbytes
+        logger.info('Loaded learner %s #%d (%.1f MB) in %.3f secs',
+                    entry.model, len(entry.replicas), nbytes / 1e6,
+                    time.time() - t)
+        return learn
+
+    def get(self, model):
+        """Get the shared (first) replica of a model without checking
+        it out. Only use it for read-only operations."""
+        entry = self._entry(model)
+        if not entry.replicas:
+            with entry.lock:
+                if not entry.replicas:
+                    try:
+                        entry.idle.put(self._add_replica(entry))
+                    except Exception:
+                        self._discard(entry)
+                        raise
+            self.evict()
+        return entry.replicas[0]
+
+    @contextmanager
+    def checkout(self, model):
+        """Exclusively use one replica of a model in a `with` block"""
+        entry = self._entry(model)
+        learn = self._acquire(entry)
+        try:
+            yield learn
+        finally:
+            entry.last_used = time.time()
+            with entry.lock:
+                entry.in_use -= 1
+            entry.idle.put(learn)
+            # models skipped by eviction while checked out
+            self.evict()
+
+    def _acquire(self, entry):
+        loaded = False
+        with entry.lock:
+            entry.in_use += 1
+            try:
+                learn = entry.idle.get_nowait()
+            except Empty:
+                learn = None
+                if len(entry.replicas) < self.replicas:
+                    try:
+                        learn = self._add_replica(entry)
+                    except Exception:
+                        entry.in_use -= 1
+                        self._discard(entry)
+                        raise
+                    loaded = True
+        if loaded:
+            self.evict()
+        if learn is None:
+            # wait for another thread to return a replica
+            learn = entry.idle.get()
+        return learn
+
+    def _discard(self, entry):
+        """Drop an entry that failed to load its first replica"""
+        with self._lock:
+            if not entry.replicas and \
+                    self._entries.get(entry.model) is entry:
+                del self._entries[entry.model]
+
+    def put(self, model, learn):
+        """Replace all replicas of a model with a new learner"""
+        nbytes = self.sizeof(learn)
+        entry = PoolEntry(model)
+        entry.replicas.append(learn)
+        entry.nbytes = nbytes
+        entry.idle.put(learn)
+        with self._lock:
+            # in-flight checkouts of the old entry return their
+            # learners to the old queue, which is then dropped
+            self._entries[model] = entry
+            self._entries.move_to_end(model)
+        self.evict()
+
+    def remove(self, model):
+        with self._lock:
+            return self._entries.pop(model, None)
+
+    def evict(self):
+        """Evict least recently used models until the pool fits
+        in `max_bytes`. Models that are checked out are kept."""
+        if not self.max_bytes:
+            return
+        with self._lock:
+            total = sum(x.nbytes for x in self._entries.values())
+            for model, entry in list(self._entries.items())[:-1]:
+                if total <= self.max_bytes:
+                    break
+                if entry.in_use:
+                    continue
+                del self._entries[model]
+                total -= entry.nbytes
+                logger.info('Evicted learner %s (%.1f MB)', model,
+                            entry.nbytes / 1e6)
+
+    def stats(self):
+        return {
+            model: {
+                'replicas': len(entry.replicas),
+                'in_use': entry.in_use,
+                'nbytes': entry.nbytes,
+            }
+            for model, entry in list(self._entries.items())
+        }
@@ -3,115 +3,217 @@
 """
 Serve the Image Classifier
 """
+import asyncio
 import logging
-import time
 import threading
-import itertools
-import os
-import pandas as pd
+import time
 
-from functools import lru_cache
-from fastai.basic_train import load_learner
-from fastai.vision import ImageList, DatasetType
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
-from zita.data import get_image, get_labels, src_from_photo_ids
-from zita.settings import MODELS_ROOT, NUM_PRED_WORKERS, PRED_EXPIRE_SEC
+from zita.settings import MODELS_ROOT, NUM_PRED_WORKERS, PRED_EXPIRE_SEC, \
+    PRED_BATCH_SIZE, PRED_BATCH_WAIT_MS, LEARNER_REPLICAS, LEARNER_POOL_MB, \
+    DEFAULT_MODEL, PRELOAD_MODELS, PRED_BACKEND, PRED_CACHE_DTYPE
 from zita.serve.redis import store
+from zita.serve.redis_async import astore
+from zita.serve.backends import load_backend, MODEL_SUFFIXES
+from zita.serve.codec import PredictionCodec
+from zita.serve.engine import predict_photos
+from zita.serve.microbatch import MicroBatcher
+from zita.serve.pool import LearnerPool
+from zita.serve.registry import ModelRegistry
+from zita.utils.metrics import REGISTRY, Gauge
 from zita.utils.parallel_runner import ParallelRunner
 
 logger = logging.getLogger('zita.serve')
-prunner = ParallelRunner(max_workers=NUM_PRED_WORKERS)
+prunner = ParallelRunner(max_workers=NUM_PRED_WORKERS, name='decode')
+# runs batch predictions for coroutines
+pred_executor = ThreadPoolExecutor(max_workers=NUM_PRED_WORKERS,
+                                   thread_name_prefix="Predict")
 CACHE_KEY_PREFIX = "zita.pred"
+# cached predictions are stored as packed probabilities, classes are
+# stored once per model in this hash
+pred_codec = PredictionCodec(store.client, f"{CACHE_KEY_PREFIX}.schemas",
+                             dtype=PRED_CACHE_DTYPE)
+
+
+def load_model(model):
+    """Load a model with the backend set by ZT_PRED_BACKEND"""
+    return load_backend(model, MODELS_ROOT, PRED_BACKEND)
+
+
+# one shared copy of each model per process (or LEARNER_REPLICAS copies)
+learner_pool = LearnerPool(load_model, replicas=LEARNER_REPLICAS,
+                           max_bytes=LEARNER_POOL_MB * 1024 * 1024)
+# preload, warm up and hot reload models, call `registry.start()`
+# when the server starts
+registry = ModelRegistry(learner_pool, load_model,
+                         models=[DEFAULT_MODEL, *PRELOAD_MODELS])
+
+
+def model_namespace(args):
+    """Cached predictions are namespaced by model version, so a
+    retrained model never serves the old model's predictions"""
+    model = args[0]
+    version = registry.version(model)
+    return f'{model}@{version}' if version else None
+
+
+def cached_versions(model=None):
+    """Cache namespaces ("model@version") with predictions"""
+    return [ns for ns in store.namespaces(CACHE_KEY_PREFIX)
+            if model is None or ns.rpartition('@')[0] == model]
+
+
+def drop_cached(namespace, pause=0):
+    """Drop all cached predictions of a model version"""
+    return store.drop_namespace(CACHE_KEY_PREFIX, namespace, pause=pause)
+
+
+def drop_old_versions(model, digest):
+    """Drop cached predictions of other versions of a model, slowly,
+    to not block Redis for other clients"""
+    current = f'{model}@{digest}'
+    try:
+        for ns in cached_versions(model):
+            if ns != current:
+                dropped = drop_cached(ns, pause=0.01)
+                logger.info('Dropped %d cached predictions of %s',
+                            dropped, ns)
+    except Exception as e:
+        logger.error('Could not drop old predictions of %s: %s', model, e)
+
+
+def expire_old_versions(model, digest):
+    threading.Thread(target=drop_old_versions, args=(model, digest),
+                     name="CacheExpiry", daemon=True).start()
+
+
+registry.listeners.append(expire_old_versions)
+
+
+MODEL_BYTES = Gauge(
+    'zita_model_bytes', 'Memory used by the loaded copies of a model',
+    ['model'])
+MODEL_REPLICAS = Gauge(
+    'zita_model_replicas', 'Loaded copies of a model, by state',
+    ['model', 'state'])
+
 
-# cache two models in memory for each worker
-@lru_cache(maxsize=NUM_PRED_WORKERS * 2)
-def get_learner(model, cache_id=1):
-    filename = f"{model}.pkl"
-    fullpath = MODELS_ROOT/filename
-    if not fullpath.exists():
-        # logger.error('Learner does not exist: %s', fullpath)
-        raise ValueError(f"No such learner: {model}")
-    learn = load_learner(MODELS_ROOT, filename)
-    # if hasattr(learn.model, 'module'):
-    #     learn.model = learn.model.module
-    return learn
+@REGISTRY.on_collect
+def collect_pool_stats():
+    MODEL_BYTES.clear()
+    MODEL_REPLICAS.clear()
+    for model, stats in learner_pool.stats().items():
+        MODEL_BYTES.labels(model).set(stats['nbytes'])
+        MODEL_REPLICAS.labels(model, 'in_use').set(stats['in_use'])
+        MODEL_REPLICAS.labels(model, 'idle').set(
+            stats['replicas'] - stats['in_use'])
+
+
+def get_learner(model, cache_id=None):
+    """Get the shared backend of a model (see `zita.serve.backends`).
+    Use it for read-only operations, or `learner_pool.checkout(model)`
+    for exclusive access.
+
+    `cache_id` is ignored, it is kept for backward compatibility
+    """
+    return learner_pool.get(model)
 
 
 # List all trained learners under MODELS_ROOT
-def list_learners(root=MODELS_ROOT):
+def list_learners(root=MODELS_ROOT, backend=PRED_BACKEND):
+    suffix = MODEL_SUFFIXES[backend]
     return sorted([p.name.replace(p.suffix, '')
                    for p in root.iterdir()
-                   if p.suffix == '.pkl'])
+                   if p.suffix == suffix])
+
 
+def _predict_batch(model, photo_ids):
+    with learner_pool.checkout(model) as learn:
+        return predict_photos(learn, model, photo_ids, runner=prunner)
 
-@store.cache(expire=PRED_EXPIRE_SEC, key=CACHE_KEY_PREFIX)
+
+# coalesce concurrent single-photo predictions into batches, as many
+# batches as there are replicas to run them
+batcher = MicroBatcher(_predict_batch, max_wait_ms=PRED_BATCH_WAIT_MS,
+                       max_batch_size=PRED_BATCH_SIZE,
+                       max_concurrency=LEARNER_REPLICAS,
+                       name='PredictBatcher')
+
+
+@store.cache(expire=PRED_EXPIRE_SEC, key=CACHE_KEY_PREFIX,
+             serialize=pred_codec.encode, deserialize=pred_codec.decode,
+             namespace=model_namespace)
 def predict(model, photo_id):
-    """Predict labels for one photo"""
-    # each thread uses a different learner cache
-    learn = get_learner(model, cache_id=threading.get_ident())
-    image = get_image(photo_id)
-    y, preds, probs = learn.predict(image)
-    return {
-        "id": photo_id,
-        "model": model,
-        "classes": learn.data.classes,
-        "tags": y.obj,
-        "preds": preds.to(int).tolist(),
-        "probs": probs.tolist()
-    }
+    """Predict labels for one photo
 
+    Concurrent calls for the same model are batched together
+    by `batcher`.
+    """
+    return batcher(model, photo_id)
 
-@store.mcache(expire=PRED_EXPIRE_SEC, mini_batch_size=100,
-              key=CACHE_KEY_PREFIX, autocache=False, cache_first=True)
-def batch_predict(model, photo_ids):
-    """Run predictions in parallel"""
 
+@store.mcache(expire=PRED_EXPIRE_SEC, mini_batch_size=100,
+              key=CACHE_KEY_PREFIX, cache_first=True,
+              serialize=pred_codec.encode, deserialize=pred_codec.decode,
+              namespace=model_namespace)
+def batch_predict(model, photo_ids, bs=PRED_BATCH_SIZE):
+    """Run predictions in stacked batches.
+
+    Images are loaded and preprocessed in worker threads, then fed
+    to the model `bs` images at a time.
+    """
     logger.debug('Predicting %d photos..', len(photo_ids))
     t = time.time()
-    # run in multithread mode
-    logger.debug('Run predictions in %d worker threads..',
-                 prunner._executor._max_workers)
-    results = prunner.run(predict, itertools.repeat(model), photo_ids)
+    with learner_pool.checkout(model) as learn:
+        results = predict_photos(learn, model, photo_ids, bs=bs,
+                                 runner=prunner)
     tt = time.time()
     logger.debug('Prediction finished in %.3f seconds', tt - t)
 
     return results
 
 
+@astore.cache(expire=PRED_EXPIRE_SEC, key=CACHE_KEY_PREFIX,
+              codec=pred_codec, namespace=model_namespace)
+async def apredict(model, photo_id):
+    """`predict` for coroutines, shares its cache"""
+    if batcher.max_wait > 0:
+        return await asyncio.wrap_future(batcher.submit(model, photo_id))
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(pred_executor, batcher, model, photo_id)
+
+
+@astore.mcache(expire=PRED_EXPIRE_SEC, mini_batch_size=100,
+               key=CACHE_KEY_PREFIX, cache_first=True,
+               codec=pred_codec, namespace=model_namespace)
+async def abatch_predict(model, photo_ids, bs=PRED_BATCH_SIZE):
+    """`batch_predict` for coroutines, shares its cache"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        pred_executor, partial(batch_predict.nocache, model, photo_ids, bs=bs))
+
+
 @store.mcache(expire=PRED_EXPIRE_SEC, mini_batch_size=1280,
-              key=CACHE_KEY_PREFIX, cache_first=False)
-def native_batch_predict(model, photo_ids):
-    """Predict in native fastai batches. Useful
-    when you want to run predictions on a very large set of data
+              key=CACHE_KEY_PREFIX, cache_first=False,
+              serialize=pred_codec.encode, deserialize=pred_codec.decode,
+              namespace=model_namespace)
+def native_batch_predict(model, photo_ids, bs=None, runner=None):
+    """Predict in large batches. Useful when you want to run
+    predictions on a very large set of data
 
     Args:
-        ds : an ImageList dataset
         photo_ids : Photo Ids (dir/name.jpg) we use to find photos
                     in ALBUMS_ROOT.
+        bs : batch size, defaults to the learner's DataBunch batch size
+        runner : ParallelRunner to decode images with
 
     Returns:
         Prediction results as a list of dictionaries
     """
-    learn = get_learner(model)
-    ds = src_from_photo_ids(photo_ids)
-    # Run batch tests in fastai
-    learn.data.add_test(ds)
-    classes = learn.data.classes
-    ds = learn.data.single_ds
-
     logger.info('Predicting %d photos with native batch..', len(photo_ids))
-
-    all_probs, _ = learn.get_preds(DatasetType.Test)
-    results = []
-    for photo_id, probs in zip(photo_ids, all_probs):
-        preds = ds.y.analyze_pred(probs)
-        results.append({
-            'id': photo_id,
-            'model': model,
-            'classes': classes,
-            'tags': ds.y.reconstruct(preds).obj,
-            'preds': preds.tolist(),
-            'probs': probs.tolist(),
-        })
-    return results
-
+    with learner_pool.checkout(model) as learn:
+        return predict_photos(learn, model, photo_ids,
+                              bs=bs or learn.batch_size,
+                              runner=runner or prunner)
@@ -3,16 +3,62 @@ Redis helpers
 """
 import orjson
 import logging
-import asyncio
+import time
+import uuid
 
 from threading import Thread
 from redis import Redis
 from functools import wraps
-from zita.settings import REDIS_URL
+from zita.settings import REDIS_URL, L1_CACHE_SIZE, L1_CACHE_TTL, \
+    L1_CACHE_CHANNEL, REFILL_WORKERS, REFILL_MAX_PENDING, REFILL_LEASE_SEC
+from zita.serve.refill import RefillQueue
+from zita.utils.metrics import REGISTRY, Counter, Gauge, Histogram
+from zita.utils.ttl_cache import TTLCache
 
 
 logger = logging.getLogger('zita.redis')
 
+CACHE_LOOKUPS = Counter(
+    'zita_cache_lookups',
+    'Cache lookups by tier (local or redis) and result', ['tier', 'result'])
+LOCAL_HITS = CACHE_LOOKUPS.labels('local', 'hit')
+LOCAL_MISSES = CACHE_LOOKUPS.labels('local', 'miss')
+REDIS_HITS = CACHE_LOOKUPS.labels('redis', 'hit')
+REDIS_MISSES = CACHE_LOOKUPS.labels('redis', 'miss')
+MGET_KEYS = Histogram(
+    'zita_redis_mget_keys', 'Number of keys read with one MGET',
+    buckets=(1, 10, 50, 100, 500, 1000, 5000))
+CODEC_SECONDS = Histogram(
+    'zita_cache_codec_seconds',
+    'Time spent encoding or decoding the values of one cache call', ['op'],
+    buckets=(.0001, .0005, .001, .005, .01, .05, .1, .5, 1))
+ENCODE_SECONDS = CODEC_SECONDS.labels('encode')
+DECODE_SECONDS = CODEC_SECONDS.labels('decode')
+REFILL_PENDING = Gauge(
+    'zita_refill_pending', 'Number of cache keys waiting to be refilled')
+LOCAL_CACHE_SIZE = Gauge(
+    'zita_cache_local_size', 'Number of values in the in-process cache')
+
+
+def record_mget(values):
+    """Count hits and misses of the values read from Redis"""
+    misses = sum(1 for x in values if x is None)
+    MGET_KEYS.observe(len(values))
+    REDIS_HITS.inc(len(values) - misses)
+    REDIS_MISSES.inc(misses)
+
+
+# delete leases only if they are still ours
+RELEASE_LEASES = """
+local n = 0
+for _, key in ipairs(KEYS) do
+    if redis.call('get', key) == ARGV[1] then
+        n = n + redis.call('del', key)
+    end
+end
+return n
+"""
+
 
 def isiterable(arg):
     """Check if a variable is iterable and not a string"""
@@ -50,46 +96,50 @@ def gen_minibatch(items, bs):
         yield batch, start, end
 
 
-class WorkerThread(Thread):
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
-    def run(self, func, *args, **kwargs):
-        func(*args, **kwargs)
-
-
 class RedisStore(object):
-    """Cache Storage with redis"""
+    """Cache Storage with redis
+
+    Parameters
+    ----------
+        local_size:  max number of values to also keep in process memory,
+                     0 to always read from Redis. Writes are broadcast on
+                     `channel` so that other processes drop their local
+                     copies of the same keys.
+        local_ttl:   seconds before values in process memory expire, this
+                     bounds how stale they can get if an invalidation is
+                     lost.
+    """
 
     def __init__(self, client=None,
                  serialize=orjson.dumps,
                  deserialize=orjson.loads,
                  expire=None,
-                 allow_async=True):
+                 allow_async=True,
+                 local_size=L1_CACHE_SIZE,
+                 local_ttl=L1_CACHE_TTL,
+                 channel=L1_CACHE_CHANNEL):
         self.client = client or Redis.from_url(REDIS_URL)
         self.serialize = serialize
         self.deserialize = deserialize
         self.default_expire = expire  # seconds
+        self.id = uuid.uuid4().hex
+        self.channel = channel
+        # number of invalidations received, values read from Redis before
+        # an invalidation arrived may be stale and are not kept locally
+        self.generation = 0
+        self.local = None
+        if local_size > 0:
+            self.local = TTLCache(local_size, local_ttl)
+            Thread(target=self.listen, name="RedisInvalidation",
+                   daemon=True).start()
+        self._release_leases = self.client.register_script(RELEASE_LEASES)
         if allow_async:
-            loop = self.loop = asyncio.new_event_loop()
-
-            def exit_on_exception(context):
-                error = context.get('exception')
-                if error:
-                    # raise error from background tasks
-                    raise error
-
-            def start_worker():
-                asyncio.set_event_loop(loop)
-                loop.run_forever()
-
-            loop.default_exception_handler = exit_on_exception
-            worker = Thread(target=start_worker, name="RedisWorker")
-            logger.debug("Starting async worker for Redis cache store...")
-            worker.start()
+            # refills missing values of cache-first batch calls
+            self.refill = RefillQueue(self, max_workers=REFILL_WORKERS,
+                                      max_pending=REFILL_MAX_PENDING,
+                                      lease_sec=REFILL_LEASE_SEC)
         else:
-            self.worker = None
+            self.refill = None
 
     def serialize_to_str(self, val):
         ret = self.serialize(val)
@@ -97,14 +147,17 @@ class RedisStore(object):
             ret = ret.decode('utf-8')
         return ret
 
-    def deserialize_multi(self, values):
+    def deserialize_multi(self, values, deserialize=None):
+        deserialize = deserialize or self.deserialize
+        t = time.perf_counter()
         vals, na_idxs = [], []
         for i, x in enumerate(values):
-            if x:
-                vals.append(self.deserialize(x))
-            else:
-                vals.append(None)
+            # values that cannot be decoded anymore count as missing
+            val = deserialize(x) if x else None
+            vals.append(val)
+            if val is None:
                 na_idxs.append(i)
+        DECODE_SECONDS.observe(time.perf_counter() - t)
         return vals, na_idxs
 
     def genkey(self, key):
@@ -119,18 +172,207 @@ class RedisStore(object):
 
         return genkey
 
-    def get(self, key, raw=False):
-        value = self.client.get(key)
+    def keyfunc(self, prefix, namespace=None):
+        """Function of (args, kwargs) that returns the cache key of
+        a call, and the index (prefix, namespace) the key belongs to"""
+        genkey = self.genkey(prefix)
+
+        def keyfunc(args, kwargs):
+            ns = namespace(args) if namespace else None
+            if ns is None:
+                return genkey(args, kwargs), None
+            return self.genkey(f'{prefix}:{ns}')(args, kwargs), (prefix, ns)
+
+        return keyfunc
+
+    def batch_keyfunc(self, prefix, namespace=None):
+        """Function of the args before and after the list of items of
+        a batch call, that returns the key function of the items and
+        the index they belong to"""
+        default_genkey = self.genkey(prefix)
+
+        def keyfuncs(args1, args2):
+            ns = namespace([*args1, *args2]) if namespace else None
+            if ns is None:
+                return default_genkey, None
+            return self.genkey(f'{prefix}:{ns}'), (prefix, ns)
+
+        return keyfuncs
+
+    def listen(self):
+        """Drop local values other processes have changed, reconnects
+        until the process exits"""
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                # invalidations may have been missed while disconnected
+                self.generation += 1
+                self.local.clear()
+                for message in pubsub.listen():
+                    self.on_invalidate(message['data'])
+            except Exception as e:
+                logger.warning("Cache invalidation listener failed: %s", e)
+                time.sleep(1)
+
+    def on_invalidate(self, data):
+        message = orjson.loads(data)
+        if message.get('origin') == self.id:
+            return
+        self.generation += 1
+        keys = message.get('keys')
+        if keys is None:
+            self.local.clear()
+        else:
+            self.local.pop_many(keys)
+
+    def publish(self, client, keys):
+        """Tell other processes to drop their local copies of `keys`,
+        all keys if None"""
+        if self.local is None:
+            return
+        client.publish(self.channel, orjson.dumps({
+            'origin': self.id,
+            'keys': keys,
+        }))
+
+    def set_local(self, items, generation, ttl=None):
+        if self.local is not None and generation == self.generation:
+            self.local.set_many(items, ttl=ttl)
+
+    def mget(self, keys):
+        """Raw values of a list of keys, read from process memory
+        when possible"""
+        if not keys:
+            return []
+        if self.local is None:
+            values = self.client.mget(*keys)
+            record_mget(values)
+            return values
+        values = self.local.get_many(keys)
+        missing = [i for i, x in enumerate(values) if x is None]
+        LOCAL_HITS.inc(len(keys) - len(missing))
+        LOCAL_MISSES.inc(len(missing))
+        if missing:
+            generation = self.generation
+            fetched = self.client.mget(*(keys[i] for i in missing))
+            record_mget(fetched)
+            for i, value in zip(missing, fetched):
+                values[i] = value
+            self.set_local([(keys[i], values[i]) for i in missing],
+                           generation)
+        return values
+
+    def get(self, key, raw=False, deserialize=None):
+        value = self.mget([key])[0]
         if raw or not value:
             return value
-        return self.deserialize(value)
+        return (deserialize or self.deserialize)(value)
 
-    def set(self, key, value, raw=False, **redis_kw):
+    def set(self, key, value, raw=False, serialize=None, index=None,
+            **redis_kw):
         if not raw and value:
-            value = self.serialize(value)
-        return self.client.set(key, value, **redis_kw)
+            t = time.perf_counter()
+            value = (serialize or self.serialize)(value)
+            ENCODE_SECONDS.observe(time.perf_counter() - t)
+        if self.local is None and index is None:
+            return self.client.set(key, value, **redis_kw)
+        generation = self.generation
+        with self.client.pipeline(transaction=False) as pipe:
+            pipe.set(key, value, **redis_kw)
+            self.publish(pipe, [key])
+            if index is not None:
+                self.add_to_index(pipe, *index, [key],
+                                  expire=redis_kw.get('ex'))
+            ret = pipe.execute()[0]
+        self.set_local([(key, value)], generation, ttl=redis_kw.get('ex'))
+        return ret
 
-    def cache(self, key=None, expire=None, **redis_kw):
+    def invalidate(self, keys=None):
+        """Drop keys from Redis and from the memory of all processes"""
+        if keys is not None:
+            # keys read back from Redis (e.g. the index sets) are bytes
+            keys = [x.decode('utf-8') if isinstance(x, bytes) else x
+                    for x in keys]
+            if not keys:
+                return
+        with self.client.pipeline(transaction=False) as pipe:
+            if keys:
+                pipe.delete(*keys)
+            self.publish(pipe, keys)
+            pipe.execute()
+        if self.local is not None:
+            self.generation += 1
+            if keys is None:
+                self.local.clear()
+            else:
+                self.local.pop_many(keys)
+
+    def acquire_leases(self, keys, ttl_ms):
+        """Take short exclusive leases on keys before computing their
+        values. Returns the keys no other process holds a lease on."""
+        if not keys:
+            return []
+        with self.client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.set(f'lease:{key}', self.id, nx=True, px=ttl_ms)
+            acquired = pipe.execute()
+        return [key for key, ok in zip(keys, acquired) if ok]
+
+    def release_leases(self, keys):
+        if keys:
+            self._release_leases(keys=[f'lease:{key}' for key in keys],
+                                 args=[self.id])
+
+    def index_key(self, prefix, namespace):
+        return f'{prefix}.index:{namespace}'
+
+    def add_to_index(self, pipe, prefix, namespace, keys, expire=None):
+        """Remember which keys belong to a namespace, so they can be
+        counted and dropped without scanning the whole keyspace"""
+        index = self.index_key(prefix, namespace)
+        pipe.sadd(index, *keys)
+        pipe.sadd(f'{prefix}.namespaces', namespace)
+        if expire:
+            # the index expires with the last key added to it
+            pipe.expire(index, expire)
+
+    def namespaces(self, prefix):
+        """All namespaces of cached values under a key prefix"""
+        return sorted(x.decode('utf-8') for x in
+                      self.client.smembers(f'{prefix}.namespaces'))
+
+    def count_namespace(self, prefix, namespace):
+        """Number of keys in a namespace. Keys that expired on their
+        own are still counted until the index expires."""
+        return self.client.scard(self.index_key(prefix, namespace))
+
+    def iter_namespace(self, prefix, namespace, batch_size=1000):
+        return self.client.sscan_iter(self.index_key(prefix, namespace),
+                                      count=batch_size)
+
+    def drop_namespace(self, prefix, namespace, batch_size=1000, pause=0):
+        """Delete all keys of a namespace, `batch_size` keys at a time.
+        Safe to run from multiple processes at once.
+
+        Returns:
+            The number of keys dropped.
+        """
+        index = self.index_key(prefix, namespace)
+        dropped = 0
+        while True:
+            keys = self.client.spop(index, batch_size)
+            if not keys:
+                break
+            self.invalidate(keys)
+            dropped += len(keys)
+            if pause:
+                time.sleep(pause)
+        self.client.srem(f'{prefix}.namespaces', namespace)
+        return dropped
+
+    def cache(self, key=None, expire=None, serialize=None, deserialize=None,
+              namespace=None, **redis_kw):
         """Cache one single key in hashes
 
         Parameters
@@ -139,50 +381,69 @@ class RedisStore(object):
                      results of the wrapped function. Defaults to the name
                      of the function.
 
+            serialize, deserialize: how to encode the cached values,
+                                    defaults to the store's.
+
+            namespace: function of the positional args that returns a
+                       namespace (e.g. a model version) for the keys,
+                       see `drop_namespace`.
+
             **redis_kw: All remaining named args are passed to redis.hset(..)
                         E.g. ex={seconds to expire}, px={millisecs to expire}
         """
         expire = expire or self.default_expire
 
         def decorator(func):
-            genkey = self.genkey(key or func.__name__)
+            keyfunc = self.keyfunc(key or func.__name__, namespace)
 
             @wraps(func)
             def wrapper(*args, cache_only=False, **kwargs):
-                key = genkey(args, kwargs)
-                value = self.get(key)
+                key, index = keyfunc(args, kwargs)
+                value = self.get(key, deserialize=deserialize)
                 if cache_only:
                     return value
                 if value is None:
                     value = func(*args, **kwargs)
                 if value is not None:
-                    self.set(key, value, ex=expire, **redis_kw)
+                    self.set(key, value, serialize=serialize, index=index,
+                             ex=expire, **redis_kw)
                 return value
 
             wrapper.iter_cached = lambda *args, **kwargs: \
-                self.client.scan_iter(genkey(args, kwargs) + '*')
+                self.client.scan_iter(keyfunc(args, kwargs)[0] + '*')
             wrapper.nocache = func
 
             return wrapper
 
         return decorator
 
-    def update_cache(self, keys, vals, expire=None):
+    def update_cache(self, keys, vals, expire=None, serialize=None,
+                     index=None):
         # save results to redis
+        serialize = serialize or self.serialize
+        t = time.perf_counter()
+        data = {
+            key: serialize(val)
+            if val is not None else val
+            for key, val in zip(keys, vals)
+        }
+        ENCODE_SECONDS.observe(time.perf_counter() - t)
+        generation = self.generation
         with self.client.pipeline() as pipe:
-            pipe.mset({
-                key: self.serialize(val)
-                if val is not None else val
-                for key, val in zip(keys, vals)
-            })
+            pipe.mset(data)
             if expire:
                 for key in keys:
                     pipe.expire(key, expire)
+            self.publish(pipe, list(keys))
+            if index is not None:
+                self.add_to_index(pipe, *index, list(keys), expire=expire)
             pipe.execute()
+        self.set_local(data.items(), generation, ttl=expire)
         return vals
 
     def mcache(self, key=None, expire=None, mini_batch_size=100,
-               cache_first=True, autocache=True):
+               cache_first=True, autocache=True, serialize=None,
+               deserialize=None, namespace=None):
         """Cache for batch commands. Fetch cache if exists, pass
         the remaining items to the batch function.
 
@@ -192,11 +453,17 @@ class RedisStore(object):
                              in mini batches.
             manual_cache: if to set results in cache automatically, if False,
                           the executor must manually set per-item cache itself.
+            serialize, deserialize: how to encode the cached values,
+                                    defaults to the store's.
+            namespace: function of the positional args except the list
+                       of items, see `cache`.
 
         This adds two parameters to the decorated function:
             cache_only:   only return cache
-            cache_first:  return cache first, then trigger let the function
-                          in another thread
+            cache_first:  return cache first, and compute the missing
+                          values in the background (see `RefillQueue`).
+                          With `return_handle=True`, also returns a
+                          handle to cancel the refill.
         """
         expire = expire or self.default_expire
         default_mini_bs = mini_batch_size
@@ -204,19 +471,32 @@ class RedisStore(object):
         default_autocache = autocache
 
         def decorator(func):
-            genkey = self.genkey(key or func.__name__.replace('batch_', ''))
+            keyfuncs = self.batch_keyfunc(
+                key or func.__name__.replace('batch_', ''), namespace)
+
+            def compute(args1, more_items, args2, more_keys, autocache,
+                        kwargs, index=None):
+                more_values = func(*args1, more_items, *args2, **kwargs)
+                if autocache:
+                    self.update_cache(more_keys, more_values, expire,
+                                      serialize=serialize, index=index)
+                logger.debug('Fetched %s additional results',
+                             len(more_values))
+                return more_values
 
             @wraps(func)
             def wrapper(*args, cache_only=False,
                         cache_first=default_cache_first,
                         mini_batch_size=default_mini_bs,
                         autocache=default_autocache,
-                        return_asyncio_handle=False, **kwargs):
+                        return_handle=False, **kwargs):
                 args1, items, args2 = first_list_arg(args)
+                genkey, index = keyfuncs(args1, args2)
 
                 # kwargs will not be part of the cache keys
                 keys = [genkey([*args1, x, *args2]) for x in items]
-                values, idxs = self.deserialize_multi(self.client.mget(*keys))
+                values, idxs = self.deserialize_multi(self.mget(keys),
+                                                     deserialize)
 
                 logger.debug("%d of %d items already in cache.",
                              len(values) - len(idxs), len(values))
@@ -228,38 +508,15 @@ class RedisStore(object):
                 def fetch_more(idxs):
                     more_items = [items[i] for i in idxs]
                     more_keys = [keys[i] for i in idxs]
-                    more_values = func(*args1, more_items, *args2, **kwargs)
-                    if autocache:
-                        self.update_cache(more_keys, more_values, expire)
-                    logger.debug('Fetched %s additional results',
-                                 len(more_values))
-                    return more_values
-
-                def check_and_fetch(nocache_idxs):
-                    """Run in small batches and check cache again before each run.
-                    This is for allowing parallel requests at the same time.
-                    """
-                    total = len(nocache_idxs)
-                    iterator = gen_minibatch(nocache_idxs, mini_batch_size)
-                    for batch, start, end in iterator:
-                        logger.debug('Fetching mini batch %2d ~ %2d of %2d',
-                                     start, end, total)
-                        vals = self.client.mget(*(keys[idx] for idx in batch))
-                        still_no_cache = [
-                            nocache_idxs[start + i]
-                            for i, val in enumerate(vals)
-                            if val is None
-                        ]
-                        if still_no_cache:
-                            fetch_more(still_no_cache)
+                    return compute(args1, more_items, args2, more_keys,
+                                   autocache, kwargs, index)
 
                 # if cache first, return the available values +
-                # an asyncio.Handle that may be used to cancel
-                # future fetch_more action
-                if cache_first:
-                    handle = self.loop.call_soon_threadsafe(
-                        check_and_fetch, idxs)
-                    if return_asyncio_handle:
+                # a handle that may be used to cancel the refill
+                if cache_first and self.refill is not None:
+                    handle = self.refill.submit(keys, idxs, fetch_more,
+                                                mini_batch_size)
+                    if return_handle:
                         return values, handle
                     return values
 
@@ -270,9 +527,40 @@ class RedisStore(object):
 
                 return values
 
+            def iter_batches(*args, mini_batch_size=default_mini_bs,
+                             autocache=default_autocache,
+                             read_batch_size=1000, **kwargs):
+                """Yield (indexes, values) for cached items right away,
+                then for the remaining items as each mini batch is
+                fetched. Never holds all the values in memory.
+                """
+                args1, items, args2 = first_list_arg(args)
+                genkey, index = keyfuncs(args1, args2)
+                keys = [genkey([*args1, x, *args2]) for x in items]
+                nocache_idxs = []
+                for batch, start, end in gen_minibatch(keys, read_batch_size):
+                    vals, idxs = self.deserialize_multi(self.mget(batch),
+                                                          deserialize)
+                    missing = set(idxs)
+                    cached = [i for i in range(len(batch)) if i not in missing]
+                    if cached:
+                        yield ([start + i for i in cached],
+                               [vals[i] for i in cached])
+                    nocache_idxs.extend(start + i for i in idxs)
+
+                for batch, start, end in gen_minibatch(nocache_idxs,
+                                                       mini_batch_size):
+                    more_items = [items[i] for i in batch]
+                    more_keys = [keys[i] for i in batch]
+                    yield batch, compute(args1, more_items, args2, more_keys,
+                                         autocache, kwargs, index)
+
+            wrapper.iter_batches = iter_batches
+
             # iter cached results
             wrapper.iter_cache = lambda *args, **kwargs: \
-                self.client.scan_iter(genkey(args, kwargs) + '*')
+                self.client.scan_iter(
+                    keyfuncs(args, ())[0](args, kwargs) + '*')
 
             # no cache
             wrapper.nocache = func
@@ -284,3 +572,11 @@ class RedisStore(object):
 
 # Default connection
 store = RedisStore()
+
+
+@REGISTRY.on_collect
+def collect_store_stats():
+    if store.refill is not None:
+        REFILL_PENDING.set(store.refill.pending())
+    if store.local is not None:
+        LOCAL_CACHE_SIZE.set(len(store.local))
@@ -0,0 +1,366 @@
+"""
+asyncio Redis helpers
+
+`AsyncRedisStore` has the same `cache` and `mcache` decorators as
+`RedisStore`, but for coroutine functions, so the ASGI app can read the
+cache without blocking the event loop or going through a thread pool.
+
+It shares key generation, encoding, the in-process cache and the refill
+queue with a synchronous `RedisStore`, so both see the same values.
+
+All GETs and MGETs issued in the same iteration of the event loop are
+sent as one MGET over a pool of connections.
+
+Values encoded by a `PredictionCodec` (`codec=`) have their schemas
+read and written with the asyncio client before they are decoded or
+encoded, so the codec never does I/O on the event loop.
+
+Commands go through `redis.asyncio` (redis-py >= 4.2). With older
+redis-py versions they are run by the synchronous client in a small
+thread pool, which still keeps them off the event loop.
+"""
+import asyncio
+import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+
+try:
+    from redis import asyncio as aredis
+except ImportError:
+    aredis = None
+
+from zita.serve.redis import store as default_store, first_list_arg, \
+    gen_minibatch, record_mget, LOCAL_HITS, LOCAL_MISSES, ENCODE_SECONDS
+from zita.settings import REDIS_URL, REDIS_POOL_SIZE
+
+logger = logging.getLogger('zita.redis')
+
+# max number of keys in one MGET
+MGET_BATCH_SIZE = 1000
+
+
+class ThreadedPipeline(object):
+    """Pipeline of a synchronous client, executed in a thread"""
+
+    def __init__(self, pipe, executor):
+        self.pipe = pipe
+        self.executor = executor
+
+    def __getattr__(self, name):
+        # queuing commands does no I/O
+        return getattr(self.pipe, name)
+
+    async def execute(self):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, self.pipe.execute)
+
+
+class ThreadedClient(object):
+    """The subset of the `redis.asyncio` client used here, for a
+    synchronous client"""
+
+    def __init__(self, client, max_workers):
+        self.client = client
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix="RedisIO")
+
+    async def mget(self, *keys):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor, partial(self.client.mget, *keys))
+
+    async def hmget(self, name, keys):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor, partial(self.client.hmget, name, keys))
+
+    def pipeline(self, transaction=False):
+        return ThreadedPipeline(self.client.pipeline(transaction=transaction),
+                                self.executor)
+
+    async def close(self):
+        # the connections belong to the synchronous store
+        self.executor.shutdown(wait=False)
+
+
+class AsyncRedisStore(object):
+    """Cache Storage with an asyncio Redis client
+
+    Parameters
+    ----------
+        store:      the RedisStore to share keys, encoding and the
+                    in-process cache with
+        url:        Redis URL
+        pool_size:  max number of connections
+    """
+
+    def __init__(self, store=None, url=REDIS_URL, pool_size=REDIS_POOL_SIZE):
+        self.store = store or default_store
+        self.url = url
+        self.pool_size = pool_size
+        self.client = None
+        # key -> future of keys to read with the next MGET
+        self._pending = {}
+        self._flush_scheduled = False
+        # key -> task computing its value
+        self._inflight = {}
+
+    async def connect(self):
+        """Create the client, called on app startup or by the first
+        command. Connections are opened when they are needed."""
+        if self.client is None:
+            if aredis is not None:
+                self.client = aredis.from_url(
+                    self.url, max_connections=self.pool_size)
+            else:
+                self.client = ThreadedClient(self.store.client,
+                                             self.pool_size)
+        return self.client
+
+    async def close(self):
+        if self.client is not None:
+            # redis-py >= 5 renamed close() to aclose()
+            await getattr(self.client, 'aclose', self.client.close)()
+        self.client = None
+
+    def _read(self, keys):
+        """Futures of the raw values of keys, all keys requested
+        before the loop gets to `_flush` are read together"""
+        loop = asyncio.get_event_loop()
+        futures = []
+        for key in keys:
+            future = self._pending.get(key)
+            if future is None:
+                future = self._pending[key] = loop.create_future()
+            futures.append(future)
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            loop.call_soon(self._flush)
+        return futures
+
+    def _flush(self):
+        pending, self._pending = self._pending, {}
+        self._flush_scheduled = False
+        keys = list(pending)
+        for start in range(0, len(keys), MGET_BATCH_SIZE):
+            batch = keys[start:start + MGET_BATCH_SIZE]
+            asyncio.ensure_future(
+                self._mget({key: pending[key] for key in batch}))
+
+    async def _mget(self, pending):
+        keys = list(pending)
+        try:
+            client = await self.connect()
+            values = await client.mget(*keys)
+            record_mget(values)
+        except Exception as e:
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for key, value in zip(keys, values):
+            future = pending[key]
+            if not future.done():
+                future.set_result(value)
+
+    async def mget(self, keys):
+        """Raw values of a list of keys, read from process memory
+        when possible"""
+        store = self.store
+        if not keys:
+            return []
+        if store.local is None:
+            values = [None] * len(keys)
+        else:
+            values = store.local.get_many(keys)
+        missing = [i for i, x in enumerate(values) if x is None]
+        if store.local is not None:
+            LOCAL_HITS.inc(len(keys) - len(missing))
+            LOCAL_MISSES.inc(len(missing))
+        if missing:
+            generation = store.generation
+            fetched = await asyncio.gather(
+                *self._read([keys[i] for i in missing]))
+            for i, value in zip(missing, fetched):
+                values[i] = value
+            store.set_local([(keys[i], values[i]) for i in missing],
+                            generation)
+        return values
+
+    async def decoder(self, values, deserialize=None, codec=None):
+        """Function to deserialize values with, reads the schemas they
+        need first if they are encoded by `codec`"""
+        if codec is None:
+            return deserialize
+        await codec.aload_schemas(await self.connect(), values)
+        return partial(codec.decode, load=False)
+
+    async def get(self, key, raw=False, deserialize=None, codec=None):
+        value = (await self.mget([key]))[0]
+        if raw or not value:
+            return value
+        deserialize = await self.decoder([value], deserialize, codec)
+        return (deserialize or self.store.deserialize)(value)
+
+    async def update_cache(self, keys, vals, expire=None, serialize=None,
+                           index=None, codec=None):
+        store = self.store
+        if codec is not None:
+            await codec.asave_schemas(await self.connect(), vals)
+            serialize = partial(codec.encode, save=False)
+        serialize = serialize or store.serialize
+        t = time.perf_counter()
+        data = {
+            key: serialize(val)
+            for key, val in zip(keys, vals)
+            if val is not None
+        }
+        ENCODE_SECONDS.observe(time.perf_counter() - t)
+        if not data:
+            return vals
+        client = await self.connect()
+        generation = store.generation
+        pipe = client.pipeline(transaction=False)
+        pipe.mset(data)
+        if expire:
+            for key in data:
+                pipe.expire(key, expire)
+        store.publish(pipe, list(data))
+        if index is not None:
+            store.add_to_index(pipe, *index, list(data), expire=expire)
+        await pipe.execute()
+        store.set_local(data.items(), generation, ttl=expire)
+        return vals
+
+    async def set(self, key, value, serialize=None, index=None, ex=None,
+                  codec=None):
+        await self.update_cache([key], [value], expire=ex,
+                                serialize=serialize, index=index, codec=codec)
+
+    def cache(self, key=None, expire=None, serialize=None, deserialize=None,
+              namespace=None, codec=None):
+        """Cache one single key, see `RedisStore.cache`. With a `codec`,
+        values are encoded and decoded with it instead of `serialize`
+        and `deserialize`."""
+        store = self.store
+        expire = expire or store.default_expire
+
+        def decorator(func):
+            keyfunc = store.keyfunc(key or func.__name__, namespace)
+
+            async def compute(key, index, args, kwargs):
+                value = await func(*args, **kwargs)
+                if value is not None:
+                    await self.set(key, value, serialize=serialize,
+                                   index=index, ex=expire, codec=codec)
+                return value
+
+            @wraps(func)
+            async def wrapper(*args, cache_only=False, **kwargs):
+                key, index = keyfunc(args, kwargs)
+                value = await self.get(key, deserialize=deserialize,
+                                       codec=codec)
+                if cache_only or value is not None:
+                    return value
+                # concurrent misses of the same key wait for one call
+                task = self._inflight.get(key)
+                if task is None:
+                    task = self._inflight[key] = asyncio.ensure_future(
+                        compute(key, index, args, kwargs))
+                    task.add_done_callback(
+                        lambda _: self._inflight.pop(key, None))
+                return await asyncio.shield(task)
+
+            wrapper.nocache = func
+            return wrapper
+
+        return decorator
+
+    def mcache(self, key=None, expire=None, mini_batch_size=100,
+               cache_first=True, autocache=True, serialize=None,
+               deserialize=None, namespace=None, codec=None):
+        """Cache for batch commands, see `RedisStore.mcache` and
+        `cache` for `codec`.
+
+        With `cache_first`, missing values are computed by the refill
+        queue of the synchronous store, which runs the decorated
+        coroutine on this event loop.
+        """
+        store = self.store
+        expire = expire or store.default_expire
+        default_mini_bs = mini_batch_size
+        default_cache_first = cache_first
+        default_autocache = autocache
+
+        def decorator(func):
+            keyfuncs = store.batch_keyfunc(
+                key or func.__name__.replace('batch_', ''), namespace)
+
+            async def compute(args1, more_items, args2, more_keys, autocache,
+                              kwargs, index=None):
+                more_values = await func(*args1, more_items, *args2, **kwargs)
+                if autocache:
+                    await self.update_cache(more_keys, more_values, expire,
+                                            serialize=serialize, index=index,
+                                            codec=codec)
+                logger.debug('Fetched %s additional results',
+                             len(more_values))
+                return more_values
+
+            @wraps(func)
+            async def wrapper(*args, cache_only=False,
+                              cache_first=default_cache_first,
+                              mini_batch_size=default_mini_bs,
+                              autocache=default_autocache,
+                              return_handle=False, **kwargs):
+                args1, items, args2 = first_list_arg(args)
+                genkey, index = keyfuncs(args1, args2)
+
+                # kwargs will not be part of the cache keys
+                keys = [genkey([*args1, x, *args2]) for x in items]
+                raw = await self.mget(keys)
+                values, idxs = store.deserialize_multi(
+                    raw, await self.decoder(raw, deserialize, codec))
+
+                logger.debug("%d of %d items already in cache.",
+                             len(values) - len(idxs), len(values))
+
+                if not idxs or cache_only:
+                    return values
+
+                async def fetch_more(idxs):
+                    more_items = [items[i] for i in idxs]
+                    more_keys = [keys[i] for i in idxs]
+                    return await compute(args1, more_items, args2, more_keys,
+                                         autocache, kwargs, index)
+
+                if cache_first and store.refill is not None:
+                    loop = asyncio.get_event_loop()
+
+                    def fetch(idxs):
+                        # runs in a refill worker thread
+                        asyncio.run_coroutine_threadsafe(
+                            fetch_more(idxs), loop).result()
+
+                    handle = store.refill.submit(keys, idxs, fetch,
+                                                 mini_batch_size)
+                    if return_handle:
+                        return values, handle
+                    return values
+
+                for batch, start, end in gen_minibatch(idxs, mini_batch_size):
+                    for i, val in zip(batch, await fetch_more(batch)):
+                        values[i] = val
+
+                return values
+
+            wrapper.nocache = func
+            return wrapper
+
+        return decorator
+
+
+# Default connection, shares keys and encoding with `store`
+astore = AsyncRedisStore()
@@ -0,0 +1,143 @@
+"""
+Background refills for `RedisStore.mcache(cache_first=True)`
+
+Cache-first batch calls return the cached values right away and leave
+the missing ones to a bounded pool of refill workers. A key is only
+computed once at a time:
+
+- in this process, keys already queued or running are not queued again
+- across processes, a worker only computes keys it holds a short Redis
+  lease (`SET NX PX`) on, other keys are being computed elsewhere
+"""
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('zita.redis')
+
+
+class RefillHandle(object):
+    """Handle of a background refill. Like `asyncio.Handle`, call
+    `cancel()` to skip the mini batches that have not started yet."""
+
+    def __init__(self, keys):
+        self.keys = keys
+        self._cancelled = False
+        self._done = threading.Event()
+
+    def cancel(self):
+        self._cancelled = True
+
+    def cancelled(self):
+        return self._cancelled
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait until the refill finished, returns False on timeout"""
+        return self._done.wait(timeout)
+
+
+class RefillQueue(object):
+    """Refill missing cache keys with a bounded pool of workers
+
+    Parameters
+    ----------
+        store:        the RedisStore to check the cache and take leases
+        max_workers:  number of refills that may run at the same time
+        max_pending:  max number of keys queued or running, keys over
+                      the limit are not queued (they will be requested
+                      again by the next call that misses them)
+        lease_sec:    seconds other processes leave a key alone after
+                      a worker started computing it
+    """
+
+    def __init__(self, store, max_workers=2, max_pending=10000,
+                 lease_sec=60):
+        self.store = store
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='RedisRefill')
+        self.max_pending = max_pending
+        self.lease_ms = int(lease_sec * 1000)
+        # key -> handle of the refill that will compute it
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def pending(self):
+        return len(self.inflight)
+
+    def submit(self, keys, idxs, fetch, mini_batch_size=100):
+        """Compute `keys[i] for i in idxs` in the background.
+
+        Args:
+            keys : cache keys of all items of the call
+            idxs : indexes of the missing items
+            fetch : function that computes and caches the items at
+                    a list of indexes
+            mini_batch_size : number of items to compute at once
+
+        Returns:
+            A RefillHandle, only for the keys that were not already
+            being refilled.
+        """
+        with self.lock:
+            todo = [i for i in idxs if keys[i] not in self.inflight]
+            room = max(self.max_pending - len(self.inflight), 0)
+            if len(todo) > room:
+                logger.warning('Refill queue is full, dropping %d keys',
+                               len(todo) - room)
+                todo = todo[:room]
+            handle = RefillHandle([keys[i] for i in todo])
+            for i in todo:
+                self.inflight[keys[i]] = handle
+        logger.debug('Queued %d of %d missing keys for refill',
+                     len(todo), len(idxs))
+        if todo:
+            self.executor.submit(self.run, handle, keys, todo, fetch,
+                                 mini_batch_size)
+        else:
+            handle._done.set()
+        return handle
+
+    def _finish(self, handle, keys):
+        with self.lock:
+            for key in keys:
+                if self.inflight.get(key) is handle:
+                    del self.inflight[key]
+
+    def run(self, handle, keys, idxs, fetch, mini_batch_size):
+        try:
+            for start in range(0, len(idxs), mini_batch_size):
+                if handle.cancelled():
+                    logger.debug('Refill cancelled, skipped %d keys',
+                                 len(idxs) - start)
+                    break
+                batch = idxs[start:start + mini_batch_size]
+                batch_keys = [keys[i] for i in batch]
+                try:
+                    self.refill(batch, batch_keys, fetch)
+                except Exception as e:
+                    # e.g. a missing photo, the other batches still run
+                    logger.error('Refill of %d keys failed: %s',
+                                 len(batch), e, exc_info=True)
+                finally:
+                    self._finish(handle, batch_keys)
+        finally:
+            self._finish(handle, handle.keys)
+            handle._done.set()
+
+    def refill(self, batch, batch_keys, fetch):
+        # another request or process may have cached them meanwhile
+        values = self.store.client.mget(*batch_keys)
+        missing = [(i, key) for i, key, value in
+                   zip(batch, batch_keys, values) if value is None]
+        leased = set(self.store.acquire_leases(
+            [key for _, key in missing], self.lease_ms))
+        if not leased:
+            return
+        try:
+            fetch([i for i, key in missing if key in leased])
+        finally:
+            self.store.release_leases(list(leased))
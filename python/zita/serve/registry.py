@@ -0,0 +1,198 @@
+"""
+Model registry
+
+Preloads and warms up models at startup, then watches MODELS_ROOT and
+swaps in new or retrained models in the background, so requests never
+have to wait for a model to load.
+"""
+import hashlib
+import logging
+import threading
+import time
+
+from zita.serve.backends import model_path
+from zita.serve.engine import warmup
+from zita.settings import MODELS_ROOT, MODELS_POLL_SEC
+
+logger = logging.getLogger('zita.serve')
+
+
+def model_stat(model, root=MODELS_ROOT):
+    """(mtime, size) of a model file, None if it does not exist"""
+    try:
+        stat = model_path(model, root).stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+# (path, stat) -> digest, so unchanged files are only hashed once
+_digests = {}
+
+
+def model_digest(model, root=MODELS_ROOT):
+    """Short hash of the content of a model file, None if it does
+    not exist. Retraining a model changes its digest."""
+    path = model_path(model, root)
+    stat = model_stat(model, root)
+    if stat is None:
+        return None
+    digest = _digests.get((path, stat))
+    if digest is None:
+        h = hashlib.blake2b(digest_size=8)
+        with path.open('rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        digest = _digests[(path, stat)] = h.hexdigest()
+    return digest
+
+
+def file_version(model, root=MODELS_ROOT):
+    """Version of a model file without reading it: its digest if it
+    was already hashed, otherwise its mtime and size"""
+    stat = model_stat(model, root)
+    if stat is None:
+        return None
+    digest = _digests.get((model_path(model, root), stat))
+    return digest or 's{:x}-{:x}'.format(*stat)
+
+
+class ModelRegistry(object):
+    """Keep a set of models loaded, warm and up to date
+
+    Parameters
+    ----------
+        pool:      the LearnerPool to load models into.
+        load:      function to load a learner by model name.
+        models:    models to preload at startup.
+        root:      where to find the model files.
+        poll_sec:  seconds between checks for changed model files,
+                   0 to disable hot reload.
+    """
+
+    def __init__(self, pool, load, models=(), root=MODELS_ROOT,
+                 poll_sec=MODELS_POLL_SEC):
+        self.pool = pool
+        self.load = load
+        self.models = list(dict.fromkeys(models))
+        self.root = root
+        self.poll_sec = poll_sec
+        # stat of model files when they were loaded
+        self.versions = {}
+        # content digests of the loaded models
+        self.digests = {}
+        # functions to call with (model, digest) after a model is loaded
+        self.listeners = []
+        # stat of changed files seen in the last poll
+        self._pending = {}
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+        self._started = False
+        self._watcher = None
+        # models the pool loads on demand also go through us, so we
+        # always know the version of what it serves
+        pool.load = self.load_file
+
+    def _load(self, model):
+        """Load a model file, with the stat and digest of the file
+        that was actually loaded"""
+        for _ in range(3):
+            stat = model_stat(model, self.root)
+            if stat is None:
+                raise ValueError(f"No such learner: {model}")
+            digest = model_digest(model, self.root)
+            learn = self.load(model)
+            if model_stat(model, self.root) == stat:
+                break
+            # the file changed while it was loading
+        return learn, stat, digest
+
+    def load_file(self, model):
+        """Load a model for the pool and record its version"""
+        if not self.pool.stats().get(model, {}).get('replicas'):
+            # first copy, e.g. after an eviction: until it is loaded the
+            # version is the one of the file on disk, not the digest of
+            # the copy that was evicted
+            self.digests.pop(model, None)
+        learn, stat, digest = self._load(model)
+        self.versions[model] = stat
+        self.digests[model] = digest
+        return learn
+
+    def load_model(self, model):
+        """Load and warm up a model, then swap it into the pool"""
+        t = time.time()
+        learn, stat, digest = self._load(model)
+        warmup(learn)
+        self.pool.put(model, learn)
+        self.versions[model] = stat
+        self.digests[model] = digest
+        logger.info('Loaded and warmed up %s (%s) in %.3f secs',
+                    model, digest, time.time() - t)
+        for listener in self.listeners:
+            try:
+                listener(model, digest)
+            except Exception as e:
+                logger.error('Model listener failed: %s', e, exc_info=True)
+        return learn
+
+    def version(self, model):
+        """Version of the model that serves predictions: the digest of
+        the loaded model until a changed file is reloaded. A model that
+        is not loaded yet will be loaded from the file on disk, see
+        `file_version`. Never hashes a file, so it is safe to call
+        on the event loop."""
+        digest = self.digests.get(model)
+        if digest and model in self.pool.models():
+            return digest
+        return file_version(model, self.root)
+
+    def preload(self):
+        for model in self.models:
+            try:
+                self.load_model(model)
+            except Exception as e:
+                logger.error('Could not preload %s: %s', model, e)
+
+    def start(self):
+        """Preload models, then start watching for changes in background.
+        Blocks until the preloaded models are ready."""
+        with self._start_lock:
+            if self._started:
+                return
+            self._started = True
+            self.preload()
+        if self.poll_sec > 0:
+            self._watcher = threading.Thread(
+                target=self.watch, name="ModelRegistry", daemon=True)
+            self._watcher.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def changed_models(self):
+        """Models that should be (re)loaded. A model is only reloaded
+        once its file stays unchanged between two polls, so we never
+        load a partially written file."""
+        models = set(self.models) | set(self.pool.models())
+        changed = []
+        for model in sorted(models):
+            stat = model_stat(model, self.root)
+            if stat is None or stat == self.versions.get(model):
+                self._pending.pop(model, None)
+                continue
+            if self._pending.get(model) == stat:
+                del self._pending[model]
+                changed.append(model)
+            else:
+                self._pending[model] = stat
+        return changed
+
+    def watch(self):
+        while not self._stop.wait(self.poll_sec):
+            for model in self.changed_models():
+                logger.info('Model %s changed, reloading...', model)
+                try:
+                    self.load_model(model)
+                except Exception as e:
+                    logger.error('Could not reload %s: %s', model, e)
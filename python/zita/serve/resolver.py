@@ -1,39 +1,58 @@
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from graphql.error import GraphQLError
 from ariadne import QueryType, ObjectType, convert_kwargs_to_snake_case
 
 from zita.data import get_true_labels
-from zita.serve.predict import predict, batch_predict
+from zita.serve.predict import apredict, abatch_predict
+from zita.settings import NUM_IO_WORKERS
 
 query = QueryType()
 Prediction = ObjectType("Prediction")
 
+# Resolvers run on the event loop, so never block it. Cache lookups
+# are async (see `zita.serve.redis_async`), inference runs in the
+# prediction executor, and other blocking I/O (files) in a separate
+# executor, so slow predictions do not starve it.
+io_executor = ThreadPoolExecutor(max_workers=NUM_IO_WORKERS,
+                                 thread_name_prefix="IO")
+
+
+async def run_in(executor, func, *args, **kwargs):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, partial(func, *args, **kwargs))
+
 
 @Prediction.field("truth")
-def truth_labels(obj, info, photo_id) -> [str]:
-    return get_true_labels(photo_id)
+async def truth_labels(obj, info) -> [str]:
+    return await run_in(io_executor, get_true_labels, obj["id"])
 
 
-def get_pred(model, photo_id):
+async def get_pred(model, photo_id):
     try:
-        return predict(model, photo_id)
+        return await apredict(model, photo_id)
     except ValueError as e:
         raise GraphQLError(*e.args)
 
 
-def get_batch_pred(model, photo_ids):
+async def get_batch_pred(model, photo_ids):
     try:
-        return batch_predict(model, photo_ids)
+        # returns cached results right away, missing predictions are
+        # computed in background
+        return await abatch_predict(model, photo_ids)
     except ValueError as e:
         raise GraphQLError(*e.args)
 
 
 @query.field("prediction")
 @convert_kwargs_to_snake_case
-def predict_one(obj, info, photo_id) -> dict:
-    return get_pred(info.context.model, photo_id)
+async def predict_one(obj, info, photo_id) -> dict:
+    return await get_pred(info.context.model, photo_id)
 
 
 @query.field("predictions")
 @convert_kwargs_to_snake_case
-def predict_many(obj, info, photo_ids):
-    return get_batch_pred(info.context.model, photo_ids)
+async def predict_many(obj, info, photo_ids):
+    return await get_batch_pred(info.context.model, photo_ids)
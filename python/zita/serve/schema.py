@@ -10,7 +10,7 @@ from ariadne import gql, make_executable_schema
 from ariadne.asgi import GraphQL
 from zita.settings import DEBUG, DEFAULT_MODEL
 
-from .resolver import query
+from .resolver import query, Prediction
 
 # header key
 ZT_MODEL = "ZT_M"
@@ -18,7 +18,7 @@ ZT_MODEL = "ZT_M"
 with (Path(os.path.dirname(__file__)) / "typedef.gql").open() as f:
     typedef = gql(f.read())
 
-schema = make_executable_schema(typedef, query)
+schema = make_executable_schema(typedef, query, Prediction)
 Context = namedtuple("Context", ["model"])
 
 
@@ -0,0 +1,160 @@
+"""
+Warm up the prediction cache for whole albums
+
+Predicts photos in large batches, skipping photos that are already
+cached, and saves its progress to a checkpoint file after each batch so
+an interrupted run resumes where it stopped.
+"""
+import json
+import logging
+import os
+import time
+
+from pathlib import Path
+
+from zita.data.decode import photo_path
+from zita.serve.predict import native_batch_predict
+from zita.serve.registry import model_digest
+from zita.utils.parallel_runner import ParallelRunner
+from zita.settings import NUM_PRED_WORKERS
+
+logger = logging.getLogger('zita.serve')
+
+# errors of photos that cannot be read or decoded (PIL raises OSError,
+# its subclass UnidentifiedImageError, or SyntaxError for some broken
+# headers), other errors abort the run
+IMAGE_ERRORS = (OSError, SyntaxError)
+
+
+def load_checkpoint(path, model, version, photo_ids):
+    """Number of photos already processed by a previous run, 0 if the
+    checkpoint is for another model version or list of photos"""
+    try:
+        with Path(path).open() as f:
+            state = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return 0
+    offset = state.get('offset', 0)
+    if state.get('model') != model or state.get('version') != version \
+            or not 0 < offset <= len(photo_ids) \
+            or photo_ids[offset - 1] != state.get('last'):
+        return 0
+    return offset
+
+
+def save_checkpoint(path, model, version, photo_ids, offset):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({
+            'model': model,
+            'version': version,
+            'offset': offset,
+            'last': photo_ids[offset - 1] if offset else None,
+            'total': len(photo_ids),
+        }, f)
+    # never leave a half written checkpoint
+    os.replace(tmp_path, path)
+
+
+def existing(photo_ids):
+    ok = []
+    for photo_id in photo_ids:
+        try:
+            photo_path(photo_id)
+            ok.append(photo_id)
+        except ValueError:
+            logger.warning('Skipping missing photo %s', photo_id)
+    return ok
+
+
+def predict_batch(model, photo_ids, bs=None, runner=None, batch_size=1280):
+    """Predict and cache photos. If a photo of the batch cannot be
+    decoded, the batch is split in halves until the bad photos are
+    found, so the others are still predicted in large batches.
+
+    Returns:
+        The number of photos that could not be predicted.
+    """
+    try:
+        # writes results with one pipelined MSET per mini batch
+        native_batch_predict(model, photo_ids, bs=bs, runner=runner,
+                             cache_first=False, mini_batch_size=batch_size)
+        return 0
+    except IMAGE_ERRORS as e:
+        if len(photo_ids) == 1:
+            logger.warning('Skipping photo %s: %s', photo_ids[0], e)
+            return 1
+        logger.debug('Batch of %d photos failed (%s), splitting it',
+                     len(photo_ids), e)
+    mid = len(photo_ids) // 2
+    return sum(predict_batch(model, x, bs=bs, runner=runner,
+                             batch_size=batch_size)
+               for x in (photo_ids[:mid], photo_ids[mid:]))
+
+
+def warm_cache(model, photo_ids, batch_size=1280, bs=None,
+               workers=NUM_PRED_WORKERS, checkpoint=None, callback=None):
+    """Predict and cache all photos that are not cached yet
+
+    Args:
+        model : name of the model
+        photo_ids : photos to warm up, in a stable order
+        batch_size : number of photos to check and predict at once,
+                     the checkpoint is saved after each batch
+        bs : images in one forward pass, defaults to the learner's
+        workers : number of threads to decode images with
+        checkpoint : file to save progress to, resumes from it if it
+                     exists
+        callback : function called with the stats after each batch
+
+    Returns:
+        A dict of stats: number of photos cached before, predicted and
+        failed (missing or undecodable), seconds spent and images per
+        second. Failed photos are skipped, they do not stop the run.
+    """
+    version = model_digest(model)
+    if version is None:
+        # before any checkpoint is saved for it
+        raise ValueError(f"No such learner: {model}")
+    start = 0
+    if checkpoint:
+        start = load_checkpoint(checkpoint, model, version, photo_ids)
+        if start:
+            logger.info('Resuming %s from photo %d of %d', model, start,
+                        len(photo_ids))
+    stats = {'total': len(photo_ids), 'done': start, 'cached': 0,
+             'predicted': 0, 'failed': 0, 'secs': 0.0,
+             'images_per_sec': 0.0}
+    t = time.time()
+
+    with ParallelRunner(max_workers=workers) as runner:
+        for offset in range(start, len(photo_ids), batch_size):
+            batch = photo_ids[offset:offset + batch_size]
+            cached = native_batch_predict(model, batch, cache_only=True)
+            uncached = [x for x, pred in zip(batch, cached) if pred is None]
+            missing = existing(uncached)
+            failed = 0
+            if missing:
+                failed = predict_batch(model, missing, bs=bs, runner=runner,
+                                       batch_size=batch_size)
+
+            stats['done'] = offset + len(batch)
+            stats['cached'] += len(batch) - len(uncached)
+            stats['predicted'] += len(missing) - failed
+            stats['failed'] += len(uncached) - len(missing) + failed
+            stats['secs'] = time.time() - t
+            stats['images_per_sec'] = stats['predicted'] / \
+                max(stats['secs'], 1e-9)
+            if checkpoint:
+                save_checkpoint(checkpoint, model, version, photo_ids,
+                                stats['done'])
+            if callback:
+                callback(stats)
+    return stats
+
+
+def format_stats(stats):
+    return (f"{stats['done']}/{stats['total']} photos, "
+            f"{stats['cached']} already cached, "
+            f"{stats['predicted']} predicted, {stats['failed']} failed, "
+            f"{stats['images_per_sec']:.1f} images/sec")
@@ -9,6 +9,7 @@ import logging
 
 from pathlib import Path
 from starlette.config import Config
+from starlette.datastructures import CommaSeparatedStrings
 # from starlette.datastructures import URL
 
 config = Config(".env")
@@ -19,6 +20,13 @@ LOG_LEVEL = logging.DEBUG if DEBUG else logging.INFO
 HOST = config("ZT_HOST", default="0.0.0.0")
 PORT = config("ZT_PY_PORT", cast=int, default=3001)
 RPC_PORT = config("ZT_RPC_PORT", cast=int, default=3002)
+# number of RPC workers behind a load balancing broker, 0 to serve
+# with a single REQ/REP loop
+RPC_WORKERS = config("ZT_RPC_WORKERS", cast=int, default=0)
+# run RPC workers as "process"es or "thread"s
+RPC_WORKER_MODE = config("ZT_RPC_WORKER_MODE", default="process")
+# seconds an RPC worker may spend on one request
+RPC_TIMEOUT_SEC = config("ZT_RPC_TIMEOUT_SEC", cast=float, default=120)
 CORS = config("ZT_PY_CORS", default="*")
 CLIENT_API_ROOT = config("ZT_API_ROOT", default="http://localhost:3000/api")
 ALBUM_DELIM = config("ZT_ALBUM_DELIM", default=" ~ ")
@@ -26,14 +34,66 @@ ALBUMS_ROOT = Path(config("ZT_ALBUMS_ROOT", default="../example/data"))
 LABELS_CSV = config("ZT_LABELS_CSV", default=f"{ALBUMS_ROOT}/tags.csv")
 MODELS_ROOT = Path(config("ZT_MODELS_ROOT", default="notebooks/models"))
 DEFAULT_MODEL = config("ZT_DEFAULT_MODEL", default="default")
+# how to run models: "fastai" (Learner pickles) or "torchscript"
+# (artifacts created by `zita export`)
+PRED_BACKEND = config("ZT_PRED_BACKEND", default="fastai")
+# models to load and warm up at startup, besides DEFAULT_MODEL
+PRELOAD_MODELS = config("ZT_PRELOAD_MODELS", cast=CommaSeparatedStrings,
+                        default="")
+# seconds between checks for new or changed models in MODELS_ROOT
+# (0 to disable hot reload)
+MODELS_POLL_SEC = config("ZT_MODELS_POLL_SEC", cast=float, default=10)
 
 REDIS_URL = config("ZT_REDIS_URL", default=config(
     "REDIS_URL", default="redis://localhost:6379"))
 CELERY_BROKER_URL = config("ZT_CELERY_BROKER_URL", default=f'{REDIS_URL}/1')
+# max number of connections of the asyncio Redis client
+REDIS_POOL_SIZE = config("ZT_REDIS_POOL_SIZE", cast=int, default=10)
+# max number of cache entries to keep in process memory in front of
+# Redis (0 to disable)
+L1_CACHE_SIZE = config("ZT_L1_CACHE_SIZE", cast=int, default=0)
+# seconds before in-process cache entries expire
+L1_CACHE_TTL = config("ZT_L1_CACHE_TTL", cast=float, default=60)
+# Redis pub/sub channel to broadcast cache invalidations on
+L1_CACHE_CHANNEL = config("ZT_L1_CACHE_CHANNEL",
+                          default="zita.cache.invalidate")
+
+# number of background workers computing missing values of cache-first
+# batch predictions
+REFILL_WORKERS = config("ZT_REFILL_WORKERS", cast=int, default=2)
+# max number of keys waiting to be refilled per process
+REFILL_MAX_PENDING = config("ZT_REFILL_MAX_PENDING", cast=int, default=10000)
+# seconds other processes leave a key alone while one is computing it
+REFILL_LEASE_SEC = config("ZT_REFILL_LEASE_SEC", cast=float, default=60)
 
 # number of parallel workers to run batch predictions
 NUM_PRED_WORKERS = config("ZT_NUM_PRED_WORKERS",
                           cast=int, default=os.cpu_count())
+# number of copies of each model to keep in memory per process. A copy
+# runs one forward pass at a time, so this is also how many batches of
+# a model run at the same time (each pass already uses all cores)
+LEARNER_REPLICAS = config("ZT_LEARNER_REPLICAS", cast=int, default=2)
+# evict least recently used models when loaded models use more memory
+LEARNER_POOL_MB = config("ZT_LEARNER_POOL_MB", cast=int, default=2048)
+# number of threads for blocking I/O (e.g. Redis) in async resolvers
+NUM_IO_WORKERS = config("ZT_NUM_IO_WORKERS", cast=int, default=32)
+# max number of images to stack into one forward pass
+PRED_BATCH_SIZE = config("ZT_PRED_BATCH_SIZE", cast=int, default=64)
+# where to cache preprocessed input tensors (empty to disable)
+TENSOR_CACHE_ROOT = config("ZT_TENSOR_CACHE_ROOT", default="")
+# max size of the tensor cache for each input size
+TENSOR_CACHE_MB = config("ZT_TENSOR_CACHE_MB", cast=int, default=4096)
+# where to keep perceptual hashes of images for dedup (empty to disable)
+SIG_STORE = config("ZT_SIG_STORE", default=f"{ALBUMS_ROOT}/.signatures.db")
+# hash images for dedup in "process"es or "thread"s
+HASH_WORKER_MODE = config("ZT_HASH_WORKER_MODE", default="process")
+# milliseconds to hold single-photo predictions so that concurrent
+# requests for the same model can run as one batch (0 to disable)
+PRED_BATCH_WAIT_MS = config("ZT_PRED_BATCH_WAIT_MS", cast=float, default=5)
+# max drop of accuracy or F-beta allowed to publish a quantized model
+QUANT_MAX_DROP = config("ZT_QUANT_MAX_DROP", cast=float, default=0.01)
+# how to pack cached prediction probabilities: "float16" or "float32"
+PRED_CACHE_DTYPE = config("ZT_PRED_CACHE_DTYPE", default="float16")
 # seconds before predictions expire (default: 2h)
 PRED_EXPIRE_SEC = config("ZT_PRED_EXPIRE_SEC", cast=int, default=7200)
 
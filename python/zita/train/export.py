@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Export trained learners for serving without fastai
+"""
+import json
+import logging
+import torch
+
+from pathlib import Path
+
+from zita.serve.backends import FastaiBackend
+from zita.settings import MODELS_ROOT
+
+logger = logging.getLogger('zita.train')
+
+
+def backend_meta(backend):
+    """Everything a TorchScriptBackend needs besides the module"""
+    stats = backend.stats
+    meta = {
+        'classes': list(backend.classes),
+        'input_size': list(backend.input_size),
+        'batch_size': backend.batch_size,
+        'multi_label': backend.multi_label,
+        'thresh': 0.5,
+        'mean': None,
+        'std': None,
+    }
+    if stats is not None:
+        mean, std = stats
+        meta['mean'] = torch.as_tensor(mean).view(-1).tolist()
+        meta['std'] = torch.as_tensor(std).view(-1).tolist()
+    return meta
+
+
+def export_torchscript(model, root=MODELS_ROOT, output_dir=None):
+    """Trace a learner's model into `{model}.pt` and write the
+    metadata (classes, normalization stats, threshold) to `{model}.json`
+
+    Args:
+        model : name of the learner, `root/{model}.pkl`
+        root : where to find the learner
+        output_dir : where to save the artifacts, defaults to `root`
+    """
+    root = Path(root)
+    output_dir = Path(output_dir or root)
+    backend = FastaiBackend.load(model, root)
+    net = backend.model
+    # unwrap DataParallel
+    net = getattr(net, 'module', net).cpu().eval()
+    h, w = backend.input_size
+    with torch.no_grad():
+        traced = torch.jit.trace(net, torch.zeros(1, 3, h, w))
+
+    pt_path = output_dir / f'{model}.pt'
+    meta_path = output_dir / f'{model}.json'
+    # write the metadata first, the model registry watches the .pt file
+    with meta_path.open('w') as f:
+        json.dump(backend_meta(backend), f, indent=2)
+    traced.save(str(pt_path))
+    logger.info('Exported %s to %s', model, pt_path)
+    return pt_path
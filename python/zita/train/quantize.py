@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Post-training dynamic int8 quantization with an accuracy gate
+"""
+import copy
+import logging
+import torch
+
+from pathlib import Path
+
+from zita.serve.backends import FastaiBackend
+from zita.serve.evaluate import validation_set, evaluate_backend
+from zita.serve.pool import learner_nbytes
+from zita.settings import ALBUMS_ROOT, LABELS_CSV, MODELS_ROOT, \
+    QUANT_MAX_DROP
+
+logger = logging.getLogger('zita.train')
+
+QUANT_SUFFIX = '-int8'
+
+
+def quantize_model(net, dtype=torch.qint8):
+    """Dynamically quantize the Linear layers of a model. Runs on CPU"""
+    net = copy.deepcopy(getattr(net, 'module', net)).cpu().eval()
+    return torch.quantization.quantize_dynamic(
+        net, {torch.nn.Linear}, dtype=dtype)
+
+
+def quantize(model, root=MODELS_ROOT, path=ALBUMS_ROOT,
+             labels_csv=LABELS_CSV, max_drop=QUANT_MAX_DROP,
+             suffix=QUANT_SUFFIX, thresh=0.5, publish=True):
+    """Create an int8 variant of a learner, e.g. `name-stage2-int8`.
+
+    Both variants are scored on the validation set. The quantized
+    learner is only exported if neither accuracy nor F-beta drops by
+    more than `max_drop`.
+
+    Returns:
+        A report dict with the scores, latency and whether the
+        quantized learner was published.
+    """
+    root = Path(root)
+    backend = FastaiBackend.load(model, root)
+    qbackend = FastaiBackend.load(model, root)
+    qbackend.learn.model = qbackend.model = quantize_model(backend.model)
+
+    photo_ids, labels = validation_set(path, labels_csv)
+    logger.info('Evaluating %s on %d validation photos...',
+                model, len(photo_ids))
+    base = evaluate_backend(backend, photo_ids, labels, thresh=thresh)
+    quant = evaluate_backend(qbackend, photo_ids, labels, thresh=thresh)
+
+    drops = {k: base[k] - quant[k] for k in ('accuracy', 'fbeta')}
+    passed = all(x <= max_drop for x in drops.values())
+    report = {
+        'model': model,
+        'quantized': f'{model}{suffix}',
+        'base': base,
+        'int8': quant,
+        'drops': drops,
+        'speedup': base['secs_per_image'] / max(quant['secs_per_image'],
+                                                1e-9),
+        'size_mb': learner_nbytes(backend) / 1e6,
+        'int8_size_mb': learner_nbytes(qbackend) / 1e6,
+        'passed': passed,
+        'published': False,
+    }
+    logger.info(format_report(report))
+
+    if not passed:
+        logger.warning('Not publishing %s: accuracy or F-beta dropped by '
+                       'more than %.4f', report['quantized'], max_drop)
+    elif publish:
+        qbackend.learn.export(root / f'{model}{suffix}.pkl', destroy=True)
+        report['published'] = True
+        logger.info('Published %s', report['quantized'])
+    return report
+
+
+def format_report(report):
+    base, quant, drops = report['base'], report['int8'], report['drops']
+    return '\n'.join([
+        f"{'':12s} {report['model']:>20s} {report['quantized']:>20s}",
+        f"{'accuracy':12s} {base['accuracy']:20.4f} "
+        f"{quant['accuracy']:20.4f} ({-drops['accuracy']:+.4f})",
+        f"{'fbeta':12s} {base['fbeta']:20.4f} "
+        f"{quant['fbeta']:20.4f} ({-drops['fbeta']:+.4f})",
+        f"{'ms / image':12s} {base['secs_per_image'] * 1000:20.2f} "
+        f"{quant['secs_per_image'] * 1000:20.2f} "
+        f"({report['speedup']:.2f}x)",
+        f"{'model MB':12s} {report['size_mb']:20.1f} "
+        f"{report['int8_size_mb']:20.1f}",
+    ])
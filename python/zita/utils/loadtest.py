@@ -0,0 +1,117 @@
+"""
+Simple GraphQL load test
+
+Sends prediction queries from many concurrent clients and reports
+throughput and latency percentiles. Run it against a server before and
+after a change to compare.
+
+Predictions are cached in Redis, so asking for the same photos again
+only measures the cache. Use `unique=True` with more photo IDs than the
+test asks for (and photos that were not predicted in the last
+ZT_PRED_EXPIRE_SEC) so every request reaches the model.
+"""
+import json
+import time
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor
+
+PREDICT_ONE = """
+query Predict($photoId: String!) {
+    prediction(photoId: $photoId) { id tags }
+}
+"""
+
+PREDICT_MANY = """
+query PredictBatch($photoIds: [String!]!) {
+    predictions(photoIds: $photoIds) { id tags }
+}
+"""
+
+
+def post_query(url, query, variables, timeout=120):
+    data = json.dumps({"query": query, "variables": variables})
+    req = urllib.request.Request(url, data=data.encode('utf-8'), headers={
+        "Content-Type": "application/json"
+    })
+    with urllib.request.urlopen(req, timeout=timeout) as res:
+        body = json.loads(res.read())
+    if body.get("errors"):
+        raise RuntimeError(body["errors"][0].get("message"))
+    return body
+
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))
+    return values[idx]
+
+
+def run_load_test(url, photo_ids, concurrency=16, requests=200,
+                  batch_size=None, unique=False):
+    """Send `requests` queries from `concurrency` clients.
+
+    Args:
+        url : GraphQL endpoint
+        photo_ids : photos to ask predictions for, round robin
+        batch_size : if set, ask for this many photos per query with
+                     `predictions`, otherwise use `prediction`.
+        unique : never ask for the same photo twice, so results are
+                 not served from the cache. Needs `requests * batch_size`
+                 photo IDs. Note `predictions` returns cache misses
+                 right away and predicts them in background, so use
+                 `prediction` to measure inference.
+
+    Returns:
+        A dict of stats
+    """
+    per_request = batch_size or 1
+    if unique and len(photo_ids) < requests * per_request:
+        raise ValueError(
+            f'Need {requests * per_request} photo IDs for {requests} '
+            f'requests without repeats, got {len(photo_ids)}')
+    latencies, errors = [], []
+
+    def one(i):
+        start = i * per_request
+        ids = [photo_ids[(start + j) % len(photo_ids)]
+               for j in range(per_request)]
+        if batch_size:
+            query, variables = PREDICT_MANY, {"photoIds": ids}
+        else:
+            query, variables = PREDICT_ONE, {"photoId": ids[0]}
+        t = time.time()
+        try:
+            post_query(url, query, variables)
+        except Exception as e:
+            errors.append(str(e))
+            return
+        latencies.append(time.time() - t)
+
+    t = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(requests)))
+    elapsed = time.time() - t
+
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "unique": unique,
+        "errors": len(errors),
+        "elapsed": elapsed,
+        "rps": len(latencies) / elapsed,
+        "p50": percentile(latencies, 50),
+        "p90": percentile(latencies, 90),
+        "p99": percentile(latencies, 99),
+    }
+
+
+def format_stats(stats):
+    return (
+        "{requests} requests, {concurrency} clients, {errors} errors"
+        + (", uncached" if stats.get("unique") else "") + " "
+        "in {elapsed:.2f}s: {rps:.1f} req/s, "
+        "p50 {p50:.3f}s / p90 {p90:.3f}s / p99 {p99:.3f}s"
+    ).format(**stats)
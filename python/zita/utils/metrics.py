@@ -0,0 +1,251 @@
+"""
+Lightweight in-process metrics
+
+A tiny subset of the Prometheus client API (counters, gauges and
+histograms with labels), cheap enough to keep on in production.
+"""
+import bisect
+import threading
+
+from collections import OrderedDict
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+class Metric(object):
+    """Base class for a metric family with optional labels"""
+    type = None
+
+    def __init__(self, name, documentation='', labelnames=(),
+                 registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = OrderedDict()
+        if registry is None:
+            registry = REGISTRY
+        if registry is not False:
+            registry.register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def clear(self):
+        """Remove all children, e.g. before setting gauges of things
+        that may be gone"""
+        with self._lock:
+            self._children.clear()
+
+    def labels(self, *labelvalues, **labelkwargs):
+        if labelkwargs:
+            labelvalues = tuple(labelkwargs[x] for x in self.labelnames)
+        labelvalues = tuple(str(x) for x in labelvalues)
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(f'Incorrect label count for {self.name}')
+        child = self._children.get(labelvalues)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(labelvalues,
+                                                  self._new_child())
+        return child
+
+    def _default(self):
+        if self.labelnames:
+            raise ValueError(f'{self.name} requires labels '
+                             f'{self.labelnames}')
+        return self.labels()
+
+    def samples(self):
+        """Yield (suffix, labels, value) for all children"""
+        for labelvalues, child in list(self._children.items()):
+            labels = OrderedDict(zip(self.labelnames, labelvalues))
+            for suffix, extra, value in child.samples():
+                yield suffix, OrderedDict(labels, **extra), value
+
+
+class _Value(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = float(value)
+
+    def get(self):
+        return self.value
+
+    def samples(self):
+        yield '', {}, self.value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def samples(self):
+        for suffix, labels, value in super().samples():
+            yield '_total', labels, value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def dec(self, amount=1):
+        self._default().dec(amount)
+
+    def set(self, value):
+        self._default().set(value)
+
+
+class _HistogramValue(object):
+
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        """Return a dict of {upper bound: cumulative count}"""
+        with self._lock:
+            counts = list(self.counts)
+        cumulative, ret = 0, OrderedDict()
+        for bound, count in zip([*self.buckets, float('inf')], counts):
+            cumulative += count
+            ret[bound] = cumulative
+        return ret
+
+    def samples(self):
+        for bound, count in self.snapshot().items():
+            yield '_bucket', {'le': _format_value(bound)}, count
+        yield '_count', {}, self.count
+        yield '_sum', {}, self.sum
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation='', labelnames=(),
+                 buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(float(x) for x in buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+
+class Registry(object):
+    """A collection of metrics that can be rendered together"""
+
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._collectors = []
+
+    def on_collect(self, func):
+        """Call `func` before each render, to update gauges of values
+        that are cheaper to read when scraped (queue sizes, memory)"""
+        self._collectors.append(func)
+        return func
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f'Duplicate metric: {metric.name}')
+        self._metrics[metric.name] = metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def collect(self):
+        """All metrics as a list of (name, documentation, type,
+        [(suffix, labels, value), ...]), e.g. to send them to another
+        process"""
+        for collect in self._collectors:
+            collect()
+        return [(metric.name, metric.documentation, metric.type,
+                 list(metric.samples()))
+                for metric in self._metrics.values()]
+
+    def render(self):
+        """Render all metrics in Prometheus text exposition format"""
+        return render(self.collect())
+
+
+def render(families):
+    """Render metrics collected by `Registry.collect`"""
+    lines = []
+    for name, documentation, type_, samples in families:
+        lines.append(f'# HELP {name} {documentation}')
+        lines.append(f'# TYPE {name} {type_}')
+        for suffix, labels, value in samples:
+            lines.append(f'{name}{suffix}{_format_labels(labels)}'
+                         f' {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+def merge(families_by_label, label):
+    """Merge metrics collected in several processes, with a `label` to
+    tell them apart, e.g. {"worker-0": families, ...}"""
+    merged = OrderedDict()
+    for label_value, families in families_by_label.items():
+        for name, documentation, type_, samples in families:
+            if name not in merged:
+                merged[name] = (name, documentation, type_, [])
+            merged[name][3].extend(
+                (suffix, OrderedDict([(label, label_value), *labels.items()]),
+                 value)
+                for suffix, labels, value in samples)
+    return list(merged.values())
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', r'\\')
+                         .replace('\n', r'\n').replace('"', r'\"'))
+        for k, v in labels.items())
+    return '{' + pairs + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+# Default registry
+REGISTRY = Registry()
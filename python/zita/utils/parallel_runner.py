@@ -1,16 +1,28 @@
 """
 Run parallel tasks in ThreadPoolExecutor
 """
+import weakref
+
 from concurrent.futures import ThreadPoolExecutor
 
+from zita.utils.metrics import REGISTRY, Gauge
+
+QUEUE_DEPTH = Gauge(
+    'zita_runner_queue_depth',
+    'Number of tasks waiting for a thread of a ParallelRunner', ['runner'])
+# named runners, for metrics
+RUNNERS = weakref.WeakValueDictionary()
+
 
 class ParallelRunner:
     """Run a function in ThreadPoolExecutor for list of arguments
     and return the results.
     """
 
-    def __init__(self, pool=None, max_workers=None):
+    def __init__(self, pool=None, max_workers=None, name=None):
         self._executor = pool or ThreadPoolExecutor(max_workers=max_workers)
+        if name:
+            RUNNERS[name] = self
 
     def run(self, func, *iterables):
         return [x for x in self.map(func, *iterables)]
@@ -18,8 +30,19 @@ class ParallelRunner:
     def map(self, func, *iterables):
         return self._executor.map(func, *iterables)
 
+    def queue_depth(self):
+        # only ThreadPoolExecutor has a work queue
+        queue = getattr(self._executor, '_work_queue', None)
+        return queue.qsize() if queue is not None else 0
+
     def __enter__(self):
         return self
 
     def __exit__(self, exception_type, exception_value, traceback):
         self._executor.__exit__(exception_type, exception_value, traceback)
+
+
+@REGISTRY.on_collect
+def collect_queue_depths():
+    for name, runner in list(RUNNERS.items()):
+        QUEUE_DEPTH.labels(name).set(runner.queue_depth())
@@ -0,0 +1,90 @@
+"""
+Bounded in-process LRU cache with expiration
+"""
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """Thread-safe LRU cache whose entries expire after `ttl` seconds
+
+    Parameters
+    ----------
+        maxsize:  max number of entries, least recently used entries
+                  are dropped first.
+        ttl:      seconds before an entry expires, None to never expire.
+    """
+
+    def __init__(self, maxsize, ttl=None, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _get(self, key, now):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        value, expires = item
+        if expires is not None and expires <= now:
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._get(key, self.timer())
+        return default if value is None else value
+
+    def get_many(self, keys):
+        """Values of a list of keys, None for missing keys"""
+        now = self.timer()
+        with self._lock:
+            return [self._get(key, now) for key in keys]
+
+    def _set(self, key, value, expires):
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+
+    def set(self, key, value, ttl=None):
+        self.set_many([(key, value)], ttl=ttl)
+
+    def set_many(self, items, ttl=None):
+        ttl = ttl or self.ttl
+        if self.ttl:
+            ttl = min(ttl, self.ttl)
+        expires = None if ttl is None else self.timer() + ttl
+        with self._lock:
+            for key, value in items:
+                if value is None:
+                    self._data.pop(key, None)
+                else:
+                    self._set(key, value, expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return item and item[0]
+
+    def pop_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()